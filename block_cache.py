@@ -0,0 +1,157 @@
+"""
+Provides an on-disk cache of compressed BPE blocks.
+
+Compressing a BPE block always gives the same result for the same
+decompressed block and sort order, and most blocks of a game file are
+unchanged between mod installs. This module stores each compressed block
+in a cache directory under a name made from the hash of the decompressed
+block and the sort order, so that compression can reuse blocks compressed
+during previous attempts or runs. The least recently used blocks are
+deleted once the cache exceeds its maximum size.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+import hashlib
+import os
+import tempfile
+
+CACHE_VERSION = 1
+MAX_CACHE_SIZE = 0x4000000  # 64 MiB
+
+
+class BlockCache:
+    """
+    A class for storing and retrieving compressed BPE blocks.
+
+    Each compressed block is stored in its own file, in a subdirectory
+    named after the first two characters of the block hash. The
+    modification time of a file is updated whenever it is read, and is
+    used to find the least recently used blocks when the cache is full.
+
+    Functions
+    ---------
+    get()
+        Returns a compressed block from the cache.
+    put()
+        Adds a compressed block to the cache.
+    evict()
+        Deletes least recently used blocks until the cache is 3/4 of its
+        maximum size.
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory containing the cached blocks.
+    max_size : int
+        Maximum total size of the cached blocks in bytes.
+    hits : int
+        Number of blocks found in the cache.
+    misses : int
+        Number of blocks not found in the cache.
+    """
+
+    def __init__(self, cache_dir, max_size=MAX_CACHE_SIZE):
+        # Blocks are kept in a versioned subdirectory, so that blocks
+        # compressed by a different version of the compressor are not used.
+        self.cache_dir = os.path.join(cache_dir, 'v%d' % CACHE_VERSION)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, block, sort_order):
+        digest = hashlib.sha1(block).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2],
+                            '%s_%d' % (digest, sort_order))
+
+    def _entries(self):
+        for subdir in os.scandir(self.cache_dir):
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        yield entry
+
+    def get(self, block, sort_order):
+        """
+        Returns a compressed block from the cache.
+
+        Parameters
+        ----------
+        block : bytes-like
+            Decompressed block.
+        sort_order : int
+            Sort order the block was compressed with.
+
+        Returns
+        -------
+        bytes
+            Compressed block, or None if it is not in the cache.
+        """
+
+        path = self._path(block, sort_order)
+        try:
+            with open(path, 'rb') as f:
+                comp_block = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return comp_block
+
+    def put(self, block, sort_order, comp_block):
+        """
+        Adds a compressed block to the cache.
+
+        The block is written to a temp file that then replaces the cache
+        file, so that other processes never read a partially written block.
+
+        Parameters
+        ----------
+        block : bytes-like
+            Decompressed block.
+        sort_order : int
+            Sort order the block was compressed with.
+        comp_block : bytes
+            Compressed block.
+        """
+
+        path = self._path(block, sort_order)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(comp_block)
+            os.replace(temp, path)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+
+        if self._size is None:
+            self._size = sum(entry.stat().st_size for entry in self._entries())
+        else:
+            self._size += len(comp_block)
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes least recently used blocks until the cache is 3/4 of its
+        maximum size, so that the cache is not scanned again on every put.
+        """
+
+        entries = sorted(((entry.stat(), entry.path) for entry in self._entries()),
+                         key=lambda x: x[0].st_mtime)
+        self._size = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if self._size <= self.max_size * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= stat.st_size
@@ -0,0 +1,1454 @@
+"""
+Provides an in-memory codec for LoD's Byte-Pair Encoded (BPE) data.
+
+This module contains the decompression and compression logic used by the
+BPE handling functions in game_file_handler, separated from any file
+handling. All functions accept any buffer (bytes, bytearray, memoryview or
+mmap) and return bytes, so BPE data can be decoded and re-encoded without
+creating intermediate files (e.g. for BPE subfiles contained in MRG files).
+
+Compressed BPE data is made up of an 8-byte header (4-byte total decompressed
+size and b'BPE\\x1a'), followed by blocks of up to 0x800 decompressed bytes.
+Each compressed block is composed of a 4-byte header specifying the size of
+the decompressed block, instructions for filling out a byte-pair dictionary,
+and the compressed data, padded to a word boundary. A block size of 0 marks
+the end of the data.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BPE_MAGIC = b'BPE\x1a'
+BLOCK_SIZE = 0x800
+META_END = b'\xff' * 4
+INDEX_MAGIC = b'BIDX'
+INDEX_VERSION = 1
+BACKENDS = ('python', 'numpy')
+SORT_ORDERS = range(5)
+
+
+class BlockMeta:
+    """
+    A class for storing the metadata necessary for re-compressing a range
+    of decompressed BPE blocks.
+
+    Functions
+    ---------
+    from_bytes()
+        Creates a BlockMeta object from the contents of a meta file.
+    to_bytes()
+        Returns the BlockMeta object in meta file format.
+    set_index()
+        Records the block index of a compressed block range.
+    index_matches()
+        Checks whether the block index matches a compressed file.
+
+    Attributes
+    ----------
+    decompressed_size : int
+        Size of the decompressed block range.
+    start_block : int
+        First block of the decompressed range.
+    end_block : int
+        Block that the decompressed range ends on (non-inclusive).
+    block_sizes : int list
+        Decompressed sizes of each block in the range.
+    sort_orders : int list
+        Sort order used to compress each block in the range, if the range
+        has been compressed in mod mode or as a subfile.
+    bpe_start : int
+        Offset of the BPE header within the compressed file.
+    block_offsets : int list
+        Offsets of each compressed block in the range within the compressed
+        file. Empty if the meta file has no block index.
+    compressed_sizes : int list
+        Compressed size of each block in the range, including the block
+        size header and word-alignment padding.
+    range_checksum : int
+        CRC-32 of the compressed block range, used to check that the block
+        index still matches the compressed file.
+    """
+
+    def __init__(self, decompressed_size=0, start_block=0, end_block=0,
+                 block_sizes=None, sort_orders=None):
+        """
+        Parameters
+        ----------
+        decompressed_size : int
+            Size of the decompressed block range. (default: 0)
+        start_block : int
+            First block of the decompressed range. (default: 0)
+        end_block : int
+            Block that the decompressed range ends on. (default: 0)
+        block_sizes : int list
+            Decompressed sizes of each block in the range. (default: None)
+        sort_orders : int list
+            Sort order used to compress each block. (default: None)
+        """
+
+        self.decompressed_size = decompressed_size
+        self.start_block = start_block
+        self.end_block = end_block
+        self.block_sizes = block_sizes if block_sizes is not None else []
+        self.sort_orders = sort_orders if sort_orders is not None else []
+        self.bpe_start = 0
+        self.block_offsets = []
+        self.compressed_sizes = []
+        self.range_checksum = 0
+
+    def __len__(self):
+        return len(self.block_sizes)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Creates a BlockMeta object from the contents of a meta file.
+
+        The meta file consists of the decompressed size (4 bytes), start
+        block (2 bytes), end block (2 bytes), the decompressed size of each
+        block (4 bytes each), an optional block index section, a 0xffffffff
+        terminator, and optionally one sort order byte per block.
+
+        The block index section starts with b'BIDX', a 4-byte version and
+        the 4-byte length of the rest of the section. Version 1 contains
+        the BPE start offset, the range checksum, the number of blocks, and
+        an (offset, compressed size) pair for each block, all 4 bytes each.
+        Sections with an unknown version are skipped.
+
+        Parameters
+        ----------
+        data : bytes
+            Contents of the meta file.
+
+        Returns
+        -------
+        BlockMeta
+            Metadata read from data.
+        """
+
+        meta = cls(int.from_bytes(data[0:4], 'little'),
+                   int.from_bytes(data[4:6], 'little'),
+                   int.from_bytes(data[6:8], 'little'))
+
+        offset = 8
+        while offset < len(data):
+            word = bytes(data[offset:offset+4])
+            offset += 4
+            if word == META_END:
+                meta.sort_orders = list(data[offset:])
+                break
+            elif word == INDEX_MAGIC:
+                version = int.from_bytes(data[offset:offset+4], 'little')
+                section_len = int.from_bytes(data[offset+4:offset+8], 'little')
+                offset += 8
+                if version == INDEX_VERSION:
+                    meta._read_index(data[offset:offset+section_len])
+                offset += section_len
+            else:
+                meta.block_sizes.append(int.from_bytes(word, 'little'))
+
+        return meta
+
+    def _read_index(self, section):
+        """
+        Reads a version 1 block index section.
+
+        Parameters
+        ----------
+        section : bytes
+            Block index section, excluding magic, version, and length.
+        """
+
+        words = [int.from_bytes(section[i:i+4], 'little')
+                 for i in range(0, len(section), 4)]
+        self.bpe_start, self.range_checksum, num_blocks = words[:3]
+        self.block_offsets = words[3:3 + num_blocks * 2:2]
+        self.compressed_sizes = words[4:4 + num_blocks * 2:2]
+
+    def to_bytes(self):
+        """
+        Returns the BlockMeta object in meta file format.
+
+        Returns
+        -------
+        bytes
+            Contents of the meta file.
+        """
+
+        meta = [self.decompressed_size.to_bytes(4, 'little'),
+                self.start_block.to_bytes(2, 'little'),
+                self.end_block.to_bytes(2, 'little')]
+        meta.extend(size.to_bytes(4, 'little') for size in self.block_sizes)
+        if self.block_offsets:
+            words = [self.bpe_start, self.range_checksum, len(self.block_offsets)]
+            for block_offset, size in zip(self.block_offsets, self.compressed_sizes):
+                words.extend((block_offset, size))
+            meta.extend((INDEX_MAGIC, INDEX_VERSION.to_bytes(4, 'little'),
+                         (len(words) * 4).to_bytes(4, 'little')))
+            meta.extend(word.to_bytes(4, 'little') for word in words)
+        meta.append(META_END)
+        meta.append(bytes(self.sort_orders))
+
+        return b''.join(meta)
+
+    def set_index(self, bpe_start, start_block_offset, comp_block_list):
+        """
+        Records the block index of a compressed block range.
+
+        Parameters
+        ----------
+        bpe_start : int
+            Offset of the BPE header within the compressed file.
+        start_block_offset : int
+            Offset of the first block of the range in the compressed file.
+        comp_block_list : list
+            Compressed blocks of the range, including block size headers,
+            in the order they appear in the compressed file.
+        """
+
+        self.bpe_start = bpe_start
+        self.block_offsets = []
+        self.compressed_sizes = []
+        offset = start_block_offset
+        for comp_block in comp_block_list:
+            self.block_offsets.append(offset)
+            self.compressed_sizes.append(len(comp_block))
+            offset += len(comp_block)
+        self.range_checksum = _checksum(b''.join(comp_block_list))
+
+    def index_matches(self, buf):
+        """
+        Checks whether the block index matches a compressed file.
+
+        Parameters
+        ----------
+        buf : bytes-like
+            Buffer containing the compressed file.
+
+        Returns
+        -------
+        bool
+            Whether the block index is present and up to date.
+        """
+
+        if not self.block_offsets:
+            return False
+
+        range_start = self.block_offsets[0]
+        range_end = self.block_offsets[-1] + self.compressed_sizes[-1]
+        return range_end + 4 <= len(buf) \
+            and buf[self.bpe_start+4:self.bpe_start+8] == BPE_MAGIC \
+            and _checksum(buf[range_start:range_end]) == self.range_checksum
+
+
+def _checksum(buf):
+    """
+    Returns the CRC-32 of a buffer used to validate block indexes.
+
+    The checksum is masked to 31 bits so that it can never be mistaken for
+    the 0xffffffff terminator by code that scans meta files word by word.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer to checksum.
+
+    Returns
+    -------
+    int
+        Masked CRC-32 of buf.
+    """
+
+    return zlib.crc32(buf) & 0x7fffffff
+
+
+def find_bpe_start(buf, is_subfile=False):
+    """
+    Finds the offset of the BPE header within a buffer.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing BPE data.
+    is_subfile : bool
+        Flag indicating whether buffer is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+
+    Returns
+    -------
+    int
+        Offset of the 8-byte BPE header, or None if no BPE data was found.
+    """
+
+    if BPE_MAGIC in bytes(buf[:8]):
+        return 0
+    elif is_subfile:
+        # The BPE magic is word-aligned within the files that contain BPE
+        # subfiles (SCUS/SCES/SCPS and S_BTLD).
+        for offset in range(8, len(buf) - 3, 4):
+            if buf[offset:offset+4] == BPE_MAGIC:
+                return offset - 4
+
+    return None
+
+
+def _read_dictionary(buf, offset):
+    """
+    Reads the byte-pair dictionary at the start of a compressed block.
+
+    Reads bytes as instructions for building the byte-pair dictionary,
+    filling it out until the key exceeds the dictionary size (256 bytes).
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing the compressed data.
+    offset : int
+        Offset of the first dictionary instruction byte in buf.
+
+    Returns
+    -------
+    (list, list, int)
+        Left-character and right-character dictionaries, and the offset of
+        the first compressed data byte following the dictionary.
+    """
+
+    # Build the initial dictionary/lookup table. The left-character dict
+    # is filled so that each key contains itself as a value, while the
+    # right-character dict is filled with empty values. Both have room for
+    # a sequential run to overflow the last key, as the original reader
+    # consumed those bytes without using them.
+    dict_leftch = list(range(0x180))
+    dict_rightch = [0] * 0x180
+
+    # Build adaptive dictionary.
+    key = 0x00
+    while key < 0x100:  # Dictionary is 256 bytes long. Loop until all keys filled.
+        # If byte_pairs_to_read is >=0x80, then only the next byte will
+        # be read into the dictionary, placed at the index value calculated
+        # using the below formula. Otherwise, the byte indicates how many
+        # sequential bytes to read into the dictionary.
+        byte_pairs_to_read = buf[offset]
+        offset += 1
+        if byte_pairs_to_read >= 0x80:
+            key = key - 0x7f + byte_pairs_to_read
+            byte_pairs_to_read = 0
+
+        # For each byte/byte pair to read, read the next byte and add it
+        # to the leftch dict at the current key. If the character matches
+        # the key it's at, increment key and continue. If it does not,
+        # read the next character and add it to the same key in the
+        # rightch dict before incrementing key and continuing.
+        if key < 0x100:  # Check that dictionary length not exceeded.
+            for i in range(byte_pairs_to_read+1):
+                compressed_byte = buf[offset]
+                offset += 1
+                dict_leftch[key] = compressed_byte
+
+                if compressed_byte != key:
+                    dict_rightch[key] = buf[offset]
+                    offset += 1
+
+                key += 1
+
+    return dict_leftch, dict_rightch, offset
+
+
+def _build_expansion_table(dict_leftch, dict_rightch):
+    """
+    Expands every dictionary key into the full byte string it decodes to.
+
+    Keys whose left character is the key itself are literals. All other
+    keys expand to the expansion of their left character followed by the
+    expansion of their right character. Expansions are memoized, so each
+    key is only resolved once per block.
+
+    Parameters
+    ----------
+    dict_leftch : list
+        Left-character dictionary of the block.
+    dict_rightch : list
+        Right-character dictionary of the block.
+
+    Returns
+    -------
+    list
+        List of 256 bytes objects indexed by key.
+    """
+
+    expansion_table = [None] * 0x100
+
+    def expand(key):
+        if expansion_table[key] is None:
+            if dict_leftch[key] == key:
+                expansion_table[key] = bytes((key,))
+            else:
+                expansion_table[key] = b''.join(
+                    (expand(dict_leftch[key]), expand(dict_rightch[key])))
+        return expansion_table[key]
+
+    for k in range(0x100):
+        expand(k)
+
+    return expansion_table
+
+
+def _decode_block(buf, offset, block_size, expansion_table):
+    """
+    Decodes the compressed data of a single block.
+
+    Each compressed byte is replaced by its expansion until block_size
+    decompressed bytes have been produced.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing the compressed data.
+    offset : int
+        Offset of the first compressed data byte of the block.
+    block_size : int
+        Decompressed size of the block.
+    expansion_table : list
+        Key expansions built by _build_expansion_table().
+
+    Returns
+    -------
+    (bytes, int)
+        Decompressed block and the offset following the compressed data.
+    """
+
+    block_data = []
+    bytes_remaining_in_block = block_size
+    while bytes_remaining_in_block > 0:
+        expansion = expansion_table[buf[offset]]
+        offset += 1
+        block_data.append(expansion)
+        bytes_remaining_in_block -= len(expansion)
+
+    return b''.join(block_data), offset
+
+
+def _build_length_table(dict_leftch, dict_rightch):
+    """
+    Finds the decompressed length of every dictionary key.
+
+    Works the same way as _build_expansion_table(), but only keeps the
+    lengths of the expansions, so no decompressed data is created.
+
+    Parameters
+    ----------
+    dict_leftch : list
+        Left-character dictionary of the block.
+    dict_rightch : list
+        Right-character dictionary of the block.
+
+    Returns
+    -------
+    list
+        List of 256 expansion lengths indexed by key.
+    """
+
+    length_table = [0] * 0x100
+
+    def expand(key):
+        if not length_table[key]:
+            if dict_leftch[key] == key:
+                length_table[key] = 1
+            else:
+                length_table[key] = expand(dict_leftch[key]) + expand(dict_rightch[key])
+        return length_table[key]
+
+    for k in range(0x100):
+        expand(k)
+
+    return length_table
+
+
+def _skip_block(buf, offset, block_size, length_table):
+    """
+    Finds the end of the compressed data of a single block.
+
+    Sums the expansion length of each compressed byte until block_size
+    decompressed bytes would have been produced.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing the compressed data.
+    offset : int
+        Offset of the first compressed data byte of the block.
+    block_size : int
+        Decompressed size of the block.
+    length_table : list
+        Key expansion lengths built by _build_length_table().
+
+    Returns
+    -------
+    int
+        Offset following the compressed data.
+    """
+
+    bytes_remaining_in_block = block_size
+    while bytes_remaining_in_block > 0:
+        bytes_remaining_in_block -= length_table[buf[offset]]
+        offset += 1
+
+    return offset
+
+
+def _read_block_size(buf, offset):
+    """
+    Reads the 4-byte decompressed size at the head of a compressed block.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing the compressed data.
+    offset : int
+        Offset of the block header.
+
+    Returns
+    -------
+    int
+        Decompressed size of the block, or 0 if the end of the data has
+        been reached.
+    """
+
+    block_size = int.from_bytes(buf[offset:offset+4], 'little')
+    if block_size > BLOCK_SIZE:
+        raise ValueError('0x%s at offset 0x%08x is an invalid block size' %
+                         (bytes(buf[offset:offset+4]).hex(), offset))
+
+    return block_size
+
+
+def decompress(buf, start_block=0, end_block=512, is_subfile=False, pool=None):
+    """
+    Decompresses BPE-compressed data.
+
+    Decompression works by reading bytes as instructions for building the
+    byte-pair dictionary of each block. Once the dictionary is filled out,
+    every key is expanded into the full byte string it stands for, and each
+    byte of compressed data is replaced by the expansion of its key until
+    the decompressed size of the block is reached.
+
+    If a pool is given, the blocks are first located with scan_blocks(),
+    then decoded in the pool with decode_block() and joined back in order.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing BPE-compressed data.
+    start_block : int
+        Data block to start decompression from. (default: 0)
+    end_block : int
+        Data block to decompress up to (non-inclusive). If not greater than
+        start_block, decompresses through the end of the data. (default: 512)
+    is_subfile : bool
+        Flag indicating whether buffer is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+    pool : multiprocessing.Pool
+        Pool to decode the blocks in, if any. (default: None)
+
+    Returns
+    -------
+    (bytes, BlockMeta)
+        Decompressed data and the metadata needed to re-compress it.
+    """
+
+    if end_block <= start_block:
+        end_block = 512
+
+    if pool is not None:
+        return _decompress_in_pool(buf, start_block, end_block, is_subfile, pool)
+
+    bpe_start = find_bpe_start(buf, is_subfile)
+    if bpe_start is None:
+        raise ValueError('Not a BPE file')
+
+    offset = bpe_start + 8  # Skip file size and BPE.
+    block = -1
+    block_sizes = []
+    block_offsets = []
+    decompressed_block_list = []
+    while True:
+        block += 1
+        block_offset = offset
+
+        # Each block is preceded by 4-byte int up to 0x800 giving the number
+        # of decompressed bytes in the block. 0x00000000 indicates that there
+        # are no further blocks and decompression is complete.
+        block_size = _read_block_size(buf, offset)
+        offset += 4
+        if not block_size or block >= end_block:
+            break
+
+        # Build the dictionary, expand each key into its full byte string,
+        # then decompress the block using one lookup per compressed byte.
+        dict_leftch, dict_rightch, offset = _read_dictionary(buf, offset)
+        expansion_table = _build_expansion_table(dict_leftch, dict_rightch)
+        block_data, offset = _decode_block(buf, offset, block_size, expansion_table)
+        if block >= start_block:
+            block_sizes.append(block_size)
+            block_offsets.append(block_offset)
+            decompressed_block_list.append(block_data)
+
+        if offset % 4 != 0:  # Word-align the pointer.
+            offset += 4 - offset % 4
+
+    decompressed_data = b''.join(decompressed_block_list)
+    meta = BlockMeta(len(decompressed_data), start_block,
+                     min(block, end_block), block_sizes)
+
+    # Record where each compressed block of the range is, so that it can
+    # be found again without decompressing when the range is compressed.
+    if block_offsets:
+        meta.bpe_start = bpe_start
+        meta.block_offsets = block_offsets
+        meta.compressed_sizes = [b - a for a, b in
+                                 zip(block_offsets, block_offsets[1:] + [block_offset])]
+        meta.range_checksum = _checksum(buf[block_offsets[0]:block_offset])
+
+    return decompressed_data, meta
+
+
+def _decompress_in_pool(buf, start_block, end_block, is_subfile, pool):
+    """
+    Decompresses BPE-compressed data, decoding the blocks in a pool.
+
+    See decompress().
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing BPE-compressed data.
+    start_block : int
+        Data block to start decompression from.
+    end_block : int
+        Data block to decompress up to (non-inclusive).
+    is_subfile : bool
+        Flag indicating whether buffer is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body.
+    pool : multiprocessing.Pool
+        Pool to decode the blocks in.
+
+    Returns
+    -------
+    (bytes, BlockMeta)
+        Decompressed data and the metadata needed to re-compress it.
+    """
+
+    bpe_start, block_offsets, end_offset = scan_blocks(buf, end_block, is_subfile)
+    num_blocks = len(block_offsets)
+    block_offsets = block_offsets[start_block:]
+    block_ends = block_offsets[1:] + [end_offset]
+
+    # Each block is sent to the pool as its own bytes object, so that the
+    # whole buffer does not have to be copied to every worker.
+    block_list = [bytes(buf[a:b]) for a, b in zip(block_offsets, block_ends)]
+    decompressed_block_list = pool.map(decode_block, block_list)
+
+    decompressed_data = b''.join(decompressed_block_list)
+    meta = BlockMeta(len(decompressed_data), start_block, num_blocks,
+                     [_read_block_size(buf, a) for a in block_offsets])
+
+    if block_offsets:
+        meta.bpe_start = bpe_start
+        meta.block_offsets = block_offsets
+        meta.compressed_sizes = [b - a for a, b in zip(block_offsets, block_ends)]
+        meta.range_checksum = _checksum(buf[block_offsets[0]:end_offset])
+
+    return decompressed_data, meta
+
+
+def scan_blocks(buf, end_block=512, is_subfile=False):
+    """
+    Finds the extent of each compressed block without decompressing it.
+
+    Walks through the compressed blocks summing the decompressed length of
+    each compressed byte, which is enough to find where every block ends.
+    Since blocks do not depend on each other, the blocks found can then be
+    decoded in any order using decode_block().
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing BPE-compressed data.
+    end_block : int
+        Block to stop scanning at (non-inclusive). (default: 512)
+    is_subfile : bool
+        Flag indicating whether buffer is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+
+    Returns
+    -------
+    (int, int list, int)
+        Offset of the BPE header, offsets of each block up to end_block,
+        and offset of the block header following the last block scanned.
+    """
+
+    bpe_start = find_bpe_start(buf, is_subfile)
+    if bpe_start is None:
+        raise ValueError('Not a BPE file')
+
+    offset = bpe_start + 8
+    block_offsets = []
+    while True:
+        block_offset = offset
+        block_size = _read_block_size(buf, offset)
+        offset += 4
+        if not block_size or len(block_offsets) >= end_block:
+            break
+
+        dict_leftch, dict_rightch, offset = _read_dictionary(buf, offset)
+        length_table = _build_length_table(dict_leftch, dict_rightch)
+        offset = _skip_block(buf, offset, block_size, length_table)
+        block_offsets.append(block_offset)
+
+        if offset % 4 != 0:  # Word-align the pointer.
+            offset += 4 - offset % 4
+
+    return bpe_start, block_offsets, block_offset
+
+
+def decode_block(block_buf):
+    """
+    Decompresses a single compressed block.
+
+    Parameters
+    ----------
+    block_buf : bytes-like
+        Compressed block, starting with its 4-byte block size header.
+
+    Returns
+    -------
+    bytes
+        Decompressed block.
+    """
+
+    block_size = _read_block_size(block_buf, 0)
+    dict_leftch, dict_rightch, offset = _read_dictionary(block_buf, 4)
+    expansion_table = _build_expansion_table(dict_leftch, dict_rightch)
+
+    return _decode_block(block_buf, offset, block_size, expansion_table)[0]
+
+
+def find_block_offsets(buf, start_block=0, end_block=512, is_subfile=False,
+                       meta=None):
+    """
+    Finds the offsets of the start and end blocks of a block range.
+
+    If the metadata of the range has a block index that still matches the
+    buffer, the offsets are read from the index. Otherwise, the blocks are
+    found using scan_blocks(), without decompressing any data.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing BPE-compressed data.
+    start_block : int
+        First block of the range. (default: 0)
+    end_block : int
+        Block that the range ends on (non-inclusive). (default: 512)
+    is_subfile : bool
+        Flag indicating whether buffer is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+    meta : BlockMeta
+        Metadata of the range, if available. (default: None)
+
+    Returns
+    -------
+    (int, int, int)
+        Offsets of start and end block and BPE start within buffer,
+        respectively.
+    """
+
+    if meta is not None and meta.index_matches(buf):
+        return meta.block_offsets[0], \
+            meta.block_offsets[-1] + meta.compressed_sizes[-1], meta.bpe_start
+
+    if end_block <= start_block:
+        end_block = 512
+
+    bpe_start, block_offsets, end_offset = scan_blocks(buf, end_block, is_subfile)
+    block_offsets.append(end_offset)
+    if start_block < len(block_offsets):
+        start_block_offset = block_offsets[start_block]
+    else:
+        start_block_offset = bpe_start + 8
+
+    return start_block_offset, end_offset, bpe_start
+
+
+def _tie_break(sort_order, occurrences):
+    """
+    Returns the function used to choose between byte pairs of equal count.
+
+    Byte pairs are always chosen primarily by count; however, the game does
+    not seem to have a consistent order for choosing between byte pairs with
+    the same count. Depending on how byte pairs are subsorted according to
+    each byte's value (e.g. 1st byte ascending, 2nd byte descending), the
+    block may compress to a different size. Since it is necessary for
+    modding to compress a file to <= its original size, varying sort order
+    can help achieve smaller compressed size.
+
+    Sort order 0 chooses the byte pair that occurs first in the block.
+
+    Parameters
+    ----------
+    sort_order : int
+        Int indicating how byte pairs should be sorted.
+    occurrences : dict
+        Dict containing the set of positions of each byte pair in the block.
+
+    Returns
+    -------
+    function
+        Key function for min() that takes a byte pair.
+    """
+
+    if sort_order == 0:
+        return lambda pair: min(occurrences[pair])
+    elif sort_order == 1:
+        return lambda pair: (pair[0], pair[1])
+    elif sort_order == 2:
+        return lambda pair: (-pair[0], pair[1])
+    elif sort_order == 3:
+        return lambda pair: (pair[0], -pair[1])
+    else:
+        return lambda pair: (-pair[0], -pair[1])
+
+
+def split_blocks(data, meta):
+    """
+    Splits decompressed data into blocks for compression.
+
+    Blocks are split using the original block sizes from the metadata. The
+    final original block and any data beyond the original blocks (e.g. data
+    added to the end of a file by a mod) are split into 0x800-byte blocks.
+
+    Parameters
+    ----------
+    data : bytes-like
+        Decompressed data.
+    meta : BlockMeta
+        Metadata created when data was decompressed.
+
+    Returns
+    -------
+    list
+        List of decompressed blocks.
+    """
+
+    block_list = []
+    offset = 0
+    block_num = 0
+    while offset < len(data):
+        if block_num >= len(meta.block_sizes) - 1:
+            block_size = BLOCK_SIZE
+        else:
+            block_size = meta.block_sizes[block_num]
+        block_list.append(bytes(data[offset:offset+block_size]))
+        offset += block_size
+        block_num += 1
+
+    return block_list
+
+
+def compress_block(block, sort_order=0, backend='python'):
+    """
+    BPE compresses block of data.
+
+    Function goes through uncompressed data block and counts occurrences
+    of byte pairs, iteratively replacing the most frequent byte pair with
+    its assigned key until all keys are filled. Once the dictionary is
+    built, it is converted into a series of byte instructions and the
+    compressed data is appended to the instructions.
+
+    Rather than recounting the whole block after each replacement, the
+    block is kept as a linked list of positions, and the count and
+    positions of each byte pair are updated only around the positions
+    where a pair was replaced. Pairs are grouped by count, so the next pair
+    to replace is found by looking at the highest count only.
+
+    Parameters
+    ----------
+    block : bytes-like
+        Block of up to 0x800 decompressed bytes.
+    sort_order : int
+        Number indicating how to sort byte pairs with the same count.
+        (default: 0)
+    backend : str
+        'python', or 'numpy' to use _compress_block_numpy(). Both produce
+        identical output. (default: 'python')
+
+    Returns
+    -------
+    bytes
+        Compressed block, word-aligned with 0x8c padding. Does not include
+        the 4-byte block size header.
+    """
+
+    if backend == 'numpy':
+        return _compress_block_numpy(block, sort_order)
+
+    # Build the initial dictionary/lookup table. Both dicts are filled with
+    # empty values, after which each unique byte found in the block is
+    # added to dict_leftch as itself.
+    dict_leftch = {x: '' for x in range(0x100)}
+    dict_rightch = dict_leftch.copy()
+
+    values = list(bytes(block))
+    for byte in set(values):
+        dict_leftch[byte] = byte
+
+    # Create sorted list of unfilled keys available to hold byte pairs.
+    empty_keys = sorted([key for key in dict_leftch.keys()
+                         if dict_leftch[key] == '' and key != 0xff])
+    last_empty_key = empty_keys[-1]
+
+    # Positions in the block are linked to their neighbours, so that
+    # replacing a byte pair only requires unlinking its second position.
+    # Byte pairs are identified by the position of their first byte.
+    size = len(values)
+    next_pos = list(range(1, size + 1))
+    prev_pos = list(range(-1, size - 1))
+    occurrences = {}  # Positions at which each byte pair occurs.
+    count_groups = {}  # Byte pairs grouped by number of occurrences.
+
+    def add_pair(pair, pos):
+        positions = occurrences.setdefault(pair, set())
+        if positions:
+            count_groups[len(positions)].discard(pair)
+        positions.add(pos)
+        count_groups.setdefault(len(positions), set()).add(pair)
+
+    def remove_pair(pair, pos):
+        positions = occurrences[pair]
+        count_groups[len(positions)].discard(pair)
+        positions.discard(pos)
+        if positions:
+            count_groups[len(positions)].add(pair)
+        else:
+            del occurrences[pair]
+
+    for i in range(size - 1):
+        add_pair((values[i], values[i + 1]), i)
+
+    tie_break = _tie_break(sort_order, occurrences)
+    max_count = max(count_groups, default=0)
+
+    # Add byte pairs to empty keys in dictionaries. Byte pairs are only
+    # added to the dictionary if they occur at least 5 times and there are
+    # still unfilled keys in the dicts. A new pair can never occur more often
+    # than the pair it was created from, so the highest count never rises.
+    while empty_keys:
+        while max_count >= 5 and not count_groups.get(max_count):
+            max_count -= 1
+        if max_count < 5:
+            break
+
+        left, right = byte_pair = min(count_groups[max_count], key=tie_break)
+        empty_key = empty_keys.pop(-1)
+        dict_leftch[empty_key] = left
+        dict_rightch[empty_key] = right
+
+        # Replace the byte pair from left to right without overlaps,
+        # skipping positions consumed by the previous replacement.
+        for pos in sorted(occurrences[byte_pair]):
+            nxt = next_pos[pos]
+            if values[pos] != left or nxt >= size or values[nxt] != right:
+                continue
+
+            before, after = prev_pos[pos], next_pos[nxt]
+            if before >= 0:
+                remove_pair((values[before], left), before)
+            remove_pair(byte_pair, pos)
+            if after < size:
+                remove_pair((right, values[after]), nxt)
+
+            values[pos] = empty_key
+            values[nxt] = None
+            next_pos[pos] = after
+            if after < size:
+                prev_pos[after] = pos
+
+            if before >= 0:
+                add_pair((values[before], empty_key), before)
+            if after < size:
+                add_pair((empty_key, values[after]), pos)
+
+    curr_block = []
+    pos = 0
+    while pos < size:
+        curr_block.append(values[pos])
+        pos = next_pos[pos]
+
+    return _encode_dictionary(dict_leftch, dict_rightch, last_empty_key,
+                              bytes(curr_block))
+
+
+def _compress_block_numpy(block, sort_order=0):
+    """
+    BPE compresses block of data using NumPy.
+
+    Produces the same output as compress_block(), but recounts the byte
+    pairs of the whole block with np.bincount() on each pass and replaces
+    the chosen byte pair using array operations.
+
+    Parameters
+    ----------
+    block : bytes-like
+        Block of up to 0x800 decompressed bytes.
+    sort_order : int
+        Number indicating how to sort byte pairs with the same count.
+        (default: 0)
+
+    Returns
+    -------
+    bytes
+        Compressed block, word-aligned with 0x8c padding. Does not include
+        the 4-byte block size header.
+    """
+
+    dict_leftch = {x: '' for x in range(0x100)}
+    dict_rightch = dict_leftch.copy()
+
+    values = np.frombuffer(bytes(block), dtype=np.uint8)
+    for byte in np.unique(values).tolist():
+        dict_leftch[byte] = byte
+
+    empty_keys = sorted([key for key in dict_leftch.keys()
+                         if dict_leftch[key] == '' and key != 0xff])
+    last_empty_key = empty_keys[-1]
+
+    while empty_keys and len(values) > 1:
+        # Each byte pair is counted as a single 16-bit code.
+        pair_codes = (values[:-1].astype(np.uint16) << 8) | values[1:]
+        counts = np.bincount(pair_codes, minlength=0x10000)
+        max_count = counts.max()
+        if max_count < 5:
+            break
+
+        # Choose between byte pairs of equal count the same way as
+        # _tie_break().
+        if sort_order == 0:
+            code = pair_codes[np.argmax(counts[pair_codes] == max_count)]
+        else:
+            candidates = np.flatnonzero(counts == max_count)
+            if sort_order == 1:
+                code = candidates[0]
+            elif sort_order == 4:
+                code = candidates[-1]
+            else:
+                left_bytes = candidates >> 8
+                if sort_order == 2:
+                    candidates = candidates[left_bytes == left_bytes.max()]
+                    code = candidates[0]
+                else:
+                    candidates = candidates[left_bytes == left_bytes.min()]
+                    code = candidates[-1]
+        left, right = int(code) >> 8, int(code) & 0xff
+
+        empty_key = empty_keys.pop(-1)
+        dict_leftch[empty_key] = left
+        dict_rightch[empty_key] = right
+
+        # Replace the byte pair from left to right without overlaps. Matches
+        # can only overlap within runs of a repeated byte, in which case every
+        # other match, starting from the beginning of the run, is replaced.
+        positions = np.flatnonzero(pair_codes == code)
+        if left == right and len(positions) > 1:
+            run_breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+            run_starts = np.zeros(len(positions), dtype=np.intp)
+            run_starts[run_breaks] = run_breaks
+            run_starts = np.maximum.accumulate(run_starts)
+            positions = positions[(np.arange(len(positions)) - run_starts) % 2 == 0]
+
+        values = values.copy()
+        values[positions] = empty_key
+        values = np.delete(values, positions + 1)
+
+    return _encode_dictionary(dict_leftch, dict_rightch, last_empty_key,
+                              values.tobytes())
+
+
+def _encode_dictionary(dict_leftch, dict_rightch, last_empty_key, curr_block):
+    """
+    Converts a byte-pair dictionary into byte instructions.
+
+    Builds the dictionary instructions read by _read_dictionary(), and
+    appends the compressed data and word-alignment padding.
+
+    Parameters
+    ----------
+    dict_leftch : dict
+        Left-character dictionary ('' for unused keys).
+    dict_rightch : dict
+        Right-character dictionary ('' for literal and unused keys).
+    last_empty_key : int
+        Highest key that was available to hold a byte pair.
+    curr_block : bytes
+        Compressed data of the block.
+
+    Returns
+    -------
+    bytes
+        Compressed block, word-aligned with 0x8c padding.
+    """
+
+    key_list = sorted(dict_rightch.keys())
+    comp_block = []
+    previous_key = 0
+    header, byte_pair = b'', b''
+
+    # Find either first byte pair or use 0x80 literal. If the latter, assign
+    # \xfe as header and /x7f as the first byte pair/literal. If a byte pair
+    # found before 0x80, calculate header and get byte pair from dicts.
+    for key in key_list:
+        if dict_rightch[key] != '' and key <= 0x7f:
+            header = (key + 0x7f).to_bytes(1, 'big')
+            byte_pair = b''.join(x.to_bytes(1, 'big') for x in
+                                 (dict_leftch[key], dict_rightch[key]))
+            previous_key = key
+            break
+        elif key == 0x80:
+            header = b'\xfe'
+            byte_pair = b'\x7f'
+            previous_key = key - 1
+            break
+    comp_block.append(header)
+    comp_block.append(byte_pair)
+
+    i = previous_key + 1
+    sequential_key_run = False
+    sequential_keys = 0
+    while i <= last_empty_key:
+        byte = dict_rightch[i]
+        if byte != '' and i - previous_key > 1:
+            # If the current key corresponds to a byte pair and there is a >1
+            # key gap between the current and previous byte-pair key, then set
+            # the number of sequential keys to 0 and calculate the header byte.
+            # Then add the byte pair to the list of compressed bytes in order,
+            # set previous_key to the current one, and increment the key.
+            sequential_keys = 0
+            header = (i + 0x7f - (previous_key + 1)).to_bytes(1, 'big')
+            comp_block.append(header)
+            comp_block.append(dict_leftch[i].to_bytes(1, 'big'))
+            comp_block.append(byte.to_bytes(1, 'big'))
+            previous_key = i
+            i += 1
+        elif byte != '' and i - previous_key == 1:
+            # If the current key corresponds to a byte pair and immediately
+            # follows another byte pair, then a) set sequential_key_run to
+            # true if it's not, b) increment sequential keys if the key two
+            # keys later does not exceed dictionary size and the next two
+            # keys contain byte pairs, or c) append the number of sequential
+            # keys to the compressed data, followed by that number of keys'
+            # bytes/byte pairs in sequence.
+            if not sequential_key_run:
+                sequential_key_run = True
+            elif i + 2 < 256 \
+                    and (not (dict_rightch[i + 1] == '' and dict_rightch[i + 2] == '')):
+                sequential_keys += 1
+                previous_key = i
+                i += 1
+            else:
+                comp_block.append(sequential_keys.to_bytes(1, 'big'))
+                while sequential_keys >= 0:
+                    left_byte = dict_leftch[i - sequential_keys].to_bytes(1, 'big')
+                    comp_block.append(left_byte)
+                    if dict_rightch[i - sequential_keys] != '':
+                        right_byte = dict_rightch[i - sequential_keys].to_bytes(1, 'big')
+                        comp_block.append(right_byte)
+                    sequential_keys -= 1
+                sequential_keys = 0
+                sequential_key_run = False
+                previous_key = i
+                i += 1
+        elif byte == '' and sequential_key_run:
+            # If the key contains a byte literal rather than byte pair
+            # and a sequential_key_run is active, increment the number of
+            # sequential keys.
+            sequential_keys += 1
+            previous_key = i
+            i += 1
+        else:  # Move on to next key.
+            i += 1
+
+    if all(val == '' for val in dict_rightch.values()):
+        comp_block.append(b'\xfe\xff')  # For when dictionary contains only literals.
+    else:
+        comp_block.append((0x100 - (last_empty_key + 1) + 0x7f).to_bytes(1, 'big'))
+
+    # Add decompression in front of compressed data block.
+    curr_block = b''.join((b''.join(comp_block), curr_block))
+
+    size = len(curr_block)
+    padding = 4 - (size % 4) if size % 4 else 0
+
+    return b''.join((curr_block, b'\x8c' * padding))
+
+
+def _compress_all(tasks, pool=None, cache=None):
+    """
+    Compresses a list of blocks, using a block cache if given.
+
+    Blocks found in the cache are not compressed again. The remaining
+    blocks are compressed (in the pool, if given) and added to the cache.
+
+    Parameters
+    ----------
+    tasks : list
+        List of (block, sort_order, backend) tuples to compress.
+    pool : multiprocessing.Pool
+        Pool to compress the blocks in, if any. (default: None)
+    cache : BlockCache
+        Cache of compressed blocks, if any. (default: None)
+
+    Returns
+    -------
+    list
+        Compressed blocks, without block size headers, in task order.
+    """
+
+    if cache is not None:
+        results = [cache.get(block, sort_order) for block, sort_order, _ in tasks]
+    else:
+        results = [None] * len(tasks)
+    missing = [i for i, comp in enumerate(results) if comp is None]
+
+    if pool is not None:
+        comp_block_list = pool.starmap(compress_block, [tasks[i] for i in missing])
+    else:
+        comp_block_list = [compress_block(*tasks[i]) for i in missing]
+
+    for i, comp in zip(missing, comp_block_list):
+        results[i] = comp
+        if cache is not None:
+            cache.put(tasks[i][0], tasks[i][1], comp)
+
+    return results
+
+
+def read_blocks(buf, start_block=0, end_block=512, is_subfile=False):
+    """
+    Reads the compressed and decompressed form of each block in a range.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer containing BPE-compressed data.
+    start_block : int
+        First block of the range. (default: 0)
+    end_block : int
+        Block that the range ends on (non-inclusive). (default: 512)
+    is_subfile : bool
+        Flag indicating whether buffer is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+
+    Returns
+    -------
+    list
+        List of (decompressed block, compressed block) tuples. Compressed
+        blocks include the block size header and word-alignment padding.
+    """
+
+    if end_block <= start_block:
+        end_block = 512
+
+    _, block_offsets, end_offset = scan_blocks(buf, end_block, is_subfile)
+    block_offsets = block_offsets[start_block:]
+    block_ends = block_offsets[1:] + [end_offset]
+
+    block_list = []
+    for block_start, block_end in zip(block_offsets, block_ends):
+        comp_block = bytes(buf[block_start:block_end])
+        block_list.append((decode_block(comp_block), comp_block))
+
+    return block_list
+
+
+def reuse_original_blocks(block_list, original_blocks):
+    """
+    Finds blocks that are unchanged from the original compressed file.
+
+    Parameters
+    ----------
+    block_list : list
+        Decompressed blocks from split_blocks().
+    original_blocks : list
+        Blocks of the original compressed file from read_blocks(), if any.
+
+    Returns
+    -------
+    list
+        Original compressed block for each unchanged block, or None for
+        blocks that need to be compressed.
+    """
+
+    if not original_blocks:
+        return [None] * len(block_list)
+
+    return [original_blocks[i][1]
+            if i < len(original_blocks) and original_blocks[i][0] == block else None
+            for i, block in enumerate(block_list)]
+
+
+def compress_blocks(data, meta, sort_orders=None, pool=None, backend='python',
+                    cache=None, original_blocks=None):
+    """
+    BPE compresses decompressed data into a list of compressed blocks.
+
+    Splits data into blocks using the metadata created by decompress(),
+    and compresses each block using its sort order. Anything added to the
+    decompressed data that increases its size should be added to the end
+    of the data, so that the original block sizes can be reused, with new
+    blocks added to the end as needed.
+
+    If the blocks of the original compressed file are given, blocks that
+    are unchanged from the original are copied from it instead of being
+    compressed, so they also keep their original compressed size.
+
+    Parameters
+    ----------
+    data : bytes-like
+        Decompressed data.
+    meta : BlockMeta
+        Metadata created when data was decompressed.
+    sort_orders : int list
+        Sort order to use for each block. Blocks without a sort order are
+        compressed using sort order 0. (default: None)
+    pool : multiprocessing.Pool
+        Pool to compress the blocks in, if any. (default: None)
+    backend : str
+        Backend used to compress each block. See compress_block().
+        (default: 'python')
+    cache : BlockCache
+        Cache of compressed blocks to reuse blocks from, if any.
+        (default: None)
+    original_blocks : list
+        Blocks of the original compressed file from read_blocks(), if any.
+        (default: None)
+
+    Returns
+    -------
+    list
+        Compressed blocks, each preceded by its 4-byte decompressed size.
+    """
+
+    block_list = split_blocks(data, meta)
+    sort_orders = list(sort_orders) if sort_orders is not None else []
+    sort_orders.extend([0] * (len(block_list) - len(sort_orders)))
+
+    result_list = reuse_original_blocks(block_list, original_blocks)
+    changed = [i for i, comp in enumerate(result_list) if comp is None]
+    comp_block_list = _compress_all(
+        [(block_list[i], sort_orders[i], backend) for i in changed], pool, cache)
+    for i, comp in zip(changed, comp_block_list):
+        result_list[i] = b''.join((len(block_list[i]).to_bytes(4, 'little'), comp))
+
+    return result_list
+
+
+def compress_blocks_best(data, meta, sort_orders=None, pool=None,
+                         backend='python', cache=None, original_blocks=None):
+    """
+    BPE compresses decompressed data, searching for the best sort orders.
+
+    Each block without a sort order in sort_orders is compressed using
+    every sort order, and the smallest result is kept (the lowest sort
+    order in case of a tie). Since blocks are compressed independently,
+    this finds the smallest possible compressed size for those blocks,
+    and always chooses the same sort orders for the same data.
+
+    Blocks that are unchanged from the original compressed file are copied
+    from it, as in compress_blocks(). These keep their sort order from
+    sort_orders, or 0 if they have none.
+
+    Parameters
+    ----------
+    data : bytes-like
+        Decompressed data.
+    meta : BlockMeta
+        Metadata created when data was decompressed.
+    sort_orders : int list
+        Sort orders to use for the first blocks, instead of searching.
+        (default: None)
+    pool : multiprocessing.Pool
+        Pool to compress the blocks in, if any. (default: None)
+    backend : str
+        Backend used to compress each block. See compress_block().
+        (default: 'python')
+    cache : BlockCache
+        Cache of compressed blocks to reuse blocks from, if any.
+        (default: None)
+    original_blocks : list
+        Blocks of the original compressed file from read_blocks(), if any.
+        (default: None)
+
+    Returns
+    -------
+    (list, int list)
+        Compressed blocks, each preceded by its 4-byte decompressed size,
+        and the sort order chosen for each block.
+    """
+
+    block_list = split_blocks(data, meta)
+    sort_orders = list(sort_orders[:len(block_list)]) if sort_orders is not None else []
+    result_list = reuse_original_blocks(block_list, original_blocks)
+
+    # Compress every block/sort order combination in a single batch, so
+    # that the pool is kept busy across blocks.
+    candidates = [[s] for s in sort_orders]
+    candidates.extend([list(SORT_ORDERS)] * (len(block_list) - len(sort_orders)))
+    tasks = [(b, s, backend) for b, orders, comp in zip(block_list, candidates, result_list)
+             if comp is None for s in orders]
+    results = iter(_compress_all(tasks, pool, cache))
+
+    chosen_orders = []
+    for i, (b, orders) in enumerate(zip(block_list, candidates)):
+        if result_list[i] is not None:
+            chosen_orders.append(orders[0] if len(orders) == 1 else 0)
+            continue
+        comp, sort_order = min(((next(results), s) for s in orders),
+                               key=lambda x: (len(x[0]), x[1]))
+        result_list[i] = b''.join((len(b).to_bytes(4, 'little'), comp))
+        chosen_orders.append(sort_order)
+
+    return result_list, chosen_orders
+
+
+def compress(data, meta, sort_orders=None, pool=None, backend='python'):
+    """
+    BPE compresses decompressed data.
+
+    See compress_blocks().
+
+    Parameters
+    ----------
+    data : bytes-like
+        Decompressed data.
+    meta : BlockMeta
+        Metadata created when data was decompressed.
+    sort_orders : int list
+        Sort order to use for each block. (default: None)
+    pool : multiprocessing.Pool
+        Pool to compress the blocks in, if any. (default: None)
+    backend : str
+        Backend used to compress each block. (default: 'python')
+
+    Returns
+    -------
+    bytes
+        Compressed blocks, each preceded by its 4-byte decompressed size.
+        Does not include the BPE header or end-of-data marker.
+    """
+
+    return b''.join(compress_blocks(data, meta, sort_orders, pool, backend))
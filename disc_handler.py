@@ -6,16 +6,40 @@ This module contains functions that deal with the disc images for LoD
 are wrappers that integrate Neill Corlett's cdpatch and CUE's psx-mode2
 into the LODModS framework for extracting/inserting game files from/into
 the disc images so that they can be further handled using the functions
-in the game_file_handler module. Additionally, this module provides a
-function to backup/restore backups of game discs and files.
+in the game_file_handler module. Additionally, this module provides
+functions to backup/restore backups of game discs and files, and to
+replace files safely. Game files are extracted natively with the
+disc_image module rather than with cdpatch, and inserted natively in place
+of psx-mode2.
+
+Backups are made as cheaply as the file system allows. Where reflinks are
+supported (e.g. Btrfs and XFS on Linux), a backup is a copy-on-write clone
+that shares its data with the original. Otherwise, if a backup store has
+been set, backups are hard links to deduplicated copies kept in the store
+under the hash of their contents.
 
 Copyright (C) 2019 theflyingzamboni
 """
 # TODO: Get backup working properly for PSXMode and CDPatch
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
+import io
 import os
 import shutil
 import subprocess
 import sys
+import tempfile
+from disc_image import DiscImage, DiscWriter
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows.
+
+COPY_BUFFER_SIZE = 0x100000  # 1 MiB
+FICLONE = 0x40049409  # Linux ioctl to reflink one file to another.
+
+_backup_store = None
 
 
 def _def_path(file_system_object):
@@ -46,7 +70,114 @@ def _def_path(file_system_object):
                             file_system_object)
 
 
-def backup_file(input_file, restore_from_backup=False, hide_print=False):
+def set_backup_store(store_dir):
+    """
+    Sets the directory that backups are deduplicated in.
+
+    Copies in the store that no backup links to any longer are deleted.
+
+    Parameters
+    ----------
+    store_dir : str
+        Backup store directory, or None to not use a backup store.
+    """
+
+    global _backup_store
+    _backup_store = store_dir
+    if store_dir is None or not os.path.isdir(store_dir):
+        return
+
+    for subdir in os.scandir(store_dir):
+        if subdir.is_dir():
+            for entry in os.scandir(subdir.path):
+                try:
+                    if entry.is_file() and entry.stat().st_nlink == 1:
+                        os.remove(entry.path)
+                except OSError:
+                    continue
+
+
+def _clone_file(src_file, dst_file):
+    """
+    Replaces dst_file with a reflink of src_file.
+
+    Parameters
+    ----------
+    src_file : str
+        File to clone.
+    dst_file : str
+        Name of clone.
+
+    Returns
+    -------
+    bool
+        Whether the file system supports reflinks.
+    """
+
+    if fcntl is None:
+        return False
+
+    try:
+        with open_replacement(dst_file) as outf, open(src_file, 'rb') as inf:
+            fcntl.ioctl(outf.fileno(), FICLONE, inf.fileno())
+    except OSError:
+        return False
+
+    shutil.copymode(src_file, dst_file)
+    return True
+
+
+def _copy_file(src_file, dst_file):
+    """
+    Replaces dst_file with a copy of src_file, reflinking it if possible.
+
+    Parameters
+    ----------
+    src_file : str
+        File to copy.
+    dst_file : str
+        Name of copy.
+    """
+
+    if _clone_file(src_file, dst_file):
+        return
+
+    with open_replacement(dst_file) as outf, open(src_file, 'rb') as inf:
+        copy_range(inf, outf, 0, os.fstat(inf.fileno()).st_size)
+    shutil.copymode(src_file, dst_file)
+
+
+def _store_file(input_file):
+    """
+    Adds a file to the backup store, if it is not already stored.
+
+    Parameters
+    ----------
+    input_file : str
+        File to store.
+
+    Returns
+    -------
+    str
+        Name of stored copy of file.
+    """
+
+    sha1 = hashlib.sha1()
+    with open(input_file, 'rb') as inf:
+        for chunk in iter(lambda: inf.read(COPY_BUFFER_SIZE), b''):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+
+    stored_file = os.path.join(_backup_store, digest[:2], digest)
+    if not os.path.exists(stored_file):
+        os.makedirs(os.path.dirname(stored_file), exist_ok=True)
+        _copy_file(input_file, stored_file)
+
+    return stored_file
+
+
+def backup_file(input_file, restore_from_backup=False, hide_print=False,
+                remove_backup=False):
     """
     Creates/restores disc image backup.
 
@@ -56,6 +187,13 @@ def backup_file(input_file, restore_from_backup=False, hide_print=False):
     normally. Backup files should not be deleted, as this could result in
     certain functions creating backups from modded files.
 
+    Backups are reflinks of the file where the file system supports them,
+    or hard links to a copy in the backup store if one is set, and plain
+    copies otherwise. A restored file is always a separate file from its
+    backup, as files are modified in place. Backups and restored files
+    are written to a temp file first, so an interrupted backup never
+    leaves behind a partial .orig file.
+
     Parameters
     ----------
     input_file : str
@@ -65,6 +203,10 @@ def backup_file(input_file, restore_from_backup=False, hide_print=False):
         (default: False)
     hide_print : bool
         Flag determining whether to hide console output. (default: False)
+    remove_backup : bool
+        Flag determining whether to delete the backup once the file has been
+        restored from it. The backup is then simply renamed if it is not
+        linked to the backup store. (default: False)
     """
 
     # DO NOT DELETE .orig file if .bin file has been modified
@@ -74,11 +216,133 @@ def backup_file(input_file, restore_from_backup=False, hide_print=False):
     if not os.path.exists(input_backup):
         if not hide_print:
             print(f'Backing up {input_file}')
-        shutil.copy(input_file, input_backup)
+        if _clone_file(input_file, input_backup):
+            return
+        if _backup_store is not None:
+            stored_file = _store_file(input_file)
+            try:
+                os.link(stored_file, input_backup)
+                return
+            except OSError:
+                pass  # Backup store is on another file system.
+        _copy_file(input_file, input_backup)
     elif restore_from_backup:
         if not hide_print:
             print(f'Restoring {input_file} from backup')
-        shutil.copy(input_backup, input_file)
+        if remove_backup and os.stat(input_backup).st_nlink == 1:
+            os.replace(input_backup, input_file)
+            return
+        _copy_file(input_backup, input_file)
+        if remove_backup:
+            os.remove(input_backup)
+
+
+@contextlib.contextmanager
+def open_replacement(file_name):
+    """
+    Opens a temp file that replaces a file once it is written.
+
+    The temp file is created in the same directory as file_name, and
+    replaces it when the with block finishes without error, so that an
+    interrupted write never leaves a partially written file behind. If an
+    error occurs, the temp file is deleted and file_name is unchanged.
+
+    Parameters
+    ----------
+    file_name : str
+        Name of file to replace.
+
+    Yields
+    ------
+    BufferedWriter
+        Temp file to write the new contents of the file to.
+    """
+
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(file_name), suffix='.temp',
+                                dir=os.path.dirname(os.path.abspath(file_name)))
+    try:
+        with os.fdopen(fd, 'wb') as outf:
+            yield outf
+        if os.path.exists(file_name):
+            shutil.copymode(file_name, temp)
+        os.replace(temp, file_name)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def replace_file(file_name, data):
+    """
+    Replaces the contents of a file in a single step.
+
+    See open_replacement().
+
+    Parameters
+    ----------
+    file_name : str
+        Name of file to replace.
+    data : bytes-like
+        New contents of the file.
+    """
+
+    with open_replacement(file_name) as outf:
+        outf.write(data)
+
+
+def copy_range(src_file, dst_file, offset, count):
+    """
+    Copies part of one file to the current position of another.
+
+    The copy is made by the kernel with os.copy_file_range() where it is
+    supported, falling back to os.sendfile(), so that the data does not
+    pass through Python. Otherwise, the data is copied through a buffer.
+
+    Parameters
+    ----------
+    src_file : BufferedReader
+        File to copy from.
+    dst_file : BufferedWriter
+        File to copy to. Left positioned after the copied data.
+    offset : int
+        Offset of the data in src_file.
+    count : int
+        Number of bytes to copy.
+    """
+
+    dst_file.flush()
+    src_fd = src_file.fileno()
+    dst_fd = dst_file.fileno()
+    dst_offset = dst_file.tell()
+    copied = 0
+
+    try:
+        while copied < count:
+            n = os.copy_file_range(src_fd, dst_fd, count - copied,
+                                   offset + copied, dst_offset + copied)
+            if not n:
+                break
+            copied += n
+    except (AttributeError, OSError):
+        try:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+                if not n:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            buffer = bytearray(min(count - copied, COPY_BUFFER_SIZE))
+            src_file.seek(offset + copied)
+            dst_file.seek(dst_offset + copied)
+            while copied < count:
+                with memoryview(buffer)[:count-copied] as view:
+                    n = src_file.readinto(view)
+                    if not n:
+                        break
+                    dst_file.write(view[:n])
+                copied += n
+
+    dst_file.seek(dst_offset + copied)
 
 
 def cdpatch(disc_dict, mode='-x', called_by_patcher=False):
@@ -86,12 +350,16 @@ def cdpatch(disc_dict, mode='-x', called_by_patcher=False):
     Wrapper function for extracting/inserting game files with cdpatch.exe.
 
     Wraps Neill Corlett's cdpatch utility to integrate it with LODModS.
-    For each disc listed in disc_dict, attempts to use cdpatch to extract
-    or insert flagged game files, depending on how the mode flag is set.
+    For each disc listed in disc_dict, attempts to extract or insert
+    flagged game files, depending on how the mode flag is set.
 
-    Cdpatch is the preferred game file extractor/inserter for XA audio
-    only, as it is required for that. It is unable to handle inserting
-    files of increased size, however.
+    Files are extracted natively with DiscImage, in the same format as
+    cdpatch extracts them (XA audio and video files as 2336-byte sectors),
+    and inserted with cdpatch. Cdpatch writes files over the originals in
+    place, so it is unable to insert files of increased size. It is no
+    longer needed for XA and IKI files, which psxmode() inserts as raw
+    2336-byte sectors, and insert mode is only kept for use with
+    cdpatch.exe.
 
     Parameters
     ----------
@@ -136,17 +404,19 @@ def cdpatch(disc_dict, mode='-x', called_by_patcher=False):
         except KeyError:
             pass  # Skip if 'All Discs' key not present.
 
-    # For each disc in disc_dict, extract/insert all game files in
-    # the file list.
+    if mode == '-x':
+        for disc, disc_val in disc_dict.items():
+            if disc_val[1][1]:
+                _extract_disc_files(disc_val[0], disc_val[1][0], disc_val[1][1],
+                                    called_by_patcher)
+        return
+
+    # For each disc in disc_dict, insert all game files in the file list.
     cdpatch_path = _def_path('cdpatch.exe')  # Get the absolute path of cdpatch
     sub_kwargs = (dict(stdout=subprocess.DEVNULL) if called_by_patcher else {})
     for disc, disc_val in disc_dict.items():
         try:
-            if disc_val[1][1] and mode == '-x':
-                subprocess.run([cdpatch_path, mode, disc_val[0],
-                                '-f', '-o', '-v', '-d', disc_val[1][0],
-                                *disc_val[1][1]], **sub_kwargs)
-            elif disc_val[1][1] and mode == '-i':
+            if disc_val[1][1]:
                 subprocess.run([cdpatch_path, mode, disc_val[0],
                                 '-f', '-v', '-d', disc_val[1][0],
                                 *disc_val[1][1]], **sub_kwargs)
@@ -154,16 +424,56 @@ def cdpatch(disc_dict, mode='-x', called_by_patcher=False):
             print('CDPatch: %s could not be found' % sys.exc_info()[1].filename)
 
 
+def _extract_disc_files(disc_image, output_dir, game_files, hide_print=False):
+    """
+    Extracts game files from a disc image with DiscImage.
+
+    Files are written to the same paths under output_dir as they have on
+    the disc.
+
+    Parameters
+    ----------
+    disc_image : str
+        Name of disc image file.
+    output_dir : str
+        Directory to extract files to.
+    game_files : str list
+        Paths of files on the disc (e.g. 'SECT/DRGN21.BIN').
+    hide_print : bool
+        Hides print statements. (default: False)
+    """
+
+    try:
+        disc = DiscImage(disc_image)
+    except FileNotFoundError:
+        print('CDPatch: %s could not be found' % disc_image)
+        return
+    except ValueError as e:
+        print('CDPatch: %s' % e)
+        return
+
+    with disc:
+        for game_file in game_files:
+            try:
+                disc.extract_file(game_file, os.path.join(output_dir, game_file))
+            except (FileNotFoundError, ValueError) as e:
+                print('CDPatch: %s' % e)
+            else:
+                if not hide_print:
+                    print('CDPatch: Extracted %s' % game_file)
+
+
 def psxmode(disc_dict, backup_discs=False, called_by_patcher=False):
     """
-    Wrapper function for inserting game files with psx-mode2.exe.
+    Inserts game files into disc images with DiscWriter.
 
-    Wraps CUE's psx-mode2 utility to integrate it with LODModS.
-    For each disc listed in disc_dict, attempts to use psx-mode2 to
-    insert flagged game files.
+    Replaces CUE's psx-mode2 utility, which was run once per file. For
+    each disc listed in disc_dict, all flagged game files are inserted in
+    a single pass over the disc image, and the disc images are patched
+    simultaneously in separate processes.
 
-    Psx-mode2 is used in instances where a file needs to be inserted
-    that is larger than the original.
+    Used in instances where a file needs to be inserted that is larger
+    than the original, which is relocated to the end of the image.
 
     Parameters
     ----------
@@ -206,36 +516,81 @@ def psxmode(disc_dict, backup_discs=False, called_by_patcher=False):
     except KeyError:
         pass  # Skip if 'All Discs' key not present.
 
-    # For each disc in disc_dict, insert all game files in the file list.
-    psxmode_path = _def_path('psx-mode2-en.exe')
-    sub_kwargs = (dict(stdout=subprocess.DEVNULL) if called_by_patcher else {})
+    # Gather the files to insert into each disc image, with the path of
+    # each file on the disc. Discs that share an image are patched together.
+    image_files = {}
     for disc, disc_val in disc_dict.items():
-        try:
-            # Does not work as expected
-            """if not os.path.exists('.'.join((disc_val[0], 'orig'))):
-                print('\nPSXMode: Creating %s backup\n' % disc)
-                backup_file(disc_val[0], backup_discs, True)
-            elif backup_discs:
-                print('\nPSXMode: Restoring %s backup\n' % disc)
-                backup_file(disc_val[0], backup_discs, True)"""
-
-            files_to_insert = disc_val[1]
-            for j, file in enumerate(files_to_insert):
-                for path in path_list:
-                    if path in file:
-                        file = file.replace(path, '')
-                        break
+        for file in disc_val[1]:
+            disc_file = file
+            for path in path_list:
+                if path and path in file:
+                    disc_file = file.replace(path, '').lstrip('\\/')
+                    break
+
+            # XA and IKI files are extracted as raw Mode 2 sectors, so are
+            # inserted without regenerating their EDC/ECC data.
+            raw = 'XA' in disc_file.upper() or 'IKI' in disc_file.upper()
+            image_files.setdefault(os.path.abspath(disc_val[0]), []).append(
+                (disc_file, file, raw))
+
+    # The disc images are independent, so are patched simultaneously.
+    jobs = [(image, files, called_by_patcher) for image, files in image_files.items()]
+    if len(jobs) > 1:
+        with ProcessPoolExecutor(len(jobs)) as executor:
+            for messages in executor.map(_patch_disc, jobs):
+                print(messages, end='')
+    elif jobs:
+        print(_patch_disc(jobs[0]), end='')
+
+
+def _patch_disc(job):
+    """
+    Inserts game files into one disc image for psxmode().
 
-                # For XA and IKI files, the -n flag is necessary to skip
-                # adding EDC/ECC data.
-                if 'XA' in file.upper() or 'IKI' in file.upper():
-                    subprocess.run([psxmode_path, disc_val[0], file,
-                                    files_to_insert[j], '-n'],
-                                   **sub_kwargs)
-                else:
-                    subprocess.run([psxmode_path, disc_val[0], file,
-                                    files_to_insert[j]],
-                                   **sub_kwargs)
+    All files are queued on a DiscWriter and written in a single pass.
+    Messages are returned rather than printed, so that the output of
+    simultaneous jobs is not interleaved.
+
+    Parameters
+    ----------
+    job : tuple
+        (disc image, list of (path on disc, file, raw) tuples,
+        called_by_patcher), as for psxmode().
 
+    Returns
+    -------
+    str
+        Messages printed while inserting files.
+    """
+
+    disc_image, files, called_by_patcher = job
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        try:
+            writer = DiscWriter(disc_image)
         except FileNotFoundError:
-            print('PSXMode: %s could not be found' % disc_val)
+            print('PSXMode: %s could not be found' % disc_image)
+            return messages.getvalue()
+        except ValueError as e:
+            print('PSXMode: %s' % e)
+            return messages.getvalue()
+
+        with writer:
+            original_lbas = {}
+            for disc_file, file, raw in files:
+                try:
+                    original_lbas[disc_file] = writer.disc.file_entry(disc_file).lba
+                    writer.add_file(disc_file, file, raw)
+                except (FileNotFoundError, ValueError) as e:
+                    print('PSXMode: %s' % e)
+                    original_lbas.pop(disc_file, None)
+            layout = writer.write()
+
+        if not called_by_patcher:
+            for disc_file, original_lba in original_lbas.items():
+                lba = layout[disc_file]
+                if lba != original_lba:
+                    print('PSXMode: Relocated %s to sector %d' % (disc_file, lba))
+                print('PSXMode: Inserted %s' % disc_file)
+
+    return messages.getvalue()
@@ -0,0 +1,617 @@
+"""
+Provides read access to the files on LoD's disc images.
+
+Disc images are either raw images of 2352-byte sectors (.bin/.img), as
+needed for the CD-ROM XA files on the discs, or images of the 2048 bytes
+of user data of each sector (.iso). The ISO9660 file system is read from
+the Primary Volume Descriptor and directory records once, into an index of
+the location, size and sector form of every file, and files are then
+copied straight out of a memory map of the image.
+
+DiscWriter replaces files on a disc image natively, in place of psx-mode2.
+All of the files for an image are planned and written together in one
+pass. Files that have grown past the sectors of the original are relocated
+to the end of the image, and their directory records updated. In raw
+images, the EDC and ECC of every sector written are regenerated with the
+edc_ecc module.
+
+In raw images, Mode 2 Form 1 sectors hold 2048 bytes of user data after an
+8-byte subheader. Mode 2 Form 2 sectors, used by XA audio and video (e.g.
+the XA and IKI files), hold 2324 bytes. Files flagged as Form 2 or
+interleaved in their XA directory record are extracted as whole 2336-byte
+sectors (subheader, data and EDC), so that they keep the subheaders
+needed to play or reinsert them.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+from collections import namedtuple
+import mmap
+import os
+import edc_ecc
+from edc_ecc import RAW_SECTOR_SIZE, SYNC_PATTERN
+
+SECTOR_SIZE = 0x800
+XA_SECTOR_SIZE = 0x920  # Mode 2 sector without sync pattern and header
+PVD_SECTOR = 16
+WRITE_BATCH_SECTORS = 0x1000
+SUBMODE_DATA = 0x08
+SUBMODE_END = 0x81  # End of file and end of record flags
+XA_FORM2 = 0x1000
+XA_INTERLEAVED = 0x2000
+DIRECTORY_FLAG = 0x02
+
+DiscFile = namedtuple('DiscFile', ('lba', 'size', 'form'))
+
+
+class DiscImage:
+    """
+    A class for reading files from a disc image.
+
+    Functions
+    ---------
+    normalize_path()
+        Returns a path in the form used as a key of files.
+    file_entry()
+        Returns the location, size and form of a file.
+    record_location()
+        Returns the location of a file's directory record.
+    read_file()
+        Returns the contents of a file.
+    view_file()
+        Returns the contents of a file as a memoryview.
+    extract_file()
+        Copies a file to a new file.
+    close()
+        Releases the image's memory map.
+
+    Attributes
+    ----------
+    name : str
+        Name of the disc image file.
+    raw : bool
+        Whether the image is made up of raw 2352-byte sectors.
+    sector_size : int
+        Size of each sector in the image.
+    num_sectors : int
+        Number of sectors in the image.
+    volume_id : str
+        Volume identifier from the Primary Volume Descriptor.
+    files : dict
+        DiscFile (LBA, size and form (1 or 2)) of each file, by path
+        (e.g. 'SECT/DRGN21.BIN'). Paths are upper case and exclude the
+        ';1' version number.
+    """
+
+    def __init__(self, image_file):
+        """
+        Parameters
+        ----------
+        image_file : str
+            Name of disc image file.
+
+        Raises
+        ------
+        ValueError
+            If the file is not an ISO9660 disc image.
+        """
+
+        self.name = image_file
+        self._file = open(image_file, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError('%s is empty' % image_file)
+        self._view = memoryview(self._mmap)
+
+        try:
+            raw_pvd = PVD_SECTOR * RAW_SECTOR_SIZE
+            if self._view[raw_pvd:raw_pvd+12] == SYNC_PATTERN:
+                self.raw = True
+                self.sector_size = RAW_SECTOR_SIZE
+            elif self._view[PVD_SECTOR*SECTOR_SIZE+1:PVD_SECTOR*SECTOR_SIZE+6] == b'CD001':
+                self.raw = False
+                self.sector_size = SECTOR_SIZE
+            else:
+                raise ValueError('%s is not an ISO9660 disc image' % image_file)
+            self.num_sectors = len(self._view) // self.sector_size
+
+            pvd = self._sector_data(PVD_SECTOR)
+            if pvd[0] != 1 or pvd[1:6] != b'CD001':
+                raise ValueError('%s has no Primary Volume Descriptor' % image_file)
+            self.volume_id = bytes(pvd[40:72]).decode('ascii', 'replace').strip()
+
+            self.files = {}
+            self._records = {}
+            root = pvd[156:190]
+            self._read_directory(int.from_bytes(root[2:6], 'little'),
+                                 int.from_bytes(root[10:14], 'little'), '')
+        except (ValueError, IndexError):
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, path):
+        return self.normalize_path(path) in self.files
+
+    @staticmethod
+    def normalize_path(path):
+        """
+        Returns a path in the form used as a key of files.
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc, with '/' or '\\' separators and an
+            optional ';1' version number. Not case sensitive.
+
+        Returns
+        -------
+        str
+            Upper case path with '/' separators and no version number.
+        """
+
+        return path.replace('\\', '/').strip('/').upper().split(';')[0]
+
+    def _sector_data(self, lba):
+        """
+        Returns the 2048 bytes of user data of a Mode 1 or Mode 2 Form 1
+        sector.
+        """
+
+        if not 0 <= lba < self.num_sectors:
+            raise ValueError('Sector %d is outside of %s' % (lba, self.name))
+        if not self.raw:
+            return self._view[lba*SECTOR_SIZE:(lba+1)*SECTOR_SIZE]
+
+        start = lba * RAW_SECTOR_SIZE
+        start += 16 if self._view[start+15] == 1 else 24
+        return self._view[start:start+SECTOR_SIZE]
+
+    def _read_directory(self, lba, size, parent):
+        """
+        Adds the files in a directory, and its subdirectories, to files.
+        """
+
+        for sector in range(lba, lba + -(-size // SECTOR_SIZE)):
+            data = self._sector_data(sector)
+            offset = 0
+
+            # Records never cross sector boundaries, and the rest of a
+            # sector after the last record is zeroed.
+            while offset < SECTOR_SIZE and data[offset]:
+                record = data[offset:offset+data[offset]]
+                offset += record[0]
+
+                name_len = record[32]
+                name = bytes(record[33:33+name_len])
+                if name in (b'\x00', b'\x01'):
+                    continue  # '.' and '..' entries
+                name = name.decode('ascii', 'replace').split(';')[0]
+                path = '/'.join(filter(None, (parent, name))).upper()
+                extent = int.from_bytes(record[2:6], 'little')
+                data_len = int.from_bytes(record[10:14], 'little')
+
+                if record[25] & DIRECTORY_FLAG:
+                    if extent != lba:
+                        self._read_directory(extent, data_len, path)
+                    continue
+
+                # The XA system use field follows the name (padded to an
+                # even length) and contains the file attributes.
+                form = 1
+                system_use = record[33+name_len+(1 - name_len % 2):]
+                if len(system_use) >= 8 and system_use[6:8] == b'XA':
+                    attributes = int.from_bytes(system_use[4:6], 'big')
+                    if attributes & (XA_FORM2 | XA_INTERLEAVED):
+                        form = 2
+                self.files[path] = DiscFile(extent, data_len, form)
+                self._records[path] = (sector, offset - record[0])
+
+    def file_entry(self, path):
+        """
+        Returns the location, size and form of a file.
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc (e.g. 'SECT/DRGN21.BIN'). Not case
+            sensitive.
+
+        Returns
+        -------
+        DiscFile
+            LBA, size and form of file.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the disc does not contain the file.
+        """
+
+        try:
+            return self.files[self.normalize_path(path)]
+        except KeyError:
+            raise FileNotFoundError('%s not found on %s' % (path, self.name)) from None
+
+    def record_location(self, path):
+        """
+        Returns the location of a file's directory record.
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc. Not case sensitive.
+
+        Returns
+        -------
+        (int, int)
+            LBA of the directory sector containing the record, and offset
+            of the record within the sector's user data.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the disc does not contain the file.
+        """
+
+        try:
+            return self._records[self.normalize_path(path)]
+        except KeyError:
+            raise FileNotFoundError('%s not found on %s' % (path, self.name)) from None
+
+    def _chunks(self, path):
+        """
+        Yields the contents of a file in chunks, as memoryviews of the image.
+        """
+
+        entry = self.file_entry(path)
+        num_sectors = -(-entry.size // SECTOR_SIZE)
+        if entry.lba + num_sectors > self.num_sectors:
+            raise ValueError('%s extends past the end of %s' % (path, self.name))
+
+        if not self.raw:
+            start = entry.lba * SECTOR_SIZE
+            yield self._view[start:start+entry.size]
+        elif entry.form == 2:
+            for lba in range(entry.lba, entry.lba + num_sectors):
+                start = lba * RAW_SECTOR_SIZE + 16
+                yield self._view[start:start+XA_SECTOR_SIZE]
+        else:
+            remaining = entry.size
+            for lba in range(entry.lba, entry.lba + num_sectors):
+                data = self._sector_data(lba)
+                yield data[:remaining]
+                remaining -= SECTOR_SIZE
+
+    def read_file(self, path):
+        """
+        Returns the contents of a file.
+
+        Form 2 files in raw images are read as whole 2336-byte sectors.
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc. Not case sensitive.
+
+        Returns
+        -------
+        bytes
+            Contents of file.
+        """
+
+        return b''.join(self._chunks(path))
+
+    def view_file(self, path):
+        """
+        Returns the contents of a file as a memoryview.
+
+        In 2048-byte images, the contents are not copied, and the memoryview
+        must be released before the image is closed. In raw images, the
+        user data of the file's sectors is copied into memory. Form 2 files
+        in raw images are read as whole 2336-byte sectors.
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc. Not case sensitive.
+
+        Returns
+        -------
+        memoryview
+            Contents of file.
+        """
+
+        chunks = list(self._chunks(path))
+        if len(chunks) == 1:
+            return chunks[0]
+        return memoryview(b''.join(chunks))
+
+    def extract_file(self, path, output_file):
+        """
+        Copies a file to a new file.
+
+        The file is written straight from the image's memory map. Form 2
+        files in raw images are copied as whole 2336-byte sectors.
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc. Not case sensitive.
+        output_file : str
+            Name of file to write. Its directory is created if necessary.
+        """
+
+        if os.path.dirname(output_file):
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with open(output_file, 'wb') as outf:
+            for chunk in self._chunks(path):
+                outf.write(chunk)
+
+    def close(self):
+        """
+        Releases the image's memory map.
+        """
+
+        if getattr(self, '_view', None) is not None:
+            self._view.release()
+            self._mmap.close()
+            self._view = None
+        self._file.close()
+
+
+class DiscWriter:
+    """
+    A class for replacing files on a disc image.
+
+    Files to replace are queued with add_file(), and written together by
+    write(). The new layout of the image is planned once: files are
+    written over the originals if they fit in their sectors, and otherwise
+    relocated to the end of the image. All changed sectors, including the
+    directory records of the files and the volume size, are then written
+    in a single pass in LBA order, with each directory sector regenerated
+    only once. In raw images, files are written as Mode 2 Form 1 sectors
+    with regenerated EDCs and ECC, except for files of raw 2336-byte Mode 2
+    sectors (XA and IKI files, as extracted by DiscImage), which are
+    written as they are.
+
+    Functions
+    ---------
+    add_file()
+        Queues a file to write over a file on the disc.
+    write()
+        Writes all queued files to the image.
+    replace_file()
+        Writes a file over a file on the disc.
+    close()
+        Writes any queued files and closes the image.
+
+    Attributes
+    ----------
+    disc : DiscImage
+        Disc image being written to.
+    backend : str
+        Backend used to regenerate EDCs and ECC ('python' or 'numpy').
+    end_lba : int
+        LBA of the sector after the end of the image.
+    """
+
+    def __init__(self, image_file, backend=None):
+        """
+        Parameters
+        ----------
+        image_file : str
+            Name of disc image file.
+        backend : str
+            Backend used to regenerate EDCs and ECC. If None, uses 'numpy'
+            if NumPy is installed, and 'python' otherwise. (default: None)
+
+        Raises
+        ------
+        ValueError
+            If the file is not an ISO9660 disc image.
+        """
+
+        self.disc = DiscImage(image_file)
+        self.backend = backend or ('python' if edc_ecc.np is None else 'numpy')
+        self.end_lba = self.disc.num_sectors
+        self._file = open(image_file, 'r+b')
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_file(self, path, source, raw=False):
+        """
+        Queues a file to write over a file on the disc.
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc. Not case sensitive.
+        source : str or bytes-like
+            Name of file, or data, to write. Files are not read until
+            written.
+        raw : bool
+            Whether source is made up of raw 2336-byte Mode 2 sectors,
+            which are written without regenerating their EDCs or ECC.
+            Files flagged as Form 2 on the disc are always written raw.
+            (default: False)
+
+        Raises
+        ------
+        FileNotFoundError
+            If the disc does not contain the file, or source does not
+            exist.
+        ValueError
+            If a raw file is not made up of whole sectors, or the image is
+            not a raw image.
+        """
+
+        entry = self.disc.file_entry(path)
+        length = os.path.getsize(source) if isinstance(source, str) else len(source)
+
+        raw = raw or entry.form == 2
+        if raw:
+            if not self.disc.raw:
+                raise ValueError('%s must be written to a raw disc image' % path)
+            if length % XA_SECTOR_SIZE:
+                raise ValueError('%s is not made up of whole %d-byte sectors'
+                                 % (path, XA_SECTOR_SIZE))
+            num_sectors = length // XA_SECTOR_SIZE
+            size = num_sectors * SECTOR_SIZE
+        else:
+            num_sectors = -(-length // SECTOR_SIZE)
+            size = length
+
+        # Files are queued by normalized path, so that a file queued twice
+        # is only written once, and reported under the last path given.
+        self._pending[self.disc.normalize_path(path)] = \
+            (path, entry, source, raw, num_sectors, size)
+
+    def write(self):
+        """
+        Writes all queued files to the image.
+
+        Returns
+        -------
+        dict
+            LBA of each file written, keyed by the path it was queued with.
+            Differs from the original LBA of a file if it was relocated.
+        """
+
+        # Plan the layout. Relocated files keep their order on the disc.
+        layout = {}
+        for path, (_, entry, _, _, num_sectors, _) in sorted(self._pending.items(),
+                                                              key=lambda x: x[1][1].lba):
+            if num_sectors <= -(-entry.size // SECTOR_SIZE):
+                layout[path] = entry.lba
+            else:
+                layout[path] = self.end_lba
+                self.end_lba += num_sectors
+
+        # Group the directory record updates by sector.
+        sector_updates = {}
+        for path, lba in layout.items():
+            record_lba, offset = self.disc.record_location(path)
+            size = self._pending[path][5]
+            sector_updates.setdefault(record_lba, []).extend(
+                ((offset + 2, lba), (offset + 10, size)))
+        if self.end_lba > self.disc.num_sectors:
+            sector_updates.setdefault(PVD_SECTOR, []).append((80, self.end_lba))
+
+        operations = sorted([(lba, 0, path) for path, lba in layout.items()]
+                            + [(lba, 1, None) for lba in sector_updates])
+        for lba, _, path in operations:
+            if path is None:
+                self._update_sector(lba, sector_updates[lba])
+                continue
+
+            _, entry, source, raw, num_sectors, size = self._pending[path]
+            if isinstance(source, str):
+                with open(source, 'rb') as f:
+                    data = f.read()
+            else:
+                data = bytes(source)
+            for start in range(0, num_sectors, WRITE_BATCH_SECTORS):
+                end = min(start + WRITE_BATCH_SECTORS, num_sectors)
+                self._write_sectors(lba, data, start, end, num_sectors, raw)
+            self.disc.files[path] = DiscFile(lba, size, entry.form)
+
+        layout = {self._pending[path][0]: lba for path, lba in layout.items()}
+        self._pending = {}
+        return layout
+
+    def replace_file(self, path, source, raw=False):
+        """
+        Writes a file over a file on the disc.
+
+        Any other queued files are written as well. See add_file().
+
+        Parameters
+        ----------
+        path : str
+            Path of file on the disc. Not case sensitive.
+        source : str or bytes-like
+            Name of file, or data, to write.
+        raw : bool
+            Whether source is made up of raw 2336-byte Mode 2 sectors.
+            (default: False)
+
+        Returns
+        -------
+        int
+            LBA of the file, which differs from the original if the file
+            was relocated.
+        """
+
+        self.add_file(path, source, raw)
+        return self.write()[path]
+
+    def _write_sectors(self, lba, data, start, end, num_sectors, raw):
+        """
+        Writes sectors start to end of a file that starts at lba.
+        """
+
+        if not self.disc.raw:
+            self._file.seek((lba + start) * SECTOR_SIZE)
+            chunk = data[start*SECTOR_SIZE:end*SECTOR_SIZE]
+            self._file.write(chunk.ljust((end - start) * SECTOR_SIZE, b'\x00'))
+            return
+
+        sectors = bytearray()
+        for i in range(start, end):
+            sectors += edc_ecc.sector_header(lba + i)
+            if raw:
+                sectors += data[i*XA_SECTOR_SIZE:(i+1)*XA_SECTOR_SIZE]
+                continue
+
+            submode = SUBMODE_DATA | (SUBMODE_END if i == num_sectors - 1 else 0)
+            sectors += bytes((0, 0, submode, 0)) * 2
+            sectors += data[i*SECTOR_SIZE:(i+1)*SECTOR_SIZE].ljust(SECTOR_SIZE, b'\x00')
+            sectors += bytes(RAW_SECTOR_SIZE - 24 - SECTOR_SIZE)
+
+        if not raw:
+            edc_ecc.encode_sectors(sectors, self.backend)
+        self._file.seek((lba + start) * RAW_SECTOR_SIZE)
+        self._file.write(sectors)
+
+    def _update_sector(self, lba, values):
+        """
+        Writes both-endian 32-bit values to the user data of a Form 1
+        sector, and regenerates its EDC and ECC.
+        """
+
+        data_start = 24 if self.disc.raw else 0
+        self._file.seek(lba * self.disc.sector_size)
+        sector = bytearray(self._file.read(self.disc.sector_size))
+        for offset, value in values:
+            start = data_start + offset
+            sector[start:start+8] = value.to_bytes(4, 'little') + value.to_bytes(4, 'big')
+
+        if self.disc.raw:
+            edc_ecc.encode_sectors(sector, 'python')
+        self._file.seek(lba * self.disc.sector_size)
+        self._file.write(sector)
+
+    def close(self):
+        """
+        Writes any queued files and closes the image.
+        """
+
+        try:
+            if self._pending:
+                self.write()
+        finally:
+            self._file.close()
+            self.disc.close()
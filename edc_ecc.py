@@ -0,0 +1,290 @@
+"""
+Provides EDC and ECC generation for CD-ROM XA Mode 2 sectors.
+
+Raw Mode 2 sectors are 2352 bytes: a 12-byte sync pattern, a 4-byte header
+(the address of the sector as BCD minutes, seconds and frames, and the
+mode byte), and an 8-byte subheader (file number, channel, submode and
+coding info, stored twice). Form 1 sectors follow this with 2048 bytes of
+user data, a 4-byte EDC (a CRC32 variant of the subheader and data), and
+276 bytes of Reed-Solomon P and Q parity (ECC) computed with the header
+zeroed. Form 2 sectors, flagged in the submode byte, hold 2324 bytes of
+user data and an EDC, and no ECC.
+
+Two backends are provided, which produce identical output. The python
+backend is table driven and encodes one sector at a time. The numpy backend
+runs the same table lookups for a byte position of every sector at once,
+so its speed scales with the number of sectors encoded together.
+
+Run this module to benchmark ECC regeneration with each backend.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+import sys
+import time
+from operator import itemgetter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RAW_SECTOR_SIZE = 0x930
+SYNC_PATTERN = b'\x00' + b'\xff' * 10 + b'\x00'
+SUBMODE_FORM2 = 0x20
+EDC_START = 0x10  # EDCs cover the subheader and user data.
+FORM1_EDC_OFFSET = 0x818
+FORM2_EDC_OFFSET = 0x92c
+ECC_START = 0xc  # ECC covers the header, subheader, data and EDC.
+ECC_P_OFFSET = 0x81c
+ECC_Q_OFFSET = 0x8c8
+BACKENDS = ('python', 'numpy')
+BENCHMARK_SECTORS = 0x1000
+
+
+def _build_edc_table():
+    table = []
+    for i in range(0x100):
+        edc = i
+        for _ in range(8):
+            edc = (edc >> 1) ^ (0xd8018001 if edc & 1 else 0)
+        table.append(edc)
+    return table
+
+
+def _build_ecc_tables():
+    # ECC_F_TABLE multiplies by 2 in GF(2^8), and ECC_B_TABLE divides by 3.
+    f_table = bytearray(0x100)
+    b_table = bytearray(0x100)
+    for i in range(0x100):
+        j = ((i << 1) ^ (0x11d if i & 0x80 else 0)) & 0xff
+        f_table[i] = j
+        b_table[i ^ j] = i
+    return bytes(f_table), bytes(b_table)
+
+
+def _ecc_order(major_count, minor_count, major_mult, minor_inc):
+    """
+    Returns the offsets of the bytes of each row of a parity computation,
+    from the start of the ECC area. Each row holds one byte for each of the
+    major_count parity bytes.
+    """
+
+    size = major_count * minor_count
+    return [((major >> 1) * major_mult + (major & 1) + minor * minor_inc) % size
+            for minor in range(minor_count) for major in range(major_count)]
+
+
+EDC_TABLE = _build_edc_table()
+ECC_F_TABLE, ECC_B_TABLE = _build_ecc_tables()
+# P parity covers 86 columns of 24 bytes, and Q parity covers 52 diagonals
+# of 43 bytes (including the P parity).
+ECC_P = (86, 24, _ecc_order(86, 24, 2, 86))
+ECC_Q = (52, 43, _ecc_order(52, 43, 86, 88))
+
+
+def sector_header(lba, mode=2):
+    """
+    Returns the sync pattern and header of a sector.
+
+    Parameters
+    ----------
+    lba : int
+        Logical block address of sector.
+    mode : int
+        Mode of sector. (default: 2)
+
+    Returns
+    -------
+    bytes
+        16-byte sync pattern and header.
+    """
+
+    minutes, frames = divmod(lba + 150, 75 * 60)  # Addresses start at 2 seconds.
+    seconds, frames = divmod(frames, 75)
+    return SYNC_PATTERN + bytes(((x // 10) << 4 | x % 10) for x in (minutes, seconds, frames)) \
+        + bytes((mode,))
+
+
+def compute_edc(data, edc=0):
+    """
+    Returns the EDC of data.
+
+    Parameters
+    ----------
+    data : bytes-like
+        Data to compute EDC of.
+    edc : int
+        EDC of any preceding data. (default: 0)
+
+    Returns
+    -------
+    int
+        EDC of data.
+    """
+
+    table = EDC_TABLE
+    for byte in bytes(data):
+        edc = (edc >> 8) ^ table[(edc ^ byte) & 0xff]
+    return edc
+
+
+def _ecc_block_python(data, major_count, minor_count, order):
+    """
+    Returns the parity bytes of an ECC area, for one of ECC_P or ECC_Q.
+    """
+
+    rows = bytes(itemgetter(*order)(data))
+    a = b = 0
+    for start in range(0, len(rows), major_count):
+        row = int.from_bytes(rows[start:start+major_count], 'big')
+        a = int.from_bytes((a ^ row).to_bytes(major_count, 'big').translate(ECC_F_TABLE),
+                           'big')
+        b ^= row
+    a = int.from_bytes(a.to_bytes(major_count, 'big').translate(ECC_F_TABLE), 'big') ^ b
+    a = a.to_bytes(major_count, 'big').translate(ECC_B_TABLE)
+    return a + (int.from_bytes(a, 'big') ^ b).to_bytes(major_count, 'big')
+
+
+def _encode_sector_python(sector):
+    if sector[0x12] & SUBMODE_FORM2:
+        sector[FORM2_EDC_OFFSET:FORM2_EDC_OFFSET+4] = compute_edc(
+            sector[EDC_START:FORM2_EDC_OFFSET]).to_bytes(4, 'little')
+        return
+
+    sector[FORM1_EDC_OFFSET:FORM1_EDC_OFFSET+4] = compute_edc(
+        sector[EDC_START:FORM1_EDC_OFFSET]).to_bytes(4, 'little')
+
+    # The header is zeroed for Mode 2 ECC, so that sectors can be moved.
+    ecc_data = bytes(4) + bytes(sector[ECC_START+4:ECC_P_OFFSET])
+    p_parity = _ecc_block_python(ecc_data, *ECC_P)
+    q_parity = _ecc_block_python(ecc_data + p_parity, *ECC_Q)
+    sector[ECC_P_OFFSET:ECC_Q_OFFSET] = p_parity
+    sector[ECC_Q_OFFSET:RAW_SECTOR_SIZE] = q_parity
+
+
+def _compute_edc_numpy(data):
+    """
+    Returns the EDC of each column of a 2D uint8 array.
+    """
+
+    edc_table = np.array(EDC_TABLE, dtype=np.uint32)
+    edc = np.zeros(data.shape[1], dtype=np.uint32)
+    for row in data:
+        edc = (edc >> 8) ^ np.take(edc_table, (edc ^ row) & 0xff)
+    return edc
+
+
+def _ecc_block_numpy(data, major_count, minor_count, order):
+    """
+    Returns the parity bytes of the ECC area in each column of a 2D uint8
+    array, for one of ECC_P or ECC_Q.
+    """
+
+    f_table = np.frombuffer(ECC_F_TABLE, dtype=np.uint8)
+    b_table = np.frombuffer(ECC_B_TABLE, dtype=np.uint8)
+    rows = data[order].reshape(minor_count, major_count, data.shape[1])
+    a = np.zeros((major_count, data.shape[1]), dtype=np.uint8)
+    for row in rows:
+        a = np.take(f_table, a ^ row)
+    b = np.bitwise_xor.reduce(rows, axis=0)
+    a = np.take(b_table, np.take(f_table, a) ^ b)
+    return np.concatenate((a, a ^ b))
+
+
+def _encode_sectors_numpy(sectors):
+    # Sectors are transposed so that each byte position of every sector
+    # is contiguous, and is processed in one operation.
+    view = np.frombuffer(sectors, dtype=np.uint8).reshape(-1, RAW_SECTOR_SIZE)
+    form2 = (view[:, 0x12] & SUBMODE_FORM2).astype(bool)
+
+    if form2.any():
+        columns = np.ascontiguousarray(view[form2].T)
+        edc = _compute_edc_numpy(columns[EDC_START:FORM2_EDC_OFFSET])
+        columns[FORM2_EDC_OFFSET:] = edc.astype('<u4').view(np.uint8).reshape(-1, 4).T
+        view[form2] = columns.T
+
+    if not form2.all():
+        columns = np.ascontiguousarray(view[~form2].T)
+        edc = _compute_edc_numpy(columns[EDC_START:FORM1_EDC_OFFSET])
+        columns[FORM1_EDC_OFFSET:FORM1_EDC_OFFSET+4] = \
+            edc.astype('<u4').view(np.uint8).reshape(-1, 4).T
+
+        ecc_data = columns[ECC_START:ECC_P_OFFSET].copy()
+        ecc_data[:4] = 0
+        p_parity = _ecc_block_numpy(ecc_data, *ECC_P)
+        columns[ECC_P_OFFSET:ECC_Q_OFFSET] = p_parity
+        columns[ECC_Q_OFFSET:] = _ecc_block_numpy(np.concatenate((ecc_data, p_parity)), *ECC_Q)
+        view[~form2] = columns.T
+
+
+def encode_sectors(sectors, backend='python'):
+    """
+    Regenerates the EDC and ECC of raw Mode 2 sectors in place.
+
+    Form 1 sectors get an EDC and ECC, and Form 2 sectors an EDC, as set by
+    the submode byte of each sector's subheader.
+
+    Parameters
+    ----------
+    sectors : bytearray
+        Raw 2352-byte sectors, with their sync patterns, headers,
+        subheaders and user data already set.
+    backend : str
+        'python', or 'numpy' to encode all sectors at once. Both produce
+        identical output. (default: 'python')
+
+    Raises
+    ------
+    ValueError
+        If sectors is not made up of whole sectors.
+    """
+
+    if len(sectors) % RAW_SECTOR_SIZE:
+        raise ValueError('Data is not made up of whole %d-byte sectors' % RAW_SECTOR_SIZE)
+
+    if backend == 'numpy':
+        if sectors:
+            _encode_sectors_numpy(sectors)
+        return
+
+    with memoryview(sectors) as view:
+        for start in range(0, len(sectors), RAW_SECTOR_SIZE):
+            _encode_sector_python(view[start:start+RAW_SECTOR_SIZE])
+
+
+def benchmark(num_sectors=BENCHMARK_SECTORS, backend='python'):
+    """
+    Returns the number of Form 1 sectors per second that a backend
+    regenerates the EDC and ECC of.
+
+    Parameters
+    ----------
+    num_sectors : int
+        Number of sectors to encode. (default: BENCHMARK_SECTORS)
+    backend : str
+        Backend to benchmark ('python' or 'numpy'). (default: 'python')
+
+    Returns
+    -------
+    float
+        Sectors encoded per second.
+    """
+
+    sector = bytearray(sector_header(0) + bytes((0, 0, 8, 0)) * 2 + bytes(range(0x100)) * 8
+                       + bytes(RAW_SECTOR_SIZE - 0x818))
+    sectors = sector * num_sectors
+
+    start = time.perf_counter()
+    encode_sectors(sectors, backend)
+    return num_sectors / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    num_sectors = int(sys.argv[1]) if len(sys.argv) > 1 else BENCHMARK_SECTORS
+    for backend in BACKENDS:
+        if backend == 'numpy' and np is None:
+            print('EDC/ECC: NumPy is not installed. Skipping numpy backend.')
+            continue
+        print('EDC/ECC: %s backend: %.0f sectors/second'
+              % (backend, benchmark(num_sectors, backend)))
@@ -9,7 +9,9 @@ BPE handling
 ------------
 This set of functions deals with decompressing and compressing LoD's Byte-Pair
 Encoded (BPE) files. This applies to all of the OV_ files, as well as a subsegment
-of SCUS/SCES/SCPS and a number of subfiles in DRGN0.BIN.
+of SCUS/SCES/SCPS and a number of subfiles in DRGN0.BIN. The codec itself lives
+in the bpe module; these functions handle the compressed, decompressed, and
+metadata files.
 
 MRG handling
 ------------
@@ -30,18 +32,28 @@ using a file list text file.
 Copyright (C) 2019 theflyingzamboni
 """
 
+import atexit
 import colorama
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+    ThreadPoolExecutor, wait
+import contextlib
+from functools import partial
 import glob
-from math import ceil
-from more_itertools import sort_together
+import io
+import mmap
 import multiprocessing
 import os
-import random
 import re
 import shutil
 import sys
+import bpe
+from block_cache import BlockCache
 from config_handler import read_file_list, numerical_sort
-from disc_handler import backup_file
+from disc_handler import backup_file, copy_range, open_replacement, replace_file
+import mrg
+from structure_index import get_default_index
+from virtual_files import disc_file_system
 
 MAIN_FILE = re.compile(r'(DRGN0\.bin)|(DRGN1\.bin)(DRGN2[1-4]\.bin)', re.I)
 BPE_FLAG = re.compile(b'^[\x00-\xff]{4}BPE\x1a')
@@ -56,98 +68,47 @@ colorama.init()
 MOVE_CURSOR = '\x1b[1A'
 ERASE = '\x1b[2K'
 
+_compression_pool = None  # Started by get_compression_pool()
+
 
 # BPE handling
 
-def _choose_sort(attempt_num):
+def get_compression_pool():
     """
-    Choose the sort order for count_dict entries when creating
-    a BPE compression dictionary. Introduces some variability into
-    compressed block sizes helpful for getting compressed subfiles
-    to equal their original compressed sizes.
+    Returns the process-wide pool used to compress BPE blocks.
 
-    Parameters
-    ----------
-    attempt_num : int
-        Number of times to attempt comressing a file
+    The pool is started the first time it is needed and then kept running,
+    so that compressing many files (e.g. with insert_all_from_list()) does
+    not start a new pool for every file. It is shut down when the program
+    exits, or by calling shutdown_compression_pool().
 
     Returns
     -------
-    int
-        Int that determines which sort order to use
-    """
-
-    x = 0
-    if attempt_num <= 1:
-        y = 0
-    elif attempt_num == 2:
-        x = y = 1
-    elif attempt_num == 3:
-        x = y = 2
-    elif attempt_num == 4:
-        x = y = 3
-    elif attempt_num == 5:
-        x = y = 4
-    elif 5 < attempt_num <= 30:
-        y = 1
-    elif 30 < attempt_num <= 50:
-        y = 2
-    elif 50 < attempt_num <= 70:
-        y = 3
-    else:
-        y = 4
+    multiprocessing.Pool
+        Compression pool.
+    """
 
-    return random.randint(x, y)
+    global _compression_pool
 
+    if _compression_pool is None:
+        _compression_pool = multiprocessing.Pool(multiprocessing.cpu_count() - 1 or 1)
+        atexit.register(shutdown_compression_pool)
 
-def _sort_keys(count_dict, sort_order):
-    """
-    Sorts byte-pair dict keys according to sort_order int.
+    return _compression_pool
 
-    Sorts byte-pair dictionary keys into a list, using sort_order to determine
-    how they are sorted. Byte pairs are always sorted primarily by count;
-    however, the game does not seem to have a consistent order for subsorting
-    byte pairs with the same count. Depending on how byte pairs are subsorted
-    according to each byte's value (e.g. 1st byte ascending, 2nd byte
-    descending), the block may compress to a different size. Since it is
-    necessary for modding to compress a file to <= its original size, varying
-    sort order can help achieve smaller compressed size.
 
-    Parameters
-    ----------
-    count_dict : dict
-        Dict containing byte-pairs and the number of times they occur.
-    sort_order : int
-        Int indicating how byte pairs should be sorted.
+def shutdown_compression_pool():
+    """
+    Shuts down the process-wide compression pool if it is running.
+    """
 
-    Returns
-    -------
-    list
-        Sorted list of tuples containing the byte-pair and its count.
-    """
-
-    if sort_order == 0:
-        bp_count_list = sorted(
-            [(key, count_dict[key]) for key in count_dict.keys()],
-            key=lambda tup: -tup[1])
-    elif sort_order == 1:
-        bp_count_list = sorted(
-            [(key, count_dict[key]) for key in count_dict.keys()],
-            key=lambda tup: (-tup[1], tup[0][0], tup[0][1]))
-    elif sort_order == 2:
-        bp_count_list = sorted(
-            [(key, count_dict[key]) for key in count_dict.keys()],
-            key=lambda tup: (-tup[1], -tup[0][0], tup[0][1]))
-    elif sort_order == 3:
-        bp_count_list = sorted(
-            [(key, count_dict[key]) for key in count_dict.keys()],
-            key=lambda tup: (-tup[1], tup[0][0], -tup[0][1]))
-    else:
-        bp_count_list = sorted(
-            [(key, count_dict[key]) for key in count_dict.keys()],
-            key=lambda tup: (-tup[1], -tup[0][0], -tup[0][1]))
+    global _compression_pool
 
-    return bp_count_list
+    if _compression_pool is not None:
+        _compression_pool.close()
+        _compression_pool.join()
+        _compression_pool = None
+        atexit.unregister(shutdown_compression_pool)
 
 
 def process_block_range(range_entry, base_name):
@@ -192,27 +153,19 @@ def process_block_range(range_entry, base_name):
     return block_range
 
 
-def _decompress(compressed_file, start_block=0, end_block=512, is_subfile=False):
+def _decompress_to_dir(file_name, data, start_block=0, end_block=512,
+                       is_subfile=False, pool=None):
     """
-    Decompresses LoD's BPE-compressed files.
-
-    LoD compresses some files using a form of blocked byte-pair encoding
-    algorithm. The original data is compressed in blocks of up to 0x800
-    decompressed bytes. Each compressed block is composed of a 4-byte header
-    specifying the size of the decompressed block, instructions for filling
-    out a byte-pair dictionary, and the compressed data.
-
-    Decompression works by reading bytes as instructions for building the
-    byte-pair dictionary, filling it out until the offset exceeds the
-    dictionary size (256 bytes). Once the dictionary is filled out, bytes
-    are read as compressed data, and either added to the list of decompressed
-    data (if it is a real value) or used to get the corresponding byte-pair
-    value until their are no more bytes left in the compressed block.
+    Decompresses BPE data and writes the result to the file's _dir
+    subdirectory, and the metadata necessary for re-compressing the file
+    to its meta subdirectory.
 
     Parameters
     ----------
-    compressed_file : BufferedReader
-        I/O file object of compressed file.
+    file_name : str
+        Name of compressed file the data was read from.
+    data : bytes-like
+        Contents of compressed file.
     start_block : int
         Data block to start decompression from. (default: 0)
     end_block : int
@@ -220,170 +173,97 @@ def _decompress(compressed_file, start_block=0, end_block=512, is_subfile=False)
     is_subfile : bool
         Flag indicating whether file is a BPE file, or a non-BPE file
         that contains BPE-compressed data within its body. (default: False)
+    pool : multiprocessing.Pool
+        Pool to decode blocks with, or None to decode them in this
+        process. (default: None)
+
+    Raises
+    ------
+    ValueError
+        If the data is not valid BPE data.
     """
 
-    # Make sure file is BPE, or has BPE subfile if is_subfile specified,
-    # then set pointer to start of BPE file/subfile.
-    if b'BPE\x1a' in compressed_file.read(8):
-        compressed_file.seek(0)
-    elif is_subfile:
-        while True:
-            word = compressed_file.read(4)
-            if word == b'BPE\x1a':
-                compressed_file.seek(compressed_file.tell()-8)
-                break
-    else:
-        print('Decompress: Not a BPE file')
-        print('Decompress: Skipping file')
-        return
+    decompressed_data, meta = bpe.decompress(data, start_block, end_block,
+                                             is_subfile, pool)
 
-    file_name = os.path.realpath(compressed_file.name)
+    file_name = os.path.realpath(file_name)
     basename = os.path.splitext(os.path.basename(file_name))
     bpe_subdir = '_'.join((os.path.splitext(file_name)[0], 'dir'))
     meta_dir = os.path.join(bpe_subdir, 'meta')
     os.makedirs(bpe_subdir, exist_ok=True)
     os.makedirs(meta_dir, exist_ok=True)
 
+    # The end block in the file name is the last block actually decompressed
+    # if end_block exceeded the actual number of blocks.
     decompressed_file_name = os.path.join(
         bpe_subdir,
         ''.join((basename[0], '_{', str(start_block),
-                 '-', str(end_block), '}', basename[1])))
+                 '-', str(meta.end_block), '}', basename[1])))
     meta_file = os.path.join(meta_dir, os.path.basename(decompressed_file_name))
 
-    compressed_file.read(8)  # file size and BPE
+    # Create a file containing metadata necessary for re-compressing the file.
+    # This includes the decompressed length of the block, the blocks that
+    # decompression was started and end on, and the sizes of each block.
+    with open(meta_file, 'wb') as outf:
+        outf.write(meta.to_bytes())
+
+    # Write decompressed file.
+    with open(decompressed_file_name, 'wb') as outf:
+        outf.write(decompressed_data)
+
+
+def _decompress(compressed_file, start_block=0, end_block=512, is_subfile=False,
+                workers=1):
+    """
+    Decompresses LoD's BPE-compressed files.
+
+    Reads the compressed file and decompresses it using bpe.decompress(),
+    then writes the decompressed data to the file's _dir subdirectory, and
+    the metadata necessary for re-compressing the file to its meta
+    subdirectory. See the bpe module for notes on the compression format.
+
+    If more than one worker is requested, the block boundaries are found
+    first, and the blocks are then decoded simultaneously in a
+    multiprocessing Pool.
+
+    Parameters
+    ----------
+    compressed_file : BufferedReader
+        I/O file object of compressed file.
+    start_block : int
+        Data block to start decompression from. (default: 0)
+    end_block : int
+        Data block to decompress up to (non-inclusive). (default: 512)
+    is_subfile : bool
+        Flag indicating whether file is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+    workers : int
+        Number of processes to decode blocks with. (default: 1)
+    """
 
-    block = -1
     if end_block <= start_block:
         print('Decompress: End block is not greater than start block. '
               'Decompressing through end of file.')
         end_block = 512
 
-    decompressed_file_offset = 0
-    blocksize_list = []
-    decompressed_byte_list = []
-
-    while True:
-        block += 1
-
-        # Each block is preceded by 4-byte int up to 0x800 giving the number
-        # of decompressed bytes in the block. 0x00000000 indicates that there
-        # are no further blocks and decompression is complete.
-        bytes_remaining_in_block = compressed_file.read(4)
-        if bytes_remaining_in_block == b'\x00\x00\x00\x00'\
-                or bytes_remaining_in_block == b'':
-            break
-        elif int.from_bytes(bytes_remaining_in_block, 'little') > 0x800:
-            print('Decompress: 0x%s at offset 0x%08x is an invalid block size' %
-                  (bytes_remaining_in_block.hex(), compressed_file.tell()-4))
-            print('Decompress: Skipping file')
-            return
-
-        # If the routine has not reached the specified starting block, just
-        # increment the decompressed file offset. If it's between start and
-        # end, add the block size to the list of block sizes. Break the loop
-        # once the end block is passed.
-        if start_block > block:
-            decompressed_file_offset += int.from_bytes(bytes_remaining_in_block, 'little')
-        elif start_block <= block < end_block:
-            blocksize_list.append(bytes_remaining_in_block)
-        else:
-            break
-
-        bytes_remaining_in_block = int.from_bytes(bytes_remaining_in_block, 'little')
-
-        # Build the initial dictionary/lookup table. The left-character dict
-        # is filled so that each key contains itself as a value, while the
-        # right-character dict is filled with empty values.
-        dict_leftch = {x: x for x in range(0x100)}
-        dict_rightch = {x: '' for x in range(0x100)}
-
-        # Build adaptive dictionary.
-        key = 0x00
-        while key < 0x100:  # Dictionary is 256 bytes long. Loop until all keys filled.
-            # If byte_pairs_to_read is >=0x80, then only the next byte will
-            # be read into the dictionary, placed at the index value calculated
-            # using the below formula. Otherwise, the byte indicates how many
-            # sequential bytes to read into the dictionary.
-            byte_pairs_to_read = int.from_bytes(compressed_file.read(1), 'big')
-            if byte_pairs_to_read >= 0x80:
-                key = key - 0x7f + byte_pairs_to_read
-                byte_pairs_to_read = 0
-            else:
-                byte_pairs_to_read = byte_pairs_to_read
-
-            # For each byte/byte pair to read, read the next byte and add it
-            # to the leftch dict at the current key. If the character matches
-            # the key it's at, increment key and continue. If it does not,
-            # read the next character and add it to the same key in the
-            # rightch dict before incrementing key and continuing.
-            if key < 0x100:  # Check that dictionary length not exceeded.
-                for i in range(byte_pairs_to_read+1):
-                    compressed_byte = int.from_bytes(compressed_file.read(1), 'big')
-                    dict_leftch[key] = compressed_byte
-
-                    if compressed_byte != key:
-                        compressed_byte = int.from_bytes(compressed_file.read(1), 'big')
-                        dict_rightch[key] = compressed_byte
-
-                    key += 1
-
-        # Decompress block
-        # On each pass, read one byte and add it to a list of unresolved bytes.
-        while bytes_remaining_in_block > 0:
-            compressed_byte = int.from_bytes(compressed_file.read(1), 'big')
-            unresolved_byte_list = [compressed_byte]
-
-            # Pop the first item in the list of unresolved bytes. If the
-            # byte key == value in dict_leftch, append it to the list of
-            # decompressed bytes. If the byte key != value in dict_leftch,
-            # insert the leftch followed by rightch to the unresolved byte
-            # list. Loop until the unresolved byte list is empty.
-            while unresolved_byte_list:
-                compressed_byte = unresolved_byte_list.pop(0)
-                if compressed_byte == dict_leftch[compressed_byte]:
-                    if block >= start_block:
-                        decompressed_byte_list.append(compressed_byte.to_bytes(1, 'big'))
-                    bytes_remaining_in_block -= 1
-                else:
-                    unresolved_byte_list.insert(0, dict_rightch[compressed_byte])
-                    unresolved_byte_list.insert(0, dict_leftch[compressed_byte])
-
-        if compressed_file.tell() % 4 != 0:  # Word-align the pointer.
-            compressed_file.seek(compressed_file.tell()+(4-compressed_file.tell() % 4))
-
-    # Create a file containing metadata necessary for re-compressing the file.
-    # This includes the decompressed length of the block, the blocks that
-    # decompression was started and end on, and the sizes of each block.
-    with open(meta_file, 'wb') as outf:
-        outf.write(len(decompressed_byte_list).to_bytes(4, 'little'))
-        outf.write(start_block.to_bytes(2, 'little'))
-        if end_block > block:
-            outf.write(block.to_bytes(2, 'little'))
+    try:
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                _decompress_to_dir(compressed_file.name, compressed_file.read(),
+                                   start_block, end_block, is_subfile, pool)
         else:
-            outf.write(end_block.to_bytes(2, 'little'))
-        for blocksize in blocksize_list[:end_block + 1]:
-            outf.write(blocksize)
-        outf.write(b'\xff' * 4)
+            _decompress_to_dir(compressed_file.name, compressed_file.read(),
+                               start_block, end_block, is_subfile)
+    except ValueError as e:
+        print('Decompress: %s' % e)
+        print('Decompress: Skipping file')
+        return
 
-    # Write decompressed file.
-    with open(decompressed_file_name, 'wb') as outf:
-        for byte in decompressed_byte_list:
-            outf.write(byte)
-
-    # Updates filenames if end_block exceeded the actual number of blocks.
-    if end_block > block:
-        updated_name = decompressed_file_name.replace(str(end_block)+'}', str(block)+'}')
-        updated_meta = os.path.join(meta_dir, os.path.basename(updated_name))
-        if os.path.exists(updated_name):
-            os.remove(updated_name)
-        if os.path.exists(updated_meta):
-            os.remove(updated_meta)
-        os.rename(decompressed_file_name, updated_name)
-        os.rename(meta_file, updated_meta)
     print('Decompress: File decompressed\n')
 
 
-def run_decompression(compressed_file, start_block=0, end_block=512, is_subfile=False):
+def run_decompression(compressed_file, start_block=0, end_block=512, is_subfile=False,
+                      workers=1):
     """
     Wrapper function for _decompress().
 
@@ -405,6 +285,10 @@ def run_decompression(compressed_file, start_block=0, end_block=512, is_subfile=
     is_subfile : bool
         Flag indicating whether file is a BPE file, or a non-BPE file
         that contains BPE-compressed data within its body. (default: False)
+    workers : int
+        Number of processes to decode blocks with. Values above 1 decode
+        blocks in parallel, which is worthwhile for large files. 0 uses one
+        process per CPU. (default: 1)
     """
 
     print('Decompress: Decompressing file %s' % compressed_file)
@@ -413,23 +297,109 @@ def run_decompression(compressed_file, start_block=0, end_block=512, is_subfile=
         print('Decompress: Skipping file')
         return
 
+    if workers == 0:
+        workers = multiprocessing.cpu_count()
+
     with open(compressed_file, 'rb') as inf:
-        _decompress(inf, start_block, end_block, is_subfile)
+        _decompress(inf, start_block, end_block, is_subfile, workers)
+
+
+def _decompress_job(job):
+    """
+    Decompresses one block range of a file in a batch decompression worker.
+
+    Messages are returned rather than printed, so that the output of
+    simultaneous jobs is not interleaved.
+
+    Parameters
+    ----------
+    job : tuple
+        (compressed_file, start_block, end_block, is_subfile), as for
+        run_decompression().
+
+    Returns
+    -------
+    str
+        Error message, or None if the file was decompressed.
+    """
+
+    compressed_file, start_block, end_block, is_subfile = job
+    try:
+        with open(compressed_file, 'rb') as inf:
+            _decompress_to_dir(compressed_file, inf.read(), start_block,
+                               end_block, is_subfile)
+    except (OSError, ValueError) as e:
+        return str(e)
 
+    return None
 
-def _dummy_decompress(compressed_file, start_block=0, end_block=512, is_subfile=False):
+
+def run_batch_decompression(decompression_jobs, jobs=0):
+    """
+    Decompresses many BPE files at once in a multiprocessing Pool.
+
+    Each job decompresses one block range of one file, as
+    run_decompression() would, and the results are written in the same
+    _dir and meta layout. Jobs are started largest file first, so that
+    the big files do not all end up running at the end.
+
+    Parameters
+    ----------
+    decompression_jobs : list
+        List of (compressed_file, start_block, end_block, is_subfile)
+        tuples.
+    jobs : int
+        Number of processes to decompress files with. 0 uses one process
+        per CPU. (default: 0)
+    """
+
+    valid_jobs = []
+    for compressed_file, start_block, end_block, is_subfile in decompression_jobs:
+        if not os.path.isfile(compressed_file):
+            print('Decompress: %s does not exist' % compressed_file)
+            print('Decompress: Skipping file')
+            continue
+        if end_block <= start_block:
+            print('Decompress: End block is not greater than start block. '
+                  'Decompressing %s through end of file.' % compressed_file)
+            end_block = 512
+        valid_jobs.append((compressed_file, start_block, end_block, is_subfile))
+    if not valid_jobs:
+        return
+
+    valid_jobs.sort(key=lambda x: os.path.getsize(x[0]), reverse=True)
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(valid_jobs))
+
+    print('Decompress: Decompressing %d block ranges with %d processes\n'
+          % (len(valid_jobs), jobs))
+    with multiprocessing.Pool(jobs) as pool:
+        for job, error in zip(valid_jobs, pool.imap(_decompress_job, valid_jobs)):
+            print('Decompress: Decompressing file %s' % job[0])
+            if error is not None:
+                print('Decompress: %s' % error)
+                print('Decompress: Skipping file')
+            else:
+                print('Decompress: File decompressed\n')
+
+
+def _dummy_decompress(compressed_file, start_block=0, end_block=512, is_subfile=False,
+                      meta=None):
     """
     "Fake" decompresses BPE file to find offsets of start and end blocks.
 
-    For notes on decompression, see docstring and comments on _decompress. The
-    sole purpose of this function is to decompress a BPE file without writing
-    the decompressed data to a new file to get the start and end block offsets
-    needed for _compression().
+    The sole purpose of this function is to find the start and end block
+    offsets needed for _compress() without writing any decompressed data.
+    If the metadata contains a block index that still matches the
+    compressed file, the offsets are read straight from it. Otherwise, the
+    blocks are walked through using only the decompressed length of each
+    compressed byte. See bpe.find_block_offsets().
 
     Parameters
     ----------
-    compressed_file : BufferedReader
-        I/O file object of compressed file.
+    compressed_file : bytes-like
+        Contents of compressed file (e.g. an mmap of it).
     start_block : int
         Data block to start decompression from. (default: 0)
     end_block : int
@@ -437,6 +407,8 @@ def _dummy_decompress(compressed_file, start_block=0, end_block=512, is_subfile=
     is_subfile : bool
         Flag indicating whether file is a BPE file, or a non-BPE file
         that contains BPE-compressed data within its body. (default: False)
+    meta : BlockMeta
+        Metadata of the block range, if available. (default: None)
 
     Returns
     -------
@@ -445,310 +417,151 @@ def _dummy_decompress(compressed_file, start_block=0, end_block=512, is_subfile=
         file, respectively.
     """
 
-    subfile_start = None
-    if is_subfile:
-        while True:
-            word = compressed_file.read(4)
-            if word == b'BPE\x1a':
-                subfile_start = compressed_file.tell() - 8
-                compressed_file.seek(compressed_file.tell())
-                break
-    else:
-        compressed_file.seek(8)
-
-    block = -1
-    start_block_offset = 8
-    if end_block <= start_block:
-        print('Decompress: End block is not greater than start block. '
-              'Decompressing through end of file.')
-        end_block = 512
-
-    decompressed_file_offset = 0
-    blocksize_list = []
-    decompressed_byte_list = []
-
-    while True:
-        block += 1
-        if block == start_block:
-            start_block_offset = compressed_file.tell()
-
-        bytes_remaining_in_block = compressed_file.read(4)
-        if bytes_remaining_in_block == b'\x00\x00\x00\x00' \
-                or bytes_remaining_in_block == b'':
-            break
-        elif int.from_bytes(bytes_remaining_in_block, 'little') > 0x800:
-            print('Decompress: 0x%s at offset 0x%08x is an invalid block size' %
-                  (bytes_remaining_in_block.hex(), compressed_file.tell() - 4))
-            raise ValueError
-
-        if start_block > block:
-            decompressed_file_offset += int.from_bytes(bytes_remaining_in_block, 'little')
-        elif start_block <= block < end_block:
-            blocksize_list.append(bytes_remaining_in_block)
-        else:
-            break
-
-        bytes_remaining_in_block = int.from_bytes(bytes_remaining_in_block, 'little')
+    start_block_offset, end_block_offset, subfile_start = bpe.find_block_offsets(
+        compressed_file, start_block, end_block, is_subfile, meta)
 
-        dict_leftch = {x: x for x in range(0x100)}
-        dict_rightch = {x: '' for x in range(0x100)}
+    return start_block_offset, end_block_offset, \
+        subfile_start if is_subfile else None
 
-        key = 0x00
-        while key < 0x100:
-            byte_pairs_to_read = int.from_bytes(compressed_file.read(1), 'big')
-            if byte_pairs_to_read >= 0x80:
-                key = key - 0x7f + byte_pairs_to_read
-                byte_pairs_to_read = 0
-            else:
-                byte_pairs_to_read = byte_pairs_to_read
-
-            if key < 0x100:
-                for i in range(byte_pairs_to_read + 1):
-                    compressed_byte = int.from_bytes(compressed_file.read(1), 'big')
-                    dict_leftch[key] = compressed_byte
 
-                    if compressed_byte != key:
-                        compressed_byte = int.from_bytes(compressed_file.read(1), 'big')
-                        dict_rightch[key] = compressed_byte
+def _compress_range(comp_buf, data, meta, mod_mode=False, is_subfile=False,
+                    backend='python', block_cache=None, original_blocks=None):
+    """
+    Compresses the block range of a decompressed file in memory.
 
-                    key += 1
+    Each block is compressed individually by bpe (in the compression pool
+    if >15 blocks are being compressed). Blocks that decompress to the same
+    data as the original compressed file are copied from it rather than
+    compressed, so only edited blocks need compressing and unchanged blocks
+    keep their original size.
 
-        while bytes_remaining_in_block > 0:
-            compressed_byte = int.from_bytes(compressed_file.read(1), 'big')
-            unresolved_byte_list = [compressed_byte]
+    If the file is a subfile or is being compressed for a mod, it must be
+    compressed to no larger than its original size. In that case, every
+    block without a sort order in the metadata is compressed using each of
+    the sort orders, keeping the smallest. If the range is still too large
+    and the metadata did contain sort orders, all blocks are searched
+    instead.
 
-            while unresolved_byte_list:
-                compressed_byte = unresolved_byte_list.pop(0)
-                if compressed_byte == dict_leftch[compressed_byte]:
-                    if block >= start_block:
-                        decompressed_byte_list.append(compressed_byte.to_bytes(1, 'big'))
-                    bytes_remaining_in_block -= 1
-                else:
-                    unresolved_byte_list.insert(0, dict_rightch[compressed_byte])
-                    unresolved_byte_list.insert(0, dict_leftch[compressed_byte])
+    Parameters
+    ----------
+    comp_buf : bytes-like
+        Contents of the compressed file.
+    data : bytes-like
+        Decompressed data of the block range.
+    meta : BlockMeta
+        Metadata of the block range.
+    mod_mode : bool
+        Flag indicating the file is being compressed for a mod and compressed
+        size needs to be no larger than the original. (default: False)
+    is_subfile : bool
+        Flag indicating whether file is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+    backend : str
+        Backend used to compress blocks ('python' or 'numpy').
+        (default: 'python')
+    block_cache : BlockCache
+        Cache of previously compressed blocks, if any. (default: None)
+    original_blocks : list
+        Blocks of the original compressed file from bpe.read_blocks(), if
+        any. (default: None)
 
-        if compressed_file.tell() % 4 != 0:
-            compressed_file.seek(compressed_file.tell() + (4 - compressed_file.tell() % 4))
+    Returns
+    -------
+    tuple (int, int, int, list, int list)
+        Tuple containing start block offset, end block offset, subfile
+        start, compressed blocks, and the sort order of each block (None
+        unless mod_mode or is_subfile).
+    """
 
-    end_block_offset = compressed_file.tell() - 4
+    size_limited = mod_mode or is_subfile
+    num_changed = bpe.reuse_original_blocks(bpe.split_blocks(data, meta),
+                                            original_blocks).count(None)
+
+    # Find the offsets of the start and end blocks in the compressed file.
+    # These come from the block index in the metadata, unless the compressed
+    # file has changed since it was recorded (e.g. another block range was
+    # compressed into it), in which case the blocks are scanned.
+    start_block_offset, end_block_offset, subfile_start = \
+        _dummy_decompress(comp_buf, meta.start_block, meta.end_block, is_subfile, meta)
+
+    # Use the compression pool to compress blocks simultaneously if there
+    # are more than 15 blocks to compress. Less than that and the extra time
+    # taken to start the pool tends to exceed benefits of multiprocessing.
+    # This inflection point could probably be better chosen with further
+    # testing. Once the pool is running, it is used for any file with more
+    # than one block to compress. When searching for sort orders, each
+    # block is compressed up to 5 times. Unchanged blocks are not
+    # compressed at all.
+    num_compressions = num_changed * (len(bpe.SORT_ORDERS) if size_limited else 1)
+    if num_compressions > 15 or \
+            (_compression_pool is not None and num_compressions > 1):
+        pool = get_compression_pool()
+    else:
+        pool = None
+
+    # Sort orders from a previous compression (or a mod's patch
+    # metadata) are reused if present; other blocks are searched.
+    # Normal compression simply uses sort order 0.
+    sort_order_list = None
+    if size_limited:
+        comp_block_list, sort_order_list = bpe.compress_blocks_best(
+            data, meta, meta.sort_orders, pool, backend, block_cache,
+            original_blocks)
+        if meta.sort_orders and \
+                sum(map(len, comp_block_list)) > end_block_offset - start_block_offset:
+            comp_block_list, sort_order_list = bpe.compress_blocks_best(
+                data, meta, None, pool, backend, block_cache,
+                original_blocks)
+    else:
+        comp_block_list = bpe.compress_blocks(
+            data, meta, None, pool, backend, block_cache, original_blocks)
 
-    return start_block_offset, end_block_offset, subfile_start
+    return start_block_offset, end_block_offset, subfile_start, \
+        comp_block_list, sort_order_list
 
 
-def _compress_block(block, comp_block_list, attempt_num, is_subfile=False,
-                    mod_mode=False, sort_order=None, new_sort_list=None):
+def _read_original_blocks(compressed_file, meta, is_subfile=False):
     """
-    BPE compresses block of data.
-
-    This helper function for _compression handles the actual logic for
-    compressing block of data in _compression().
-
-    Function goes through uncompressed data block and counts occurrences
-    of byte pairs, iteratively replacing byte pairs with their assigned
-    keys and recounting until all keys are filled. Once the dictionary is
-    built, it is converted into a series of byte instructions and the
-    compressed data is appended to the instructions. The full compressed
-    block is lastly appended to a list of compressed blocks.
+    Reads the blocks of a range from the .orig backup of a compressed file.
 
     Parameters
     ----------
-    block : list
-        Contains block #, block size, and block data.
-    comp_block_list : list
-        List of (block #, block size, compressed block) tuples.
-    attempt_num : int
-        Number of current compression attempt for _choose_sort().
+    compressed_file : str
+        Name of compressed file.
+    meta : BlockMeta
+        Metadata of the block range.
     is_subfile : bool
         Flag indicating whether file is a BPE file, or a non-BPE file
         that contains BPE-compressed data within its body. (default: False)
-    mod_mode : bool
-        Flag indicating the file is being compressed for a mod and compressed
-        size needs to be no larger than the original. (default: False)
-    sort_order : int
-        Number indicating how to sort compression block, if it's been previously
-        sorted successfully. (default: None)
-    new_sort_list : list
-        List of tuples containing block number and sort order, if a sort
-        order already exists. (default: None)
-    """
-
-    if new_sort_list is None:
-        new_sort_list = []
-
-    # Build the initial dictionary/lookup table. The left-character dict
-    # is filled so that each key contains itself as a value, while the
-    # right-character dict is filled with empty values.
-    dict_leftch = {x: '' for x in range(0x100)}
-    dict_rightch = dict_leftch.copy()
-
-    # Add each unique byte found in block to dict_leftch.
-    curr_block = block[2]
-    for byte in curr_block:
-        if byte not in dict_leftch.values():
-            dict_leftch[byte] = byte
-
-    # Create sorted list of unfilled keys available to hold byte pairs.
-    empty_keys = sorted([key for key in dict_leftch.keys()
-                         if dict_leftch[key] == '' and key != 0xff])
-    last_empty_key = empty_keys[-1]
-
-    bp_count_dict = {}  # Dict to keep track of how often each byte pair occurs.
-
-    # Select integer indicating how byte pairs should be sorted when filling
-    # the byte-pair dicts. If a sort order already exists, use that.
-    sort_order = sort_order if sort_order is not None else _choose_sort(attempt_num)
-    if mod_mode or is_subfile:
-        # Add tuple of block number and sort order int to new_sort_list.
-        # Used if no sort list was present from metadata.
-        new_sort_list.append((block[0], sort_order))
-
-    # Add byte pairs to empty keys in dictionaries.
-    while True:
-        # Count instances of each byte pair.
-        for i, byte in enumerate(curr_block):
-            try:
-                byte_pair = (byte, curr_block[i + 1])
-            except IndexError:
-                break
 
-            if byte_pair not in bp_count_dict.keys():
-                bp_count_dict[byte_pair] = 1
-            else:
-                bp_count_dict[byte_pair] += 1
-
-        bp_count_list = _sort_keys(bp_count_dict, sort_order)
-
-        # Add most frequent byte pair to dictionaries and replace in block
-        # with key value. Byte pairs are only added to the dictionary if
-        # they occur at least 5 times and there are still unfilled keys
-        # in the dicts. Values are replaced because compression is multi-pass
-        # and byte pairs and pair counts must be recalculated each time.
-
-        # TODO: Look into using ByteArray or ByteIO instead of doing
-        #  a str.replace on an immutable byte string.
-        if bp_count_list[0][1] >= 5 and empty_keys:
-            empty_key = empty_keys.pop(-1)
-            dict_leftch[empty_key] = bp_count_list[0][0][0]
-            dict_rightch[empty_key] = bp_count_list[0][0][1]
-            byte_pair = b''.join(x.to_bytes(1, 'big') for x in bp_count_list[0][0])
-            curr_block = curr_block.replace(byte_pair, empty_key.to_bytes(1, 'big'))
-            bp_count_dict = {}
-        else:
-            break
-
-    key_list = sorted(dict_rightch.keys())
-    comp_block = []
-    previous_key = 0
-    header, byte_pair = b'', b''
-
-    # Find either first byte pair or use 0x80 literal. If the latter, assign
-    # \xfe as header and /x7f as the first byte pair/literal. If a byte pair
-    # found before 0x80, calculate header and get byte pair from dicts.
-    for key in key_list:
-        if dict_rightch[key] != '' and key <= 0x7f:
-            header = (key + 0x7f).to_bytes(1, 'big')
-            byte_pair = b''.join(x.to_bytes(1, 'big') for x in
-                                 (dict_leftch[key], dict_rightch[key]))
-            previous_key = key
-            break
-        elif key == 0x80:
-            header = b'\xfe'
-            byte_pair = b'\x7f'
-            previous_key = key - 1
-            break
-    comp_block.append(header)
-    comp_block.append(byte_pair)
-
-    i = previous_key + 1
-    sequential_key_run = False
-    sequential_keys = 0
-    while i <= last_empty_key:
-        byte = dict_rightch[i]
-        if byte != '' and i - previous_key > 1:
-            # If the current key corresponds to a byte pair and there is a >1
-            # key gap between the current and previous byte-pair key, then set
-            # the number of sequential keys to 0 and calculate the header byte.
-            # Then add the byte pair to the list of compressed bytes in order,
-            # set previous_key to the current one, and increment the key.
-            sequential_keys = 0
-            header = (i + 0x7f - (previous_key + 1)).to_bytes(1, 'big')
-            comp_block.append(header)
-            left_byte = dict_leftch[i - sequential_keys].to_bytes(1, 'big')
-            comp_block.append(left_byte)
-            try:
-                right_byte = dict_rightch[i - sequential_keys].to_bytes(1, 'big')
-                comp_block.append(right_byte)
-            except AttributeError as e:
-                # I don't remember why this was necessary, but I'm sure it's
-                # important for something.
-                print(dict_leftch[i], dict_rightch[i])
-                print(curr_block)
-                raise e
-            previous_key = i
-            i += 1
-        elif byte != '' and i - previous_key == 1:
-            # If the current key corresponds to a byte pair and immediately
-            # follows another byte pair, then a) set sequential_key_run to
-            # true if it's not, b) increment sequential keys if the key two
-            # keys later does not exceed dictionary size and the next two
-            # keys contain byte pairs, or c) append the number of sequential
-            # keys to the compressed data, followed by that number of keys'
-            # bytes/byte pairs in sequence.
-            if not sequential_key_run:
-                sequential_key_run = True
-            elif i + 2 < 256 \
-                    and (not (dict_rightch[i + 1] == '' and dict_rightch[i + 2] == '')):
-                sequential_keys += 1
-                previous_key = i
-                i += 1
-            else:
-                comp_block.append(sequential_keys.to_bytes(1, 'big'))
-                while sequential_keys >= 0:
-                    left_byte = dict_leftch[i - sequential_keys].to_bytes(1, 'big')
-                    comp_block.append(left_byte)
-                    if dict_rightch[i - sequential_keys] != '':
-                        right_byte = dict_rightch[i - sequential_keys].to_bytes(1, 'big')
-                        comp_block.append(right_byte)
-                    sequential_keys -= 1
-                sequential_keys = 0
-                sequential_key_run = False
-                previous_key = i
-                i += 1
-        elif byte == '' and sequential_key_run:
-            # If the key contains a byte literal rather than byte pair
-            # and a sequential_key_run is active, increment the number of
-            # sequential keys.
-            sequential_keys += 1
-            previous_key = i
-            i += 1
-        else:  # Move on to next key.
-            i += 1
-
-    if all(val == '' for val in dict_rightch.values()):
-        comp_block.append(b'\xfe\xff')  # For when dictionary contains only literals.
-    else:
-        comp_block.append((0x100 - (last_empty_key + 1) + 0x7f).to_bytes(1, 'big'))
-
-    # Add decompression in front of compressed data block.
-    curr_block = b''.join((b''.join(comp_block), curr_block))
-
-    size = len(curr_block)
-    padding = 4 - (size % 4) if size % 4 else 0
-    curr_block = b''.join((curr_block, b'\x8c' * padding))
-    block[2] = curr_block
+    Returns
+    -------
+    list
+        Blocks from bpe.read_blocks(), or None if there is no usable backup.
+    """
 
-    comp_block_list.append(block)
+    # The backup is mapped rather than read, as only the blocks of the
+    # range are needed. mmap raises ValueError for an empty backup.
+    try:
+        with open(''.join((compressed_file, '.orig')), 'rb') as inf, \
+                mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as orig_buf:
+            return bpe.read_blocks(orig_buf, meta.start_block,
+                                   meta.end_block, is_subfile)
+    except (OSError, ValueError):
+        return None
 
 
-def _compress(decompressed_file, compressed_file, attempt_num=0,
-              mod_mode=False, is_subfile=False):
+def _compress(decompressed_file, compressed_file, mod_mode=False, is_subfile=False,
+              backend='python', block_cache=None):
     """
     BPE compresses LoD game files.
 
     Compresses decompressed files into BPE files using metadata created by
-    _decompress(). Each block is compressed individually (asynchronously if
-    >15 blocks are being compressed), and blocks are ordered and written to
-    the compressed file at the end.
+    _decompress(). The block range is compressed by _compress_range(), and
+    the new compressed file is built in memory from a read-only mmap of the
+    current one. Writing the file is left to run_compression(). If the file
+    is a subfile or is being compressed for a mod, the new file is only
+    built if the size limit is met.
 
     Anything added to an uncompressed file that increases its size should
     be added to end of file so as not to mess up pointers. Therefore,
@@ -763,20 +576,25 @@ def _compress(decompressed_file, compressed_file, attempt_num=0,
         I/O file object of decompressed file.
     compressed_file : str
         Name of compressed file.
-    attempt_num : int
-        Number of current compression attempt for _choose_sort(). (default: 0)
     mod_mode : bool
         Flag indicating the file is being compressed for a mod and compressed
         size needs to be no larger than the original. (default: False)
     is_subfile : bool
         Flag indicating whether file is a BPE file, or a non-BPE file
         that contains BPE-compressed data within its body. (default: False)
+    backend : str
+        Backend used to compress blocks ('python' or 'numpy').
+        (default: 'python')
+    block_cache : BlockCache
+        Cache of previously compressed blocks, if any. (default: None)
 
     Returns
     -------
-    tuple (int, int, list, str)
-        Tuple containing end block offset, new end offset, the updated sort
-        order list, and the compressed file name.
+    tuple (int, int, BlockMeta, bytearray)
+        Tuple containing end block offset, new end offset, the updated
+        metadata (sort orders and block index), and the contents of the new
+        compressed file. If the size limit was not met, the new end offset
+        is the one the file would have had, and the contents are None.
     """
 
     file_name = os.path.realpath(decompressed_file.name)
@@ -784,161 +602,267 @@ def _compress(decompressed_file, compressed_file, attempt_num=0,
                              os.path.basename(file_name))
     backup_file(compressed_file)
 
-    # Adds byte pairs to dictionary until no pairs exist with count >= 5
-    # or no empty keys are left.
-    # Get the original decompressed file size, start block, end block, and
-    # original block sizes from the metadata file. Once all block sizes have
-    # been read, if sort order data is present from a previous compression,
-    # read sort order bytes ones at a time into a list as ints.
+    # Get the original decompressed file size, start block, end block,
+    # original block sizes, and sort orders from a previous compression
+    # if present, from the metadata file.
     with open(meta_file, 'rb') as inf:
-        orig_file_size = int.from_bytes(inf.read(4), 'little')
-        start_block = int.from_bytes(inf.read(2), 'little')
-        end_block = int.from_bytes(inf.read(2), 'little')
-
-        blocksize_list = []
-        while True:
-            blocksize = inf.read(4)
-            if blocksize != b'\xff' * 4:
-                blocksize_list.append(int.from_bytes(blocksize, 'little'))
-            else:
-                sort_order_list = []
-                while True:
-                    sort_num = inf.read(1)
-                    if sort_num != b'':
-                        sort_order_list.append(int.from_bytes(sort_num, 'little'))
-                    else:
-                        break
-                break
-
-    # Perform a "fake" decompression of compressed file to get the offsets
-    # of the start and end blocks. Necessary because compressor is naive to
-    # any changes in compressed file size or block offset potentially created
-    # by previous compressions. Does not create a decompressed file.
-    # TODO: Find way get start/end block offsets without decompression.
-    #  This method may be unnecessary, and could potentially be replaced
-    #  by pattern searching (b'[\x00-\xff][\x00-\x08]\x00\x00') on only word-
-    #  aligned values. However, testing is required, as it is possible this
-    #  pattern can appear in situations where it is not a block size.
-    with open(compressed_file, 'rb+') as comp:
-        start_block_offset, end_block_offset, subfile_start = \
-            _dummy_decompress(comp, start_block, end_block, is_subfile)
-
-        # Read any data after the end block offset to memory, then truncate
-        # the file to the start block offset.
-        comp.seek(end_block_offset)
-        comp_file_end = comp.read()
-        comp.truncate(start_block_offset)
-        if is_subfile:
-            comp.seek(subfile_start)
-        else:
-            comp.seek(0)
+        meta = bpe.BlockMeta.from_bytes(inf.read())
+
+    data = decompressed_file.read()
+    original_blocks = _read_original_blocks(compressed_file, meta, is_subfile)
+
+    with open(compressed_file, 'rb') as comp, \
+            mmap.mmap(comp.fileno(), 0, access=mmap.ACCESS_READ) as comp_map:
+        start_block_offset, end_block_offset, subfile_start, comp_block_list, \
+            sort_order_list = _compress_range(comp_map, data, meta, mod_mode, is_subfile,
+                                              backend, block_cache, original_blocks)
+
+        new_range_size = sum(map(len, comp_block_list))
+        if (mod_mode or is_subfile) and \
+                new_range_size > end_block_offset - start_block_offset:
+            return end_block_offset, start_block_offset + new_range_size, \
+                meta, None
+
+        # Build the new compressed file in memory from the data before the
+        # start block (with the new uncompressed file size), the compressed
+        # blocks, and the data after the end block.
+        header_offset = subfile_start if is_subfile else 0
+        new_file = bytearray(comp_map[:start_block_offset])
+        full_file_size = int.from_bytes(new_file[header_offset:header_offset+4], 'little')
+        full_file_size += len(data) - meta.decompressed_size
+        new_file[header_offset:header_offset+4] = full_file_size.to_bytes(4, 'little')
+        new_file += b''.join(comp_block_list)
+        new_end_offset = len(new_file)
+        new_file += comp_map[end_block_offset:]
+
+    # Update the metadata with the sort orders used and the new location of
+    # each compressed block.
+    if sort_order_list is not None:
+        meta.sort_orders = sort_order_list
+    meta.set_index(subfile_start if is_subfile else 0, start_block_offset,
+                   comp_block_list)
+
+    return end_block_offset, new_end_offset, meta, new_file
+
+
+def _compression_paths(decompressed_file):
+    """
+    Finds the compressed file and metadata file of a decompressed file.
 
-        # Calculate and write the new uncompressed file size.
-        file_size = os.path.getsize(decompressed_file.name)
-        if file_size != orig_file_size:
-            size_diff = file_size - orig_file_size
-        else:
-            size_diff = 0
-        full_file_size = int.from_bytes(comp.read(4), 'little')
-        full_file_size += size_diff
-        comp.seek(comp.tell()-4)
-        comp.write(full_file_size.to_bytes(4, 'little'))
-
-        comp.flush()
-
-        comp.seek(start_block_offset)
-        block_num = 0
-        block_list = []
-        while True:
-            # Read the next block of bytes. If the uncompressed data exceeds
-            # the original number of blocks, read overflow data in 0x800-byte
-            # blocks
-            if block_num >= len(blocksize_list) - 1:
-                block = decompressed_file.read(0x800)
-            else:
-                block = decompressed_file.read(blocksize_list[block_num])
-            block_num += 1  # TODO: Is this really where this should iterate?
+    Parameters
+    ----------
+    decompressed_file : str
+        Name of decompressed file.
 
-            uncompressed_blocksize = len(block)
-            if uncompressed_blocksize == 0:
-                break
-            else:
-                # Append list to block list that contains the block # (for sorting),
-                # the uncompressed size of the block, and the block data.
-                block_list.append(
-                    [block_num, uncompressed_blocksize.to_bytes(4, 'little'), block])
-
-        random.seed()  # Random seed for block sort order.
-
-        # Use a multiprocessing Pool to compress blocks simultaneously if there
-        # are more than 15 blocks to compress. Less than that and the extra time
-        # taken to create the pool tends to exceed benefits of multiprocessing.
-        # This inflection point could probably be better chosen with further
-        # testing. the arguments used for _compress_block() depend on the
-        # values of mod_mode, is_subfile, and sort_order_list.
-        if len(block_list) > 15:
-            pool = multiprocessing.Pool(multiprocessing.cpu_count() - 1 or 1)
-            manager = multiprocessing.Manager()  # Manager lists necessary for async.
-            comp_block_list = manager.list()
-            new_order_list = manager.list()
-            for i, b in enumerate(block_list):
-                if (mod_mode or is_subfile) and sort_order_list:
-                    pool.apply_async(_compress_block, args=(b, comp_block_list, attempt_num,
-                                                            is_subfile, mod_mode,
-                                                            sort_order_list[i]))
-                elif mod_mode or is_subfile:
-                    pool.apply_async(_compress_block, args=(b, comp_block_list, attempt_num,
-                                                            is_subfile, mod_mode, None,
-                                                            new_order_list))
-                else:
-                    pool.apply_async(_compress_block, args=(b, comp_block_list, attempt_num))
-            pool.close()
-            pool.join()
-
-            # Convert the manager list objects to normal lists.
-            comp_block_list = [item for item in comp_block_list]
-            new_order_list = [item for item in new_order_list]
+    Returns
+    -------
+    (str, str)
+        Names of the compressed file and the metadata file.
+    """
+
+    meta_file = os.path.join(os.path.dirname(decompressed_file), 'meta',
+                             os.path.basename(decompressed_file))
+    extension = os.path.splitext(decompressed_file)[1]
+    compressed_dir = os.path.dirname(decompressed_file)
+    compressed_file = os.path.join(
+        os.path.dirname(compressed_dir),
+        os.path.basename(compressed_dir).replace('_dir', extension))
+
+    return compressed_file, meta_file
+
+
+def _check_backend(backend):
+    """
+    Checks that a compression backend can be used.
+
+    Parameters
+    ----------
+    backend : str
+        Name of backend.
+
+    Returns
+    -------
+    str
+        Backend to use ('python' if NumPy is not installed), or None if
+        backend is not valid.
+    """
+
+    if backend not in bpe.BACKENDS:
+        print('Compress: %s is not a valid backend' % backend)
+        return None
+    elif backend == 'numpy' and bpe.np is None:
+        print('Compress: NumPy is not installed. Using python backend.')
+        return 'python'
+
+    return backend
+
+
+class CompressionPlan:
+    """
+    A class for storing the result of a compression dry run.
+
+    Functions
+    ---------
+    print_report()
+        Prints the per-block sizes and whether the file fits.
+
+    Attributes
+    ----------
+    decompressed_file : str
+        Name of the decompressed file.
+    start_block : int
+        First block of the decompressed range.
+    original_sizes : int list
+        Compressed size of each block in the current compressed file.
+    new_sizes : int list
+        Compressed size of each block after compression. Contains more
+        entries than original_sizes if data was added to the file.
+    sort_orders : int list
+        Sort order chosen for each block, if sort orders were searched.
+    original_size : int
+        Compressed size of the block range in the current compressed file.
+    new_size : int
+        Compressed size of the block range after compression.
+    slack : int
+        Number of bytes by which the new size is under the original size
+        (negative if it is over).
+    overflow_blocks : int list
+        Numbers of the blocks that compress to more than their original size.
+    fits : bool
+        Whether the block range fits in its original size.
+    """
+
+    def __init__(self, decompressed_file, start_block, original_sizes, new_sizes,
+                 sort_orders=None):
+        self.decompressed_file = decompressed_file
+        self.start_block = start_block
+        self.original_sizes = original_sizes
+        self.new_sizes = new_sizes
+        self.sort_orders = sort_orders
+        self.original_size = sum(original_sizes)
+        self.new_size = sum(new_sizes)
+        self.slack = self.original_size - self.new_size
+        self.overflow_blocks = [
+            start_block + i for i, size in enumerate(new_sizes)
+            if i >= len(original_sizes) or size > original_sizes[i]]
+        self.fits = self.slack >= 0
+
+    def __len__(self):
+        return len(self.new_sizes)
+
+    def print_report(self):
+        """
+        Prints the per-block sizes of any overflowing blocks, the total
+        sizes, and whether the block range fits in its original size.
+        """
+
+        print('Compress: Dry run of %s' % self.decompressed_file)
+        if self.overflow_blocks:
+            print('Compress:   Block  Original       New      Diff')
+            for block in self.overflow_blocks:
+                i = block - self.start_block
+                original = self.original_sizes[i] if i < len(self.original_sizes) else 0
+                print('Compress: %7d  %8d  %8d  %+8d' %
+                      (block, original, self.new_sizes[i], self.new_sizes[i] - original))
+        print('Compress: %d blocks, original size: %d, new size: %d, slack: %d' %
+              (len(self), self.original_size, self.new_size, self.slack))
+        if self.fits:
+            print('Compress: File fits in original size\n')
         else:
-            comp_block_list = []
-            new_order_list = []
-            for i, b in enumerate(block_list):
-                if (mod_mode or is_subfile) and sort_order_list:
-                    _compress_block(b, comp_block_list, attempt_num, is_subfile, mod_mode=mod_mode,
-                                    sort_order=sort_order_list[i], new_sort_list=[])
-                elif mod_mode or is_subfile:
-                    _compress_block(b, comp_block_list, attempt_num, is_subfile, mod_mode=mod_mode,
-                                    new_sort_list=new_order_list)
-                else:
-                    _compress_block(b, comp_block_list, attempt_num)
-
-        # Sort the compressed block list and sort order lists, then write
-        # the block sizes and compressed block data to the compressed file.
-        # Once all blocks are written, write the post-block range data.
-        comp_block_list.sort(key=lambda x: x[0])
-        new_order_list.sort(key=lambda x: x[0])
-        for b in comp_block_list:
-            comp.write(b[1])
-            comp.write(b[2])
-        new_end_offset = comp.tell()
-        comp.read(4)
-        comp.write(comp_file_end)
-
-    return end_block_offset, new_end_offset, new_order_list, compressed_file
-
-
-def run_compression(decompressed_file, mod_mode=True, is_subfile=False,
-                    max_attempts=100, delete_decompressed=False):
+            print('Compress: File does not fit in original size\n')
+
+
+def plan_compression(decompressed_file, mod_mode=True, is_subfile=False,
+                     backend='python', block_cache_dir=None, use_backup=False):
+    """
+    Compresses a decompressed file in memory without writing anything.
+
+    Compresses the block range the same way run_compression() would, and
+    compares the size of each compressed block to its size in the current
+    compressed file, so oversize edits can be found before compressing.
+    Blocks are compressed in the compression pool if it is running or
+    there are enough of them to start it, as for run_compression().
+
+    Parameters
+    ----------
+    decompressed_file : str
+        Name of file to plan compression of.
+    mod_mode : bool
+        Flag indicating the file is being compressed for a mod, in which
+        case sort orders are searched. (default: True)
+    is_subfile : bool
+        Flag indicating whether file is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+    backend : str
+        Backend used to compress blocks. (default: 'python')
+    block_cache_dir : str
+        Directory of the compressed block cache. (default: None)
+    use_backup : bool
+        Flag indicating whether to compare against the .orig backup of the
+        compressed file, as insertion restores the backup before
+        compressing. (default: False)
+
+    Returns
+    -------
+    CompressionPlan
+        Per-block sizes of the compressed range, or None if the file could
+        not be planned.
+    """
+
+    if not os.path.isfile(decompressed_file):
+        print('Compress: %s does not exist' % decompressed_file)
+        return None
+
+    backend = _check_backend(backend)
+    if backend is None:
+        return None
+
+    compressed_file, meta_file = _compression_paths(decompressed_file)
+    source_file = compressed_file
+    if use_backup and os.path.exists(''.join((compressed_file, '.orig'))):
+        source_file = ''.join((compressed_file, '.orig'))
+
+    block_cache = BlockCache(block_cache_dir) if block_cache_dir else None
+    try:
+        with open(meta_file, 'rb') as inf:
+            meta = bpe.BlockMeta.from_bytes(inf.read())
+        with open(decompressed_file, 'rb') as inf:
+            data = inf.read()
+
+        original_blocks = _read_original_blocks(compressed_file, meta, is_subfile)
+        with open(source_file, 'rb') as comp, \
+                mmap.mmap(comp.fileno(), 0, access=mmap.ACCESS_READ) as comp_map:
+            _, _, _, comp_block_list, sort_order_list = _compress_range(
+                comp_map, data, meta, mod_mode, is_subfile, backend, block_cache,
+                original_blocks)
+
+            # Find the size of each block of the range in the compressed file.
+            _, block_offsets, end_offset = bpe.scan_blocks(
+                comp_map, meta.end_block, is_subfile)
+            block_offsets = block_offsets[meta.start_block:]
+            original_sizes = [b - a for a, b in
+                              zip(block_offsets, block_offsets[1:] + [end_offset])]
+    except (OSError, ValueError) as e:
+        print('Compress: %s' % e)
+        print('Compress: Could not plan compression of %s' % decompressed_file)
+        return None
+
+    return CompressionPlan(decompressed_file, meta.start_block, original_sizes,
+                           [len(b) for b in comp_block_list], sort_order_list)
+
+
+def run_compression(decompressed_file, mod_mode=True, is_subfile=False, *,
+                    delete_decompressed=False, backend='python', block_cache_dir=None):
     """
     Wrapper function for _compress().
 
     When a file is being compressed normally, the function calls _compress()
     once and writes the new file. However, if the file is a subfile (as in
-    SCUS for example), or is intended for creating or applying a mod,
-    additional logic is required. _compress() will be called until the new
-    compressed size is no larger than the original, or the maximum number
-    of attempts specified is reached. Each time _compress() is used, the
-    byte pairs in the blocks will be sorted in a different order in an
-    attempt to minimize compression size.
+    SCUS for example), or is intended for creating or applying a mod, the
+    new compressed size must be no larger than the original. In that case,
+    _compress() searches for the sort orders that give the smallest size for
+    each block, so the outcome is the same every time the same data is
+    compressed, and the file is left unchanged if it is still too large.
 
     Note: Although individual or ranges of blocks can be decompressed/
     compressed, it is advised to simply decompress/compress the entire
@@ -954,10 +878,17 @@ def run_compression(decompressed_file, mod_mode=True, is_subfile=False,
     is_subfile : bool
         Flag indicating whether file is a BPE file, or a non-BPE file
         that contains BPE-compressed data within its body. (default: False)
-    max_attempts : int
-        Maximum number of times to attempt to compress a file. (default: 100)
     delete_decompressed : bool
         Flag indicating whether to delete decompressed file after compression.
+        Keyword-only, as is every following argument. (default: False)
+    backend : str
+        Backend used to compress blocks. 'numpy' counts and replaces byte
+        pairs with NumPy arrays, and produces the same output as 'python'.
+        (default: 'python')
+    block_cache_dir : str
+        Directory of the compressed block cache. Blocks already compressed
+        with the same data and sort order are taken from the cache instead
+        of being compressed again. (default: None)
     """
 
     print('Compress: Compressing file %s' % decompressed_file)
@@ -966,188 +897,68 @@ def run_compression(decompressed_file, mod_mode=True, is_subfile=False,
         print('Compress: Skipping file')
         return
 
-    # Since compression requires a clean copy of the file, a temp copy
-    # is created to replace the main file following failed compressions
-    # (size limit not achieved). This is done rather than using the clean
-    # backup so that already-modded files can be compressed without losing
-    # previous changes.
-    meta_file = os.path.join(os.path.dirname(decompressed_file), 'meta',
-                             os.path.basename(decompressed_file))
-    extension = os.path.splitext(decompressed_file)[1]
-    compressed_dir = os.path.dirname(decompressed_file)
-    compressed_file = os.path.join(
-        os.path.dirname(compressed_dir),
-        os.path.basename(compressed_dir).replace('_dir', extension))
-    temp = '.'.join((compressed_file, 'temp'))
-    shutil.copy(compressed_file, temp)
-
-    with open(decompressed_file, 'rb') as inf:
-        if is_subfile or mod_mode:
-            attempts = 1
-            print('Compress: Attempting to compress file to original size.')
-        else:
-            attempts = 0
-
-        return_vals = None
-        while True:
-            if is_subfile or mod_mode:
-                if attempts == 1:
-                    print('Compress: Attempt %d/%d' % (attempts, max_attempts))
-                else:
-                    print('Compress: Attempt %d/%d (Prev: [original size: %d, new size: %d])' %
-                          (attempts, max_attempts, return_vals[0], return_vals[1]))
-
-            # Compress file.
-            return_vals = _compress(inf, compressed_file, attempts, mod_mode, is_subfile)
-
-            # If file is not a subfile and not flagged for modding, no further action
-            # is necessary. If either of those are true, however, further action is
-            # necessary if the new compressed size is greater than the original
-            # compressed size. If the max number of attempts has not been reached,
-            # compression will be attempted until compressed size is no more than
-            # original. If max attempts is reached, the function will print a warning
-            # and return.
-            #
-            # Once an appropriate size is achieved, the sort order list will be
-            # written out to the metadata file. If the compressed file is a subfile
-            # (as found in SCUS/SCES/SCPS and S_BTLD), some additional actions are
-            # performed to write the post-compression data to the correct location.
-            if (is_subfile or mod_mode) and return_vals[0] < return_vals[1] and \
-                    ((os.path.getsize(decompressed_file) > 0x800 and attempts < max_attempts) or
-                     (os.path.getsize(decompressed_file) <= 0x800 and attempts <= 5)):
-                attempts += 1
-                shutil.copy(temp, compressed_file)
-                inf.seek(0)
-                continue
-            elif (is_subfile or mod_mode) and return_vals[0] < return_vals[1] and \
-                    ((os.path.getsize(decompressed_file) > 0x800 and attempts >= max_attempts) or
-                     (os.path.getsize(decompressed_file) <= 0x800 and attempts > 5)):
-                shutil.copy(temp, compressed_file)
-                os.remove(temp)
-                print('Compress: Could not compress subfile to original size')
-                print('Compress: Compression terminated')
-                return
-            else:
-                if is_subfile or mod_mode:
-                    with open(meta_file, 'rb+') as outf:
-                        while True:
-                            if outf.read(4) == (b'\xff' * 4):
-                                break
-                        for num in return_vals[2]:
-                            outf.write(num[1].to_bytes(1, 'little'))
-
-                if is_subfile and return_vals[1] < return_vals[0]:
-                    with open(return_vals[3], 'rb+') as f:
-                        data = b''
-                        if 'SCUS' in decompressed_file.upper()\
-                                or 'SCES' in decompressed_file.upper()\
-                                or 'SCPS' in decompressed_file.upper():
-                            f.seek(0x36c28 - (return_vals[0] - return_vals[1]))
-                            data = f.read()
-                            f.seek(0x36c28 - (return_vals[0] - return_vals[1]))
-                        elif 'BTLD' in decompressed_file.upper():
-                            f.seek(0x68d8 - (return_vals[0] - return_vals[1]))
-                            data = f.read()
-                        f.write(b'\x00' * (return_vals[0] - return_vals[1]))
-                        f.write(data)
-
-                print('Compress: File compressed')
-
-            break
-
-    # Delete the temp file, and the decompressed file as well if specified.
-    os.remove(temp)
-    if delete_decompressed:
-        shutil.rmtree(os.path.dirname(decompressed_file))
-
-
-# MRG handling and file swapping functions + integrated functions
-
-class LBATable:
-    """
-    A class for storing necessary values from the logical block addressing
-    tables at the beginnings of MRG files.
-
-    Functions
-    ---------
-    read_lba_table()
-        Reads MRG LBA table to LBATable object.
-
-    Attributes
-    ----------
-    sector_padding : bool
-        Value stating whether the MRG file uses '0x8c' sector padding.
-    num_files : int
-        Number of files contained in MRG file (excludes LBA); defined by
-        second 4-byte word header.
-    lba_table_len : int
-        Length of the LBA table; equal to num_files * 8
-    ptr_locs = int list
-        List containing offsets of all 8-byte entries in LBA table.
-    file_locs = int list
-        List containing offsets of all files in MRG, as defined by first
-        4 bytes of each LBA table entry.
-    file_sizes : int list
-        List containing sizes of all files in MRG, as defined by second
-        4 bytes of each LBA table entry.
-    """
-
-    def __init__(self, source_file, sector_padding):
-        """
-        Parameters
-        ----------
-        source_file : BufferedReader
-            MRG file that files are being extracted from/inserted into
-        sector_padding : bool
-            Value stating whether the MRG file uses '0x8c' sector padding.
-        """
-
-        source_file.seek(4)
-        self.sector_padding = sector_padding
-        self.num_files = int.from_bytes(source_file.read(4), 'little')
-        self.lba_table_len = self.num_files * 0x08
-        self.ptr_locs = []
-        self.file_locs = []
-        self.file_sizes = []
-
-    def __len__(self):
-        return len(self.ptr_locs)
+    backend = _check_backend(backend)
+    if backend is None:
+        print('Compress: Skipping file')
+        return
 
-    def read_lba_table(self, source_file):
-        """
-        Reads MRG LBA tables and stores values.
+    compressed_file, meta_file = _compression_paths(decompressed_file)
 
-        Loops through all 8-byte entries of MRG LBA table, and appends pointer
-        offsets, pointer values/file offsets, and file sizes to their respective
-        list variables, then co-sorts all lists.
+    if is_subfile or mod_mode:
+        print('Compress: Attempting to compress file to original size.')
 
-        Parameters
-        ----------
-        source_file : BufferedReader
-            MRG file that files are being extracted from/inserted into
-        """
+    block_cache = BlockCache(block_cache_dir) if block_cache_dir else None
+    with open(decompressed_file, 'rb') as inf:
+        return_vals = _compress(inf, compressed_file, mod_mode, is_subfile, backend,
+                                block_cache)
+    if block_cache is not None and block_cache.hits:
+        print('Compress: %d/%d blocks reused from cache' %
+              (block_cache.hits, block_cache.hits + block_cache.misses))
+
+    # If file is not a subfile and not flagged for modding, no further action
+    # is necessary. If either of those are true, however, the file is not
+    # written if the new compressed size is greater than the original
+    # compressed size, and the function will print a warning and return.
+    #
+    # Once an appropriate size is achieved, the sort order list and block
+    # index will be written out to the metadata file. If the compressed
+    # file is a subfile (as found in SCUS/SCES/SCPS and S_BTLD), some
+    # additional actions are performed to write the post-compression data
+    # to the correct location.
+    if (is_subfile or mod_mode) and return_vals[0] < return_vals[1]:
+        print('Compress: Could not compress subfile to original size '
+              '[original size: %d, new size: %d]' % (return_vals[0], return_vals[1]))
+        print('Compress: Compression terminated')
+        return
 
-        source_file.seek(0x08)
+    # Subfiles that shrink are padded with zeros so that the data following
+    # them stays at its original offset.
+    new_file = return_vals[3]
+    if is_subfile and return_vals[1] < return_vals[0]:
+        padding = bytes(return_vals[0] - return_vals[1])
+        if 'SCUS' in decompressed_file.upper()\
+                or 'SCES' in decompressed_file.upper()\
+                or 'SCPS' in decompressed_file.upper():
+            pad_offset = 0x36c28 - len(padding)
+        elif 'BTLD' in decompressed_file.upper():
+            pad_offset = 0x68d8 - len(padding)
+        else:
+            pad_offset = len(new_file)
+        new_file[pad_offset:pad_offset] = padding
 
-        for file_num in range(self.num_files):
-            self.ptr_locs.append(source_file.tell())
+    # The compressed file is written before the metadata, as the block index
+    # in the metadata is only used if it matches the compressed file.
+    replace_file(compressed_file, new_file)
+    replace_file(meta_file, return_vals[2].to_bytes())
 
-            loc = int.from_bytes(source_file.read(4), 'little')
-            if self.sector_padding:
-                # Pointer values are multiplied by 0x800 if pointer values
-                # are sector numbers rather than actual offsets.
-                loc = loc * 0x800
-            self.file_locs.append(loc)
+    print('Compress: File compressed')
 
-            size = source_file.read(4)
-            self.file_sizes.append(int.from_bytes(size, 'little'))
+    # Delete the decompressed file as well if specified.
+    if delete_decompressed:
+        shutil.rmtree(os.path.dirname(decompressed_file))
 
-        self.file_locs, self.file_sizes, self.ptr_locs = \
-            sort_together(
-                [self.file_locs, self.file_sizes, self.ptr_locs], key_list=(0, 1))
-        self.file_locs, self.file_sizes, self.ptr_locs = \
-            list(self.file_locs), list(self.file_sizes), list(self.ptr_locs)
 
+# MRG handling and file swapping functions + integrated functions
 
 def parse_input(file_list, num_files_in_mrg):
     """
@@ -1203,7 +1014,8 @@ def parse_input(file_list, num_files_in_mrg):
     return sorted(list(num_list))
 
 
-def extract_files(source_file, sector_padding=False, files_to_extract=('*',)):
+def extract_files(source_file, sector_padding=False, files_to_extract=('*',),
+                  threads=0, use_index=True, source_data=None):
     """
     Extracts files from MRG files.
 
@@ -1213,6 +1025,10 @@ def extract_files(source_file, sector_padding=False, files_to_extract=('*',)):
     the individual files specified are extracted. File numbering starts
     at 1. File 0 corresponds to the LBA table, and is excluded from '*'.
 
+    Files are copied straight from the source file to the new files by
+    copy_range(), several at a time in a thread pool, as the copies are
+    made by the kernel where possible and so release the GIL.
+
     Parameters
     ----------
     source_file : string
@@ -1223,79 +1039,111 @@ def extract_files(source_file, sector_padding=False, files_to_extract=('*',)):
     files_to_extract : list
         List of files to extract. Default: ('*',) [all files excluding
         file 0 {the LBA table}]
+    threads : int
+        Number of threads to copy files with. 0 uses one thread per CPU.
+        (default: 0)
+    use_index : bool
+        Whether to read the LBA table from the structure index, if one is
+        in use. (default: True)
+    source_data : bytes-like
+        Contents of the MRG file, if it should not be read from source_file
+        (e.g. if it is read from a disc image). Files are still extracted
+        to source_file's subdirectory. (default: None)
     """
 
     # Return if file does not exist or file size is 0.
-    if not os.path.isfile(source_file):
-        print('Extract: File %s not found' % source_file)
+    if source_data is None:
+        if not os.path.isfile(source_file):
+            print('Extract: File %s not found' % source_file)
+            print('Extract: Skipping file')
+            return
+        elif not os.path.getsize(source_file):
+            print('Extract: %s is an empty file' % source_file)
+            print('Extract: Skipping file')
+            return
+
+    # Check that file is MRG file and get the offset and size of each file
+    # from the LBA table, or from the structure index if it is in use.
+    # Return if not a MRG file.
+    structure_index = get_default_index() if use_index and source_data is None else None
+    if structure_index is not None:
+        file_ranges = structure_index.file_ranges(source_file, sector_padding)
+    else:
+        try:
+            with mrg.MRGArchive(source_file if source_data is None else source_data,
+                                sector_padding) as archive:
+                file_ranges = [archive.file_range(num) for num in range(len(archive) + 1)]
+        except ValueError:
+            file_ranges = None
+    if file_ranges is None:
+        print('Extract: %s is not a MRG file' % source_file)
         print('Extract: Skipping file')
         return
-    elif not os.path.getsize(source_file):
-        print('Extract: %s is an empty file' % source_file)
-        print('Extract: Skipping file')
+
+    num_files = len(file_ranges) - 1
+    print('Extract: Extracting files from %s' % source_file)
+    if num_files == 0:
         return
 
-    with open(source_file, 'rb') as inf:
-        # Check that file is MRG file. Return if not.
-        header = inf.read(4)
-        if header != b'MRG\x1a':
-            print('Extract: %s is not a MRG file' % source_file)
+    # Get list of files to extract. Return if empty.
+    file_nums = parse_input(files_to_extract, num_files)
+    if not file_nums:
+        return  # Exit function early if no files to extract.
+
+    # Create output directory
+    output_dir = '_'.join((os.path.splitext(source_file)[0], 'dir'))
+    os.makedirs(output_dir, exist_ok=True)
+    basename = os.path.splitext(os.path.basename(source_file))[0]
+
+    # Loop through all items in file_nums and get the offset and size of
+    # each file. File 0 contains the LBA table. Not especially useful.
+    copy_jobs = []
+    for num in file_nums:
+        # Make sure source actually contains file number
+        if num > num_files:
+            print('Extract: File %d does not exist. %s contains %d files' %
+                  (num, source_file, num_files))
             print('Extract: Skipping file')
-            return
+            continue
 
-        print('Extract: Extracting files from %s' % source_file)
+        output_file = os.path.join(
+            output_dir, ''.join((basename, '_', str(num), '.bin')))
+        copy_jobs.append((source_file if source_data is None else source_data,
+                          output_file, *file_ranges[num]))
 
-        # Read LBA table
-        lba_list = LBATable(inf, sector_padding)
-        if lba_list.num_files == 0:
-            return
-        lba_list.read_lba_table(inf)
-
-        # Get list of files to extract. Return if empty.
-        file_nums = parse_input(files_to_extract, lba_list.num_files)
-        if not file_nums:
-            return  # Exit function early if no files to extract.
-
-        # Create output directory
-        output_dir = '_'.join((os.path.splitext(source_file)[0], 'dir'))
-        os.makedirs(output_dir, exist_ok=True)
-        basename = os.path.splitext(os.path.basename(source_file))[0]
-
-        # Loop through all items in file_nums. For each, go to the offset
-        # corresponding to the file number, read file size bytes, and write
-        # them to a new file.
-        files_extracted = 0
-        for num in file_nums:
-            # Creates a file 0 containing LBA table. Not especially useful.
-            if num == 0:
-                file_loc = 0
-                file_size = lba_list.lba_table_len + 8
-            else:
-                # Make sure source actually contains file number
-                try:
-                    file_loc = lba_list.file_locs[num-1]
-                    file_size = lba_list.file_sizes[num-1]
-                except IndexError:
-                    print('Extract: File %d does not exist. '
-                          '%s contains %d files' %
-                          (num, source_file, len(lba_list)))
-                    print('Extract: Skipping file')
-                    continue
+    # Copy each file from the source file to its new file.
+    if threads < 1:
+        threads = multiprocessing.cpu_count()
+    with ThreadPoolExecutor(min(threads, len(copy_jobs)) or 1) as executor:
+        for _ in executor.map(_extract_file, copy_jobs):
+            pass
+    print('Extract: Extracted %d of %d files' %
+          (len(copy_jobs), len(file_nums)))
 
-            output_file = os.path.join(
-                output_dir, ''.join((basename, '_', str(num), '.bin')))
 
-            with open(output_file, 'wb') as outf:
-                inf.seek(file_loc)
-                outf.write(inf.read(file_size))
+def _extract_file(copy_job):
+    """
+    Copies a file out of a MRG file for extract_files().
 
-            files_extracted += 1
-        else:
-            print('Extract: Extracted %d of %d files' %
-                  (files_extracted, len(file_nums)))
+    Parameters
+    ----------
+    copy_job : tuple
+        Name or contents of MRG file, name of file to copy to, and offset
+        and size of the file in the MRG file.
+    """
+
+    source_file, output_file, offset, size = copy_job
+    if not isinstance(source_file, str):
+        with open(output_file, 'wb') as outf:
+            outf.write(source_file[offset:offset+size])
+        return
+
+    with open(source_file, 'rb') as inf, open(output_file, 'wb') as outf:
+        copy_range(inf, outf, offset, size)
 
 
-def _extraction_handler(source_file, sector_padding=False, files_to_extract=('*',)):
+def _extraction_handler(source_file, sector_padding=False, files_to_extract=('*',),
+                        decompression_jobs=None, vfs=None):
     """
     Wrapper function for extracting/decompressing files when using
     extract_all_from_list.
@@ -1319,29 +1167,80 @@ def _extraction_handler(source_file, sector_padding=False, files_to_extract=('*'
     files_to_extract : list
         List of files to extract (MRG) or blocks to decompress (BPE).
         Default: ('*',) [all files excluding file 0 of MRG files {the LBA table}]
+    decompression_jobs : list
+        If given, BPE block ranges are appended to this list as jobs for
+        run_batch_decompression() instead of being decompressed
+        immediately. (default: None)
+    vfs : VirtualFileSystem
+        If given, source files that have not been extracted to disk are
+        read through it (e.g. from a disc image). (default: None)
     """
 
     # Exit function if file number is '^', which references parent file.
     if any('^' in sl[0] for sl in files_to_extract):
         return
 
+    source_data = None
     if not os.path.exists(source_file):
-        print('Extract: %s does not exist' % source_file)
-        return
+        if vfs is not None:
+            try:
+                source_data = vfs.read_extracted(source_file)
+            except FileNotFoundError:
+                pass
+        if source_data is None:
+            print('Extract: %s does not exist' % source_file)
+            return
 
-    source_file = source_file.upper()
-    with open(source_file, 'rb') as f:
-        mrg = f.read(4)
-        bpe = f.read(4)
+    try:
+        _extract_source(source_file.upper(), sector_padding, files_to_extract,
+                        decompression_jobs, source_data)
+    finally:
+        if isinstance(source_data, memoryview):
+            source_data.release()
+
+
+def _extract_source(source_file, sector_padding, files_to_extract, decompression_jobs,
+                    source_data):
+    """
+    Extracts from or decompresses one source file for _extraction_handler().
+
+    Parameters
+    ----------
+    source_file : str
+        Path and name of source file.
+    sector_padding : bool
+        See _extraction_handler().
+    files_to_extract : list
+        See _extraction_handler().
+    decompression_jobs : list
+        See _extraction_handler().
+    source_data : bytes-like
+        Contents of source file, or None to read it from disk.
+    """
+
+    # Get the type of the file from its header, or from the structure
+    # index if it is in use.
+    structure_index = get_default_index() if source_data is None else None
+    file_types = None
+    if structure_index is not None:
+        file_types = structure_index.file_types(source_file, sector_padding)
+    if file_types is None:
+        if source_data is None:
+            with open(source_file, 'rb') as f:
+                header = f.read(8)
+        else:
+            header = bytes(source_data[:8])
+        file_types = [file_type for file_type, flag in (('MRG', MRG_FLAG), ('BPE', BPE_FLAG))
+                      if flag.match(header)]
 
     # extract_files() is used for all MRG files. Checked first since
     # some MRGs contain BPEs.
     # run_decompression() is used for BPE files. Condition checks for
     # OV_ and SCUS/SCES/SCPS as well as BPE header because certain of
     # these files have BPE subfiles where the header occurs later.
-    if re.match(b'MRG\x1a', mrg):
-        extract_files(source_file, sector_padding, files_to_extract)
-    elif re.match(b'BPE\x1a', bpe) \
+    if 'MRG' in file_types:
+        extract_files(source_file, sector_padding, files_to_extract, source_data=source_data)
+    elif 'BPE' in file_types \
             or ('OV_' in source_file or 'SCUS' in source_file
                 or 'SCES' in source_file or 'SCPS' in source_file):
         for i in files_to_extract:
@@ -1352,14 +1251,27 @@ def _extraction_handler(source_file, sector_padding=False, files_to_extract=('*'
             else:
                 block_segment = [int(x) for x in (i[0].split('-'))]
 
-            run_decompression(source_file, block_segment[0],
-                              block_segment[1], not sector_padding)
+            if source_data is not None:
+                print('Decompress: Decompressing file %s' % source_file)
+                try:
+                    _decompress_to_dir(source_file, source_data, block_segment[0],
+                                       block_segment[1], not sector_padding)
+                except ValueError as e:
+                    print('Decompress: %s' % e)
+                    print('Decompress: Skipping file')
+            elif decompression_jobs is not None:
+                decompression_jobs.append((source_file, block_segment[0],
+                                           block_segment[1], not sector_padding))
+            else:
+                run_decompression(source_file, block_segment[0],
+                                  block_segment[1], not sector_padding)
     else:
         print('Extract: %s is not a MRG or BPE file' % source_file)
         print('Extract: Skipping file')
 
 
-def extract_all_from_list(list_file, disc_dict, file_category='[ALL]'):
+def extract_all_from_list(list_file, disc_dict, file_category='[ALL]', jobs=1,
+                          from_disc=False):
     """
     Extracts all files specified by the file list txt file given in the config.
 
@@ -1367,6 +1279,15 @@ def extract_all_from_list(list_file, disc_dict, file_category='[ALL]'):
     _extraction_handler(), which is called for every source file in the dict.
     Each source file is then extracted from (MRG) or decompressed (BPE).
 
+    If more than one job is requested, MRG files are extracted first, and
+    all BPE files are then decompressed together by
+    run_batch_decompression(). BPE subfiles of MRG files are therefore
+    available by the time they are decompressed.
+
+    If from_disc is set, source files that have not been extracted to disk
+    are read straight from each disc's image, so that game files no longer
+    need to be extracted with cdpatch() first.
+
     Parameters
     ----------
     list_file : str
@@ -1378,6 +1299,12 @@ def extract_all_from_list(list_file, disc_dict, file_category='[ALL]'):
         The header category containing file entries to extract from/decompress.
         Values are '[PATCH]', '[SWAP]', and '[ALL]'.
         Default: '[ALL]'
+    jobs : int
+        Number of processes to decompress BPE files with. 0 uses one
+        process per CPU. (default: 1)
+    from_disc : bool
+        Whether to read source files from the disc images in disc_dict if
+        they are not on disk. (default: False)
     """
 
     # '[ALL]' will read the file entries in both the [PATCH] and [SWAP]
@@ -1389,10 +1316,22 @@ def extract_all_from_list(list_file, disc_dict, file_category='[ALL]'):
     # Call _extraction_handler() on each file entry for each disc for each
     # category (i.e. [PATCH]).
     print('\nExtract: Extracting files\n')
+    decompression_jobs = [] if jobs != 1 else None
     for cat, cat_val in files_dict.items():
         for disc, disc_val in cat_val.items():
-            for key in sorted(disc_val.keys(), key=numerical_sort):
-                _extraction_handler(key, disc_val[key][0], disc_val[key][1:])
+            vfs = None
+            if from_disc and disc in disc_dict:
+                vfs = disc_file_system(disc_dict[disc])
+            try:
+                for key in sorted(disc_val.keys(), key=numerical_sort):
+                    _extraction_handler(key, disc_val[key][0], disc_val[key][1:],
+                                        decompression_jobs, vfs)
+            finally:
+                if vfs is not None:
+                    vfs.close()
+
+    if decompression_jobs:
+        run_batch_decompression(decompression_jobs, jobs)
 
     print('\nExtract: Complete')
 
@@ -1442,107 +1381,93 @@ def insert_files(source_file, sector_padding=False, files_to_insert=('*',),
     #  insert_all even for single files, but that's restructuring for the
     #  C# version
     backup_file(source_file, True if files_to_insert[0] == '*' else False, True)
-    with open(source_file, 'rb+') as outf:
-        # Check that file is MRG file. Return if not.
-        header = outf.read(4)
-        if header != b'MRG\x1a':
-            print(f'Insert: {source_file} is not a MRG file')
-            print('Insert: Skipping file')
-            return
 
-        print(f'Insert: Inserting files into {source_file}')
+    # Check that file is MRG file. Return if not.
+    with open(source_file, 'rb') as inf:
+        header = inf.read(8)
+    if header[:4] != b'MRG\x1a':
+        print(f'Insert: {source_file} is not a MRG file')
+        print('Insert: Skipping file')
+        return
 
-        input_dir = '_'.join((os.path.splitext(source_file)[0], 'dir'))
-        basename = os.path.splitext(os.path.basename(source_file))[0]
+    print(f'Insert: Inserting files into {source_file}')
 
-        # Read LBA table
-        lba_list = LBATable(outf, sector_padding)
-        lba_list.read_lba_table(outf)
+    input_dir = '_'.join((os.path.splitext(source_file)[0], 'dir'))
+    basename = os.path.splitext(os.path.basename(source_file))[0]
 
-        # Store first item in file list for rebuild test.
-        all_files_test = files_to_insert[0]
+    # Store first item in file list for rebuild test.
+    all_files_test = files_to_insert[0]
 
-        # Get list of files to insert. Return if empty.
-        file_nums = parse_input(files_to_insert, len(lba_list.file_locs))
-        if not file_nums:
-            return
+    # Get list of files to insert. Return if empty.
+    num_files = int.from_bytes(header[4:], 'little')
+    file_nums = parse_input(files_to_insert, num_files)
+    if not file_nums:
+        return
 
-        # Exclude File 0 (LBA table) from insertion.
-        if file_nums[0] == 0:
-            file_nums = file_nums[1:]
-
-        # If all files was specified, make sure that file numbers in
-        # subdir match file numbers in LBA table. If they don't, set
-        # all_files_test to '' so that _insert_helper() will be used
-        # rather than _rebuild_helper. Non-existent files are left in
-        # the list so that an error will print later to alert the user
-        # of the issue.
-        # TODO: Maybe move logic of non-existent files here
-        if all_files_test == '*':
-            subdir_check = sorted(
-                [int(os.path.basename(os.path.splitext(x)[0]).split('_')[-1])
-                 for x in glob.glob(os.path.join(input_dir.upper(), '*.bin'))])
-            if file_nums != subdir_check:
-                all_files_test = ''
-
-        # If all files was specified and they exist in subdir, then rebuild
-        # the files. Otherwise, files are inserted.
-        if all_files_test == '*':
-            files_inserted = _rebuild_helper(outf, lba_list, sector_padding,
-                                             input_dir, basename)
-        else:
-            files_inserted = _insert_helper(outf, lba_list, file_nums,
-                                            sector_padding, input_dir, basename)
-
-        # Update LBA table with new file location and size values.
-        for i in range(0, len(lba_list)):
-            outf.seek(lba_list.ptr_locs[i])
-            if sector_padding:
-                outf.write(int.to_bytes((lba_list.file_locs[i] // 0x800), 4, 'little'))
-            else:
-                outf.write(int.to_bytes(lba_list.file_locs[i], 4, 'little'))
-            outf.write(int.to_bytes(lba_list.file_sizes[i], 4, 'little'))
-        else:
-            print('Insert: Inserted %d of %d files' %
-                  (files_inserted, len(file_nums)))
+    # Exclude File 0 (LBA table) from insertion.
+    if file_nums[0] == 0:
+        file_nums = file_nums[1:]
+
+    # If all files was specified, make sure that file numbers in
+    # subdir match file numbers in LBA table. If they don't, set
+    # all_files_test to '' so that _insert_helper() will be used
+    # rather than _rebuild_helper. Non-existent files are left in
+    # the list so that an error will print later to alert the user
+    # of the issue.
+    # TODO: Maybe move logic of non-existent files here
+    if all_files_test == '*':
+        subdir_check = sorted(
+            [int(os.path.basename(os.path.splitext(x)[0]).split('_')[-1])
+             for x in glob.glob(os.path.join(input_dir.upper(), '*.bin'))])
+        if file_nums != subdir_check:
+            all_files_test = ''
+
+    # If all files was specified and they exist in subdir, then rebuild
+    # the files. Otherwise, files are inserted.
+    if all_files_test == '*':
+        files_inserted = _rebuild_helper(source_file, sector_padding,
+                                         input_dir, basename)
+    else:
+        files_inserted = _insert_helper(source_file, file_nums, sector_padding,
+                                        input_dir, basename)
 
-        # Attempt to delete subdirectory if del_subdir is true.
-        try:
-            if del_subdir:
-                shutil.rmtree(input_dir)
-        except PermissionError:
-            print('Insert: Could not delete %s. Make sure that no files in folder '
-                  'are in use' % input_dir)
-        except FileNotFoundError:
-            pass
+    print('Insert: Inserted %d of %d files' % (files_inserted, len(file_nums)))
 
+    # Attempt to delete subdirectory if del_subdir is true.
+    try:
+        if del_subdir:
+            shutil.rmtree(input_dir)
+    except PermissionError:
+        print('Insert: Could not delete %s. Make sure that no files in folder '
+              'are in use' % input_dir)
+    except FileNotFoundError:
+        pass
 
-def _insert_helper(src_file, lba_table, file_nums, sector_padding,
-                   input_dir, basename):
+
+def _insert_helper(source_file, file_nums, sector_padding, input_dir, basename):
     """
     Helper function to insert files individually into a MRG file.
 
     This helper function for insert_files() is used when all files ('*')
     is not specified, or it is but not all of the files exist in the
-    subdirectory. It uses file_nums to access entries in the LBA table,
-    goes to the offset indicated, and writes the corresponding subfile
-    to that location. If the subfile exceeds the original file size (plus
-    sector padding), the remainder of the file is read prior to insertion,
-    then written back afterwards. The LBA table  object is updated with
-    new file offsets and sizes.
+    subdirectory. The new layout of the MRG file is planned first with
+    mrg.InsertionPlan: subfiles that fit within their original size (plus
+    sector padding) overwrite the original, and larger subfiles push the
+    rest of the file back. If no subfile moves, the subfiles are simply
+    written over the MRG file. Otherwise, the new MRG file is written in
+    a single pass to a temp file that then replaces it, with the unchanged
+    parts copied by copy_range(). The LBA table is written once at the end.
 
     Parameters
     ----------
-    src_file : BufferedReader
+    source_file : str
         MRG file that files are being inserted into.
-    lba_table : LBATable
-        LBA table of src_file.
     file_nums : int list
-        List of files to be inserted into src_file, by file number.
+        List of files to be inserted into source_file, by file number.
     sector_padding : bool
         Value stating whether the MRG file uses '0x8c' sector padding.
     input_dir : string
-        Subdirectory containing subfiles to be inserted into src_file.
+        Subdirectory containing subfiles to be inserted into source_file.
     basename : string
         Base name of MRG file (e.g. DRGN21_43 for DRGN21_43.BIN).
 
@@ -1552,105 +1477,70 @@ def _insert_helper(src_file, lba_table, file_nums, sector_padding,
         Count of files successfully inserted into MRG file.
     """
 
-    # Loop through all items in file_nums. For each, go to the offset
-    # corresponding to the file number and write the subfile to the
-    # source file.
-    files_inserted = 0
-    for index, num in enumerate(file_nums):
-        input_file = os.path.join(
-            input_dir, ''.join((basename, '_', str(num), '.bin')))
-
-        # Make sure source actually contains file number, and input
-        # file exists. Skip file if not.
-        if num > len(lba_table):
-            print('Insert: File %s does not exist' %
-                  input_file)
-            print('Insert: Skipping file')
-            continue
-        if not os.path.isfile(input_file):
-            print('Insert: File %s not found' % input_file)
-            print('Insert: Skipping file')
-            continue
-
-        with open(input_file, 'rb') as inf:
-            # Preferred behavior for insert_files() is to have inserted files
-            # overwrite existing data if they are the same length as or
-            # shorter than the original (including sector padding for files
-            # that have it). If the file being inserted is longer, then the
-            # end of the file is broken off, the inserted file is written in,
-            # and the end of the source file is written back to the end and
-            # the LBA entries are updated.
-            file_size = os.path.getsize(input_file)
-            if (num == len(lba_table)
-                    or (file_size <= ceil(lba_table.file_sizes[num - 1] / 0x800) * 0x800
-                        and sector_padding)
-                    or (file_size <= ceil(lba_table.file_sizes[num - 1] / 4) * 4
-                        and not sector_padding)):
-                src_file.seek(lba_table.file_locs[num - 1])
-                src_file.write(inf.read())
-
-                # With the exception of the final subfile, any file that where
-                # size % 4 != 0 is padded with 0x8c, even when the source file
-                # is not sector padded.
-                if not sector_padding and num != len(lba_table) \
-                        and file_size % 4:
-                    src_file.write(b'\x8C' * (0x04 - file_size % 0x04))
-                src_file.flush()
-
-                lba_table.file_sizes[num - 1] = file_size
+    # Make sure source actually contains each file number, and input
+    # file exists. Skip file if not.
+    input_files = {}
+    with mrg.MRGArchive(source_file, sector_padding) as archive:
+        for num in file_nums:
+            input_file = os.path.join(
+                input_dir, ''.join((basename, '_', str(num), '.bin')))
+            if num > len(archive):
+                print('Insert: File %s does not exist' % input_file)
+                print('Insert: Skipping file')
+                continue
+            if not os.path.isfile(input_file):
+                print('Insert: File %s not found' % input_file)
+                print('Insert: Skipping file')
+                continue
+            input_files[num] = input_file
+
+        plan = archive.plan_insertion(
+            {num: os.path.getsize(input_file) for num, input_file in input_files.items()})
+
+    # The source file is closed before it is replaced by the new file.
+    with (open_replacement(source_file) if plan.moves_files
+          else open(source_file, 'rb+')) as outf, \
+            open(source_file, 'rb') as inf:
+        for kind, source, offset, length in plan.segments:
+            # Unchanged parts of the file are already in place unless
+            # files have moved.
+            if kind == 'copy' and not plan.moves_files:
+                continue
+            outf.seek(offset)
+            if kind == 'copy':
+                copy_range(inf, outf, source, length)
+            elif kind == 'file':
+                with open(input_files[source], 'rb') as subfile:
+                    copy_range(subfile, outf, 0, length)
             else:
-                src_file.seek(lba_table.file_locs[num])
-                data = src_file.read()
-                src_file.seek(lba_table.file_locs[num - 1])
-                src_file.write(inf.read())
-
-                # As above, but also add sector padding when necessary.
-                # Sector padding already exists in the source file for
-                # sector-padded files that don't exceed the original sector.
-                if not sector_padding and num != len(lba_table) \
-                        and file_size % 4:
-                    src_file.write(b'\x8C' * (0x04 - file_size % 0x04))
-                elif sector_padding and file_size % 0x800:
-                    src_file.write(b'\x8C' * (0x800 - file_size % 0x800))
-                src_file.flush()  # flush to make sure tell() gives correct offset
-
-                size_enlarged_by = src_file.tell() - lba_table.file_locs[num]
-                src_file.write(data)
-                src_file.flush()
-                lba_table.file_sizes[num - 1] = file_size
+                outf.write(b'\x8C' * length)
 
-                # Update file_locs following the file just written if file is larger
-                # than the original.
-                if size_enlarged_by > 0:
-                    for i in range(num, len(lba_table)):
-                        lba_table.file_locs[i] = \
-                            lba_table.file_locs[i] + size_enlarged_by
+        for ptr_loc, entry in plan.lba_entries(sector_padding):
+            outf.seek(ptr_loc)
+            outf.write(entry)
 
-        files_inserted += 1
+    return len(input_files)
 
-    return files_inserted
 
-
-def _rebuild_helper(src_file, lba_table, sector_padding, input_dir, basename):
+def _rebuild_helper(source_file, sector_padding, input_dir, basename):
     """
     Helper function to fully rebuild MRG file from subfiles.
 
     This helper function for insert_files() is used when all files ('*')
-    is specified and all of the files exist in the subdirectory. It walks
-    through the LBA table and writes each subfile in order, writing sector
-    padding as necessary. The LBA table object is updated with new file
-    offsets and sizes.
+    is specified and all of the files exist in the subdirectory. The
+    subfiles are streamed in order by mrg.MRGWriter into a temp file,
+    which is padded as necessary and has its LBA table filled in at the
+    end, then replaces source_file. If the rebuild fails, source_file is
+    left untouched.
 
     Parameters
     ----------
-    src_file : BufferedReader
+    source_file : str
         MRG file that is being rebuilt.
-    lba_table : LBATable
-        LBA table of src_file.
     sector_padding : bool
         Value stating whether the MRG file uses '0x8c' sector padding.
     input_dir : string
-        Subdirectory containing subfiles to rebuild src_file from.
+        Subdirectory containing subfiles to rebuild source_file from.
     basename : string
         Base name of MRG file (e.g. DRGN21_43 for DRGN21_43.BIN).
 
@@ -1660,59 +1550,50 @@ def _rebuild_helper(src_file, lba_table, sector_padding, input_dir, basename):
         Count of files successfully inserted into MRG file.
     """
 
-    # Seek end of LBA table (plus sector padding if necessary)
-    # and truncate file.
-    if sector_padding:
-        src_file.seek(src_file.tell() + 8 +
-                      (0x800 - (src_file.tell() + 8) % 0x800))
-    else:
-        src_file.seek(lba_table.lba_table_len + 8)
-    src_file.truncate()
-
-    # Loop through each file, write it to the truncated src_file, and
-    # update offset and size values in the LBATable.
-    files_inserted = 0
-    orig_file_loc = 0
-    for file in range(1, lba_table.num_files+1):
-        # Check is necessary due to several duplicate references to the
-        # same 8-byte file. Makes sure that duplicate overwrites itself
-        # instead of writing additional copies.
-        if file > 1 and orig_file_loc == lba_table.file_locs[file-1]:
-            src_file.seek(orig_file_loc)
-
-        # Get original offset of current file and current offset in
-        # src_file. If these are not the same, calculate the offset
-        # difference and add that to the file offset in the LBATable.
-        orig_file_loc = lba_table.file_locs[file-1]
-        file_loc = src_file.tell()
-        if file_loc != orig_file_loc:
-            loc_diff = file_loc - orig_file_loc
-            for i in range(file-1, lba_table.num_files):
-                lba_table.file_locs[i] += loc_diff
-
-        # Get size of subfile being inserted, update size in the LBATable,
-        # then write the subfile to src_file, padding if necessary.
-        input_file = os.path.join(
-            input_dir, ''.join((basename, '_', str(file), '.bin')))
-        with open(input_file, 'rb') as inf:
-            file_size = os.path.getsize(input_file)
-            lba_table.file_sizes[file-1] = file_size
-            src_file.write(inf.read(file_size))
-            src_file.flush()
-            curr_offset = src_file.tell()
-            if not sector_padding and file != lba_table.num_files \
-                    and curr_offset % 4:
-                src_file.write(b'\x8C' * (0x04 - curr_offset % 0x04))
-            elif sector_padding and curr_offset % 0x800:
-                src_file.write(b'\x8C' * (0x800 - curr_offset % 0x800))
-            src_file.flush()
-        files_inserted += 1
-
-    return files_inserted
+    with mrg.MRGArchive(source_file, sector_padding) as archive:
+        input_files = [os.path.join(input_dir, ''.join((basename, '_', str(file), '.bin')))
+                       for file in range(1, archive.num_files+1)]
+        writer = mrg.MRGWriter(archive, source_file,
+                               [os.path.getsize(input_file) for input_file in input_files])
+
+    with writer:
+        for input_file in input_files:
+            writer.write_file(input_file)
+
+    return len(input_files)
+
+
+def _block_range_files(source_file, files_to_insert):
+    """
+    Returns the decompressed block range files of a BPE file.
+
+    Parameters
+    ----------
+    source_file : str
+        Name of BPE file.
+    files_to_insert : list
+        List of block range entries from the file list text file.
+
+    Returns
+    -------
+    str list
+        Names of the decompressed files for each block range.
+    """
+
+    base_name = os.path.basename(source_file)
+    bn_parts = os.path.splitext(base_name)
+    dec_files = []
+    for i in files_to_insert:
+        block_range = process_block_range(i[0], base_name)
+        dec_files.append(os.path.join(
+            '_'.join((os.path.splitext(source_file)[0], 'dir')),
+            ''.join((bn_parts[0], '_', block_range, bn_parts[1]))))
+
+    return dec_files
 
 
 def _insertion_handler(source_file, sector_padding=False, files_to_insert=('*',),
-                       del_subdir=False):
+                       del_subdir=False, block_cache_dir=None):
     """
     Wrapper function for inserting/compressing files when using
     insert_all_from_list().
@@ -1735,6 +1616,9 @@ def _insertion_handler(source_file, sector_padding=False, files_to_insert=('*',)
     del_subdir : bool
         Specifies whether to delete subdirectory containing component
         files. Default: False
+    block_cache_dir : str
+        Directory of the compressed block cache used for BPE files.
+        Default: None
     """
 
     # Exit function if file number is '^', which references parent file.
@@ -1746,32 +1630,25 @@ def _insertion_handler(source_file, sector_padding=False, files_to_insert=('*',)
 
     source_file = source_file.upper()
     with open(source_file, 'rb') as f:
-        mrg = f.read(4)
-        bpe = f.read(4)
+        header = f.read(8)
 
     # insert_files() is used for all MRG files.
     # Checked first since some MRGs contain BPEs.
     # run_compression() is used for BPE files. Condition checks for
     # OV_ and SCUS/SCES/SCPS as well as BPE header because certain of
     # these files have BPE subfiles where the header occurs later.
-    if re.match(b'MRG\x1a', mrg):
+    if mrg.is_mrg(header):
         insert_files(source_file, sector_padding, files_to_insert, del_subdir)
-    elif re.match(b'BPE\x1a', bpe) \
+    elif mrg.is_bpe(header) \
             or ('OV_' in source_file or 'SCUS' in source_file
                 or 'SCES' in source_file or 'SCPS' in source_file):
         # Not restoring a clean file from backup may corrupt file
         backup_file(source_file, True, True)
 
-        base_name = os.path.basename(source_file)
-        bn_parts = os.path.splitext(base_name)
-        for i in files_to_insert:
-            block_range = process_block_range(i[0], base_name)
-            dec_file = os.path.join(
-                '_'.join((os.path.splitext(source_file)[0], 'dir')),
-                ''.join((bn_parts[0], '_', block_range, bn_parts[1])))
-
+        for dec_file in _block_range_files(source_file, files_to_insert):
             run_compression(dec_file, False, not sector_padding,
-                            delete_decompressed=del_subdir)
+                            delete_decompressed=del_subdir,
+                            block_cache_dir=block_cache_dir)
             # TODO: need to come up with another method of specifying subfiles
             #  for compression because did not originally anticipate all the
             #  nested BPEs in DRGN0
@@ -1781,7 +1658,7 @@ def _insertion_handler(source_file, sector_padding=False, files_to_insert=('*',)
 
 
 def insert_all_from_list(list_file, disc_dict, file_category='[ALL]',
-                         del_subdir=False):
+                         del_subdir=False, block_cache_dir=None):
     """
     Inserts all files specified by the file list txt file given in the config.
 
@@ -1804,6 +1681,9 @@ def insert_all_from_list(list_file, disc_dict, file_category='[ALL]',
     del_subdir : bool
         Specifies whether to delete subdirectory containing component
         files (MRG) and decompressed files (BPE). Default: False
+    block_cache_dir : str
+        Directory of the compressed block cache used for BPE files.
+        Default: None
     """
 
     # '[ALL]' will read the file entries in both the [PATCH] and [SWAP]
@@ -1819,20 +1699,181 @@ def insert_all_from_list(list_file, disc_dict, file_category='[ALL]',
         for disc, disc_val in cat_val.items():
             for key in sorted(disc_val.keys(), key=numerical_sort, reverse=True):
                 _insertion_handler(key, disc_val[key][0],
-                                   disc_val[key][1:], del_subdir)
+                                   disc_val[key][1:], del_subdir, block_cache_dir)
 
     print('\nInsert: Complete')
 
 
-def unpack_all(source_file, sector_padded=False, delete_empty_files=False):
+def _plan_range(range_entry, backend='python', block_cache_dir=None):
+    """
+    Plans compression of one block range for plan_all_from_list().
+
+    Parameters
+    ----------
+    range_entry : tuple
+        (decompressed_file, is_subfile) of the block range.
+    backend : str
+        Backend used to compress blocks. (default: 'python')
+    block_cache_dir : str
+        Directory of the compressed block cache. (default: None)
+
+    Returns
+    -------
+    CompressionPlan
+        Plan from plan_compression(), or None.
+    """
+
+    decompressed_file, is_subfile = range_entry
+    return plan_compression(decompressed_file, False, is_subfile, backend,
+                            block_cache_dir, True)
+
+
+def plan_all_from_list(list_file, disc_dict, file_category='[ALL]',
+                       backend='python', block_cache_dir=None):
+    """
+    Plans compression of all BPE files specified by the file list txt file.
+
+    Runs plan_compression() on every decompressed BPE block range that
+    insert_all_from_list() would compress, without writing anything, and
+    prints a report for each. Files are planned concurrently, sharing the
+    compression pool. MRG files are skipped.
+
+    Parameters
+    ----------
+    list_file : str
+        Text file containing list of files to insert/compress.
+    disc_dict : dict
+        Dict containing information about disc image, directory structure,
+        and game files
+    file_category : str
+        The header category containing file entries to plan. Values are
+        '[PATCH]', '[SWAP]', and '[ALL]'. Default: '[ALL]'
+    backend : str
+        Backend used to compress blocks. Default: 'python'
+    block_cache_dir : str
+        Directory of the compressed block cache. Default: None
+
+    Returns
+    -------
+    list
+        CompressionPlan of each block range that could be planned.
+    """
+
+    files_list = read_file_list(list_file, disc_dict, reverse=True,
+                                file_category=file_category)
+
+    # Find every block range that would be compressed, using the same
+    # conditions as _insertion_handler().
+    range_list = []
+    for cat, cat_val in files_list.items():
+        for disc, disc_val in cat_val.items():
+            for key in sorted(disc_val.keys(), key=numerical_sort, reverse=True):
+                files_to_insert = disc_val[key][1:]
+                if any('^' in sl[0] for sl in files_to_insert) or not os.path.exists(key):
+                    continue
+
+                source_file = key.upper()
+                with open(source_file, 'rb') as f:
+                    header = f.read(8)
+                if header[:4] == b'MRG\x1a':
+                    continue
+                elif header[4:] == b'BPE\x1a' \
+                        or ('OV_' in source_file or 'SCUS' in source_file
+                            or 'SCES' in source_file or 'SCPS' in source_file):
+                    for dec_file in _block_range_files(source_file, files_to_insert):
+                        range_list.append((dec_file, not disc_val[key][0]))
+
+    print('\nCompress: Planning compression of %d files\n' % len(range_list))
+    plan_list = []
+    if range_list:
+        # Ranges are planned in threads so that the blocks of several ranges
+        # are queued on the compression pool at once.
+        get_compression_pool()
+        with ThreadPoolExecutor(min(multiprocessing.cpu_count(), len(range_list))) as executor:
+            plan_list = list(executor.map(
+                partial(_plan_range, backend=backend, block_cache_dir=block_cache_dir),
+                range_list))
+
+    plan_list = [plan for plan in plan_list if plan is not None]
+    for plan in plan_list:
+        plan.print_report()
+    print('Compress: %d/%d files fit in original size' %
+          (sum(plan.fits for plan in plan_list), len(plan_list)))
+
+    return plan_list
+
+
+def _unpack_file(job):
+    """
+    Unpacks one file for unpack_all().
+
+    If the file is a MRG, all of its subfiles are extracted, and if it is a
+    BPE, it is decompressed. Either way, the file is then deleted (along
+    with the BPE metadata directory). Messages are returned rather than
+    printed, so that the output of simultaneous jobs is not interleaved.
+    The structure index is not used, as the files are deleted once
+    unpacked.
+
+    Parameters
+    ----------
+    job : tuple
+        (file, delete_empty_files), as for unpack_all().
+
+    Returns
+    -------
+    tuple
+        Messages printed while unpacking, the list of files produced (None
+        if file is a bottom-level file), and the size of file.
+    """
+
+    file, delete_empty_files = job
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        # Delete all empty files.
+        size = os.path.getsize(file)
+        if delete_empty_files and size <= 8:
+            os.remove(file)
+            return messages.getvalue(), [], size
+
+        # Read the header of the file.
+        with open(file, 'rb') as f:
+            print(f.name)
+            header = f.read(8)
+
+        # If the file is a MRG, extract all subfiles, then delete the
+        # file. If the file is a BPE, decompress it, then delete both file
+        # and metadata directory. Otherwise, it is a bottom-level file.
+        output_dir = '_'.join((os.path.splitext(file)[0], 'dir'))
+        if MRG_FLAG.match(header):
+            extract_files(file, threads=1, use_index=False)
+            os.remove(file)
+        elif BPE_FLAG.match(header):
+            run_decompression(file)
+            os.remove(file)
+            shutil.rmtree(os.path.join(output_dir, 'meta'))
+        else:
+            return messages.getvalue(), None, size
+
+    produced = []
+    if os.path.isdir(output_dir):
+        produced = [os.path.join(output_dir, f) for f in
+                    sorted(os.listdir(output_dir), key=numerical_sort)]
+        produced = [f for f in produced if os.path.isfile(f)]
+
+    return messages.getvalue(), produced, size
+
+
+def unpack_all(source_file, sector_padded=False, delete_empty_files=False,
+               jobs=1, manifest_file=None):
     """
     Fully unpacks a MRG file into all of its component files.
 
     This function recursively extracts all subfiles in the given source file.
     For each file, if it is a MRG/BPE, it is extracted/decompressed, then
-    deleted from the source file's subfile directory. The function continues
-    until it makes one full pass recursively walking the subfile directory
-    without encountering a MRG/BPE file.
+    deleted from the source file's subfile directory. The files this
+    produces are added to a work queue, so that every file is checked
+    exactly once, until the queue is empty. With more than one job, the
+    files in the queue are unpacked simultaneously in a process pool.
 
     The purpose of this function is to disassemble the DRGN0 and DRGN2x files
     to their lowest-level file components so that file types (e.g. TIMs, text)
@@ -1848,6 +1889,13 @@ def unpack_all(source_file, sector_padded=False, delete_empty_files=False):
         Whether the file being unpacked is sector aligned (default: False).
     delete_empty_files : bool
         Whether to delete files less than 8 bytes long (default: False).
+    jobs : int
+        Number of processes to unpack files with. 0 uses one process per
+        CPU. (default: 1)
+    manifest_file : str
+        Name of a tab-separated text file to list every bottom-level file
+        in, along with its size and the MRG/BPE file it was unpacked from.
+        (default: None)
     """
 
     # Check that source file exists and contains data.
@@ -1866,46 +1914,44 @@ def unpack_all(source_file, sector_padded=False, delete_empty_files=False):
         os.path.dirname(source_file),
         '_'.join((os.path.splitext(os.path.basename(source_file))[0], 'dir')))
 
-    # Loop through subfile directory and extract/decompress all MRG/BPE files,
-    # recursing through all subdirectories until no MRG/BPE files remain.
-    while True:
-        finished = True  # Assumes unpack will finish in one iteration.
-
-        # List out all files in directory being searched and loop through them.
-        file_list = [os.path.join(dp, f) for dp, dn, fn in
-                     os.walk(dir_to_search) for f in fn]
-        for file in file_list:
-            # Delete all empty files.
-            if delete_empty_files and os.path.getsize(file) <= 8:
-                os.remove(file)
-                continue
-
-            # Read the header of the file.
-            with open(file, 'rb') as f:
-                print(f.name)
-                header = f.read(8)
-
-            # If the file is a MRG, extract all subfiles, then delete the
-            # file and set finished to False. If the file is a BPE, decompress
-            # it, then delete both file and metadata directory and set finished
-            # to False. Otherwise, continue to next file.
-            if MRG_FLAG.match(header):
-                extract_files(file)
-                os.remove(file)
-                finished = False
-            elif BPE_FLAG.match(header):
-                run_decompression(file)
-                os.remove(file)
-                bpe_subdir = '_'.join((os.path.splitext(file)[0], 'dir'))
-                shutil.rmtree(os.path.join(bpe_subdir, 'meta'))
-                finished = False
-            else:
-                continue
+    # Queue all files in the subfile directory. Each file that is a MRG/BPE
+    # is extracted/decompressed, and the files produced are queued in turn,
+    # until no MRG/BPE files remain.
+    queue = deque((os.path.join(dp, f), source_file) for dp, dn, fn in
+                  os.walk(dir_to_search) for f in sorted(fn, key=numerical_sort))
+    manifest = []
+
+    def process_result(file, parent, result):
+        messages, produced, size = result
+        print(messages, end='')
+        if produced is None:
+            manifest.append((file, size, parent))
+        else:
+            queue.extend((f, file) for f in produced)
 
-        # Once no more MRGs or BPEs are encountered when looping through file_list,
-        # exit the while loop.
-        if finished:
-            break
+    if jobs == 1:
+        while queue:
+            file, parent = queue.popleft()
+            process_result(file, parent, _unpack_file((file, delete_empty_files)))
+    else:
+        if jobs == 0:
+            jobs = multiprocessing.cpu_count()
+        with ProcessPoolExecutor(jobs) as executor:
+            running = {}
+            while queue or running:
+                while queue:
+                    file, parent = queue.popleft()
+                    future = executor.submit(_unpack_file, (file, delete_empty_files))
+                    running[future] = (file, parent)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    process_result(*running.pop(future), future.result())
+
+    if manifest_file is not None:
+        with open(manifest_file, 'w') as outf:
+            outf.write('File\tSize\tSource\n')
+            for file, size, parent in sorted(manifest, key=lambda x: numerical_sort(x[0])):
+                outf.write('%s\t%d\t%s\n' % (file, size, parent))
 
     # Delete all empty subdirectories.
     for f in sorted(glob.glob(os.path.join(dir_to_search, '**', '*'), recursive=True), reverse=True):
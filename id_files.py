@@ -12,22 +12,14 @@ from copy import deepcopy
 import fnmatch
 import os
 from pathlib import PurePath
+import bpe
 from config_handler import numerical_sort, write_file_list
+from disc_image import DiscImage
+import mrg
 import re
-
-END_DLG_FLAG = re.compile(b'[\x00-\xff][\x00-\x05]\xff\xa0[\x00-\x26]\x00')
-# BPE and MRG searching won't work on an unpacked folder as these are never
-# base files, and get deleted in the unpacking process.
-FILETYPE_DICT = {'BPE': re.compile(b'^[\x00-\xff]{4}BPE\x1a'),
-                 'CLUT': re.compile(b'\x12\x00{3}'),
-                 'DEFF': re.compile(b'^DEFF'),
-                 'MCQ': re.compile(b'^MCQ'),
-                 'MRG': re.compile(b'^MRG\x1a'),
-                 'PXL': re.compile(b'^\x11\x00{3}'),
-                 'TIM': re.compile(b'^\x10\x00{3}'),
-                 'TMD': re.compile(b'\x41\x00{3}'),
-                 'LMB': re.compile(b'\x43\x4d\x42'),
-                 'TEXT': END_DLG_FLAG}
+from structure_index import END_DLG_FLAG, FILETYPE_DICT, FULL_FILE_TYPES, \
+    get_default_index
+from virtual_files import SECTOR_PADDED_FILES
 
 
 def build_index(dir_to_index, output_file=None):
@@ -146,8 +138,71 @@ def build_index(dir_to_index, output_file=None):
                     print()
 
 
+def _unpacked_files(file_name, data, sector_padding=False):
+    """
+    Yields the name and contents of each bottom-level file within data,
+    named as unpack_all() in game_file_handler would leave them on disk.
+    """
+
+    stem = os.path.splitext(file_name)[0]
+    basename = os.path.basename(stem)
+    output_dir = '_'.join((stem, 'dir'))
+    if mrg.is_mrg(data):
+        try:
+            archive = mrg.MRGArchive(data, sector_padding, file_name)
+        except ValueError:
+            yield file_name, data
+            return
+        with archive:
+            for num, subfile in enumerate(archive, 1):
+                with subfile:
+                    yield from _unpacked_files(os.path.join(
+                        output_dir, ''.join((basename, '_', str(num), '.bin'))), subfile)
+    elif mrg.is_bpe(data):
+        try:
+            decompressed_data, meta = bpe.decompress(data)
+        except ValueError as e:
+            print('Decompress: %s' % e)
+            print('Decompress: Skipping file')
+            return
+        yield from _unpacked_files(os.path.join(output_dir, ''.join(
+            (basename, '_{0-', str(meta.end_block), '}',
+             os.path.splitext(file_name)[1]))), decompressed_data)
+    else:
+        yield file_name, data
+
+
+def _disc_files(dir_to_search, disc_images):
+    """
+    Yields the name and contents of each bottom-level file in the SECT
+    folder of each disc image, as if the disc's files had been unpacked to
+    dir_to_search/<disc>.
+    """
+
+    for disc, disc_image in disc_images.items():
+        try:
+            image = DiscImage(disc_image)
+        except FileNotFoundError:
+            print('%s not found' % disc_image)
+            continue
+        except ValueError as e:
+            print(e)
+            continue
+
+        try:
+            game_files = sorted((x for x in image.files if x.startswith('SECT/')),
+                                key=numerical_sort)
+            for game_file in game_files:
+                with image.view_file(game_file) as data:
+                    yield from _unpacked_files(
+                        os.path.join(dir_to_search, disc, *game_file.split('/')), data,
+                        bool(SECTOR_PADDED_FILES.search(game_file)))
+        finally:
+            image.close()
+
+
 def id_file_type(dir_to_search, file_type=None, header_pattern=None,
-                 output_file=None):
+                 output_file=None, disc_images=None):
     """
     Identifies files of given type by header or byte pattern.
     File types can be defined by either file type or byte pattern. Only
@@ -158,8 +213,14 @@ def id_file_type(dir_to_search, file_type=None, header_pattern=None,
     unpacked using the unpack_all() function in game_file_handler only, due
     to the removal of non-bottom-level files. Not doing so could result in
     inappropriately set is_patch_target flags on some files.
+
+    If disc images are given, their files are unpacked in memory instead,
+    and searched as if they had been unpacked to dir_to_search with
+    unpack_all(). Nothing is written to disk.
+
     dir_to_search : str
-        Name of root directory to search
+        Name of root directory to search, or that disc files are named
+        relative to if disc images are given
     file_type : str
         Type of file to search for; should be one of the listed known types
         (default: None)
@@ -169,9 +230,12 @@ def id_file_type(dir_to_search, file_type=None, header_pattern=None,
     output : str
         Name of file list text file to output results to
         (default: None [will print to console])
+    disc_images : dict
+        Dict of disc names (e.g. 'Disc 1') and the disc images to search
+        (default: None [search files in dir_to_search])
     """
 
-    if not os.path.isdir(dir_to_search):
+    if disc_images is None and not os.path.isdir(dir_to_search):
         print('%s not found' % dir_to_search)
         return
 
@@ -195,35 +259,56 @@ def id_file_type(dir_to_search, file_type=None, header_pattern=None,
         return
 
     # List out all files in directory being searched and loop through them.
-    file_list = []
-    for r, dn, fn in os.walk(dir_to_search):
-        for f in fnmatch.filter(fn, '*.bin'):
-            file_list.append(os.path.join(r, f))
-    file_list.sort(key=numerical_sort)
+    # Files on disc images are read as they are unpacked, so their total
+    # is not known in advance.
+    if disc_images is not None:
+        file_list = _disc_files(dir_to_search, disc_images)
+        total_files = None
+    else:
+        file_list = []
+        for r, dn, fn in os.walk(dir_to_search):
+            for f in fnmatch.filter(fn, '*.bin'):
+                file_list.append((os.path.join(r, f), None))
+        file_list.sort(key=lambda x: numerical_sort(x[0]))
+        total_files = len(file_list)
 
     output_dict = OrderedDict()
     disc = None
     files_searched = 0
-    total_files = len(file_list)
-    update_percent = max(1, total_files // 250)
-    print('Searching: 0%', end='\r')
+    update_percent = max(1, total_files // 250) if total_files is not None else 250
+    print('Searching: 0%' if total_files is not None else 'Searching: 0 files', end='\r')
 
-    for index, file in enumerate(file_list):
+    structure_index = get_default_index() \
+        if file_type is not None and disc_images is None else None
+    for file, file_data in file_list:
         found_match = False
         sect_index = None
 
-        # Read necessary data
-        with open(file, 'rb') as f:
-            # If file_type is TEXT, search for the end token pattern through
-            # the full file. Otherwise, just read the first 16 bytes to match
-            # the header.
-            if file_type == 'TEXT' or file_type == 'LMB':
-                data = f.read()
-            else:
-                data = f.read(16)
+        # Read necessary data. If the structure index is in use, the types
+        # the file matches are read from it instead. Files not yet in the
+        # index are only indexed for types matched through the whole file,
+        # as other types only need the header read.
+        file_types = None
+        if structure_index is not None:
+            file_types = structure_index.file_types(
+                file, index_missing=file_type in FULL_FILE_TYPES)
+        if file_data is not None:
+            data = bytes(file_data) if file_type == 'TEXT' or file_type == 'LMB' \
+                else bytes(file_data[:16])
+        elif file_types is None:
+            with open(file, 'rb') as f:
+                # If file_type is TEXT, search for the end token pattern
+                # through the full file. Otherwise, just read the first 16
+                # bytes to match the header.
+                if file_type == 'TEXT' or file_type == 'LMB':
+                    data = f.read()
+                else:
+                    data = f.read(16)
 
         # Search for pattern matches
-        if file_type == 'TEXT':
+        if file_types is not None:
+            found_match = file_type in file_types
+        elif file_type == 'TEXT':
             match_list = END_DLG_FLAG.finditer(data)
             for m in match_list:
                 if not m.start(0) % 2:
@@ -292,10 +377,14 @@ def id_file_type(dir_to_search, file_type=None, header_pattern=None,
 
         files_searched += 1
         if files_searched % update_percent == 0:
-            print('Searching: %.1f%%' % round(
-                files_searched / total_files * 100, 1), end='\r')
+            if total_files is not None:
+                print('Searching: %.1f%%' % round(
+                    files_searched / total_files * 100, 1), end='\r')
+            else:
+                print('Searching: %d files' % files_searched, end='\r')
 
-    print('Searching: 100%  \n')
+    print('Searching: 100%  \n' if total_files is not None
+          else 'Searching: %d files\n' % files_searched)
 
     # Sort output_dict in numerical sorting order.
     for disc, disc_val in deepcopy(output_dict).items():
@@ -15,13 +15,14 @@ import sys
 import traceback
 from config_handler import read_config, config_setup, read_file_list, \
     update_file_list  # , _merge_dicts
-from disc_handler import backup_file, cdpatch, psxmode
+from disc_handler import backup_file, cdpatch, psxmode, set_backup_store
 from game_file_handler import extract_files, extract_all_from_list, insert_files,\
     insert_all_from_list, file_swap, swap_all_from_list, run_decompression,\
-    run_compression, unpack_all
+    run_compression, unpack_all, plan_compression, plan_all_from_list
 from hidden_print import HiddenPrints
 from id_files import id_file_type, build_index
 from mod_handler import update_mod_list, create_patches, install_mods
+from structure_index import set_default_index
 from text_handler import dump_text, dump_all, insert_text, insert_all
 
 
@@ -154,9 +155,12 @@ def parse_arguments():
         'cdpatch', usage='%(prog)s version [-d disc_list] [-i]',
         description='''Wrapper for Neil Corlett's cdpatch utility. Extracts
         game files that are set to true in config file for game version and
-        disc(s) specified. CDPatch is set to extract mode by default. For 
-        insertion, cdpatch must be used for all XA and IKI files, but will
-        not work for files larger than the original.''', help='''Calls
+        disc(s) specified. CDPatch is set to extract mode by default, which
+        reads the disc image directly without cdpatch.exe. Insert mode
+        still calls cdpatch.exe, which writes files over the originals in
+        place and will not work for files larger than the original. It is
+        kept for use with cdpatch.exe; use psxmode to insert files,
+        including XA and IKI files.''', help='''Calls
         cdpatch executable on discs listed''')
 
     # Positional argument
@@ -177,11 +181,12 @@ def parse_arguments():
     # Create subparser for psxmode command.
     parser_ps = subparsers.add_parser(
         'psxmode', usage='%(prog)s version [-d disc_list]',
-        description='''Wrapper for CUE's psx-mode2 utility. Inserts game
+        description='''Replacement for CUE's psx-mode2 utility. Inserts game
         files that are set to true in config file for game version and
-        disc(s) specified. Works for files larger than the original, 
-        but will not insert XA and IKI files correctly.''', help='''Calls
-        psx-mode2 on discs listed''')
+        disc(s) specified. Works for files larger than the original, which
+        are moved to the end of the disc. XA and IKI files are inserted as
+        extracted, without regenerating EDC/ECC data.''', help='''Inserts
+        files into discs listed''')
 
     # Positional arguments
     parser_ps.add_argument('version', help='Game version to insert files into')
@@ -197,7 +202,8 @@ def parse_arguments():
     # Create subparser for decompress command.
     parser_dc = subparsers.add_parser(
         'decompress',
-        usage='%(prog)s compressed_file [-s start_block] [-e end_block] [-b]',
+        usage='%(prog)s compressed_file [-s start_block] [-e end_block] [-b] '
+              '[-w workers]',
         description='''Decompresses BPE-compressed files. Can optionally
         decompress specified   blocks only within range [start_block, 
         end_block).''', help='''Decompress BPE file''')
@@ -217,12 +223,17 @@ def parse_arguments():
                            dest='is_subfile', help='''Indicate that compressed
                            file is contained within another file 
                            (default: False)''')
+    parser_dc.add_argument('-w', '--workers', dest='workers', type=int,
+                           default=1, metavar='', help='''Number of processes
+                           to decompress blocks with; 0 uses all CPUs
+                           (default: 1)''')
     parser_dc.set_defaults(run_decompression=run_decompression)
 
     # Create subparser for compress command.
     parser_c = subparsers.add_parser(
         'compress',
-        usage='%(prog)s decompressed_file [-m] [-b] [-a max_attempts] [-d]',
+        usage='%(prog)s decompressed_file [-m] [-b] [-d] '
+              '[--backend backend] [--dry-run]',
         description='''BPE-compresses files. If only a set of blocks was
         decompressed, inserts compressed block into compressed file.''',
         help='''BPE-compress file''')
@@ -239,15 +250,20 @@ def parse_arguments():
                           help='''Indicates file should be compressed to the
                           same size or smaller for mod compatibility (default:
                           False)''')
-    parser_c.add_argument('-a', '--attempts', dest='max_attempts', type=int,
-                          metavar='', default=100, help='''Maximum number of 
-                          attempts to compress file if -b or -m have been used
-                          (default: 100)''')
     parser_c.add_argument('-d', '--delete', action='store_true',
                           dest='delete_decompressed', help='''Indicate whether
                           to delete decompressed file after compression
                           (default: False)''')
-    parser_c.set_defaults(run_compression=run_compression)
+    parser_c.add_argument('--backend', dest='backend', default='python',
+                          choices=['python', 'numpy'], metavar='',
+                          help='''Backend used to compress blocks, python or
+                          numpy (requires NumPy) (default: python)''')
+    parser_c.add_argument('--dry-run', action='store_true', dest='dry_run',
+                          help='''Compress in memory only and report the size
+                          of each block compared to the original, without
+                          writing any files (default: False)''')
+    parser_c.set_defaults(run_compression=run_compression,
+                          plan_compression=plan_compression)
 
     # create subparser for buildindex command
     parser_bi = subparsers.add_parser(
@@ -271,7 +287,8 @@ def parse_arguments():
     # create subparser for idfiles command
     parser_id = subparsers.add_parser('idfiles',
                                       usage='%(prog)s dir_to_search [-t file_type]'
-                                            '[-p header_pattern] [-o output_file]',
+                                            '[-p header_pattern] [-o output_file] '
+                                            '[-v game_version]',
                                       description='''Identifies all files that 
                                       contain the header type or hex pattern
                                       specified and outputs the file list to 
@@ -280,7 +297,11 @@ def parse_arguments():
                                       MCQ, MRG, PXL, TIM, TMD, and TEXT. 
                                       header_pattern should only be used if
                                       file_type is set to None (i.e. the file type
-                                      is not known for certain yet).''',
+                                      is not known for certain yet). If a game
+                                      version is given, the files on its disc
+                                      images are unpacked in memory and searched
+                                      instead, named as if they had been unpacked
+                                      to dir_to_search.''',
                                       help='''Find files containing specified 
                                       header or byte pattern.''')
 
@@ -297,6 +318,9 @@ def parse_arguments():
     parser_id.add_argument('-o', '--out', dest='output_file', default=None,
                            metavar='', help='''Specify output file for text
                            locations (prints to console by default)''')
+    parser_id.add_argument('-v', '--version', dest='version', default=None,
+                           metavar='', help='''Game version as specified in config
+                           to search the disc images of (default: None)''')
     parser_id.set_defaults(id_file_type=id_file_type)
 
     # Create subparser for exfiles command.
@@ -352,15 +376,16 @@ def parse_arguments():
 
     # Create subparser for exfromlist command.
     parser_el = subparsers.add_parser(
-        'exfromlist', usage='%(prog)s game_version [-c file_category]',
+        'exfromlist', usage='%(prog)s game_version [-c file_category] [-j jobs] [-d]',
         description='''Takes a text file listing files to extract (as
         generated by findhex or finddlg) and extracts or decompresses
         each file on the list. For each source file in the text file, 
         specify whether file uses sector padding (e.g. DRGN2x.BIN). The
         sector padding flag when set to true doubles as the subfile flag
         for BPE decompression. Use category option with 'swap' or '
-        patch' to insert specific category of files only. Calls exfiles;
-        see exfiles help for more details''', help='''Extract component
+        patch' to insert specific category of files only. With the disc
+        option, files that have not been extracted are read straight from
+        the disc images. Calls exfiles; see exfiles help for more details''', help='''Extract component
         files/decompress from all MRG/BPE files listed in input text
         file''')
 
@@ -372,11 +397,19 @@ def parse_arguments():
         '-c', '--category', dest='file_category', default='all', metavar='',
         help='''Category of files to extract from list file (default: extract
         all files)''')
+    parser_el.add_argument(
+        '-j', '--jobs', dest='jobs', type=int, default=1, metavar='',
+        help='''Number of processes to decompress BPE files with; 0 uses all
+        CPUs (default: 1)''')
+    parser_el.add_argument(
+        '-d', '--disc', action='store_true', dest='from_disc',
+        help='''Read files that have not been extracted from the disc
+        images''')
     parser_el.set_defaults(extract_all_from_list=extract_all_from_list)
 
     # Create subparser for infromlist command.
     parser_il = subparsers.add_parser(
-        'infromlist', usage='%(prog)s game_version [-c file_category] [-d]',
+        'infromlist', usage='%(prog)s game_version [-c file_category] [-d] [--dry-run]',
         description='''Takes a text file listing files to insert (as generated
         by findhex or finddlg) and inserts or compresses each file on the list.
         For each  source file in the text file, specify whether file uses
@@ -399,11 +432,16 @@ def parse_arguments():
                            dest='del_component_folders', help='''Indicate whether
                            to delete folders containing files that were inserted
                            (default: False)''')
-    parser_il.set_defaults(insert_all_from_list=insert_all_from_list)
+    parser_il.add_argument('--dry-run', action='store_true', dest='dry_run',
+                           help='''Only report whether each BPE file on the list
+                           compresses to its original size, without inserting or
+                           writing any files (default: False)''')
+    parser_il.set_defaults(insert_all_from_list=insert_all_from_list,
+                           plan_all_from_list=plan_all_from_list)
 
     # Create subparser for unpack command.
     parser_u = subparsers.add_parser(
-        'unpack', usage='%(prog)s source_file [-p] [-d]', description='''Disassembles
+        'unpack', usage='%(prog)s source_file [-p] [-d] [-j jobs] [-m manifest_file]', description='''Disassembles
         the given MRG source file into its bottom-level component files.
         This function also deletes all intermediary files, so that the 
         created folder can be used with the id_file_type function to
@@ -423,6 +461,12 @@ def parse_arguments():
                           dest='delete_empty_files', help='''Indicate 
                           whether to delete files less than 8 bytes
                           long (default: False)''')
+    parser_u.add_argument('-j', '--jobs', type=int, default=1, dest='jobs',
+                          help='''Number of processes to unpack files
+                          with; 0 uses all CPUs (default: 1)''')
+    parser_u.add_argument('-m', '--manifest', dest='manifest_file',
+                          help='''Text file to list all unpacked files
+                          in (default: None)''')
     parser_u.set_defaults(unpack_all=unpack_all)
 
     # Create subparser for swap command.
@@ -500,7 +544,7 @@ def parse_arguments():
     # create subparser for dumpall command
     parser_da = subparsers.add_parser('dumpall',
                                       usage='%(prog)s game_version [-f script_folder] '
-                                      '[-c csv_file]',
+                                      '[-c csv_file] [-d]',
                                       description='''Takes text file containing
                                       a list of asset files (as generated by
                                       the idfiles command) and dumps the text
@@ -519,7 +563,9 @@ def parse_arguments():
                                       value indicating whether the file is . If desired,
                                       script files can be merged into a CSV file,
                                       which may be edited and used to generate
-                                      new script files.''',
+                                      new script files. With the disc option,
+                                      files that have not been extracted are
+                                      read straight from the disc images.''',
                                       help='''Dump script from all files
                                       listed in input text file''')
 
@@ -532,6 +578,9 @@ def parse_arguments():
                            default=None, metavar='',
                            help='''Output folder for dumped scripts (default: 
                            @Scripts under [Modding Directories])''')
+    parser_da.add_argument('-d', '--disc', action='store_true', dest='from_disc',
+                           help='''Read files that have not been extracted
+                           from the disc images''')
     parser_da.set_defaults(dump_all=dump_all)
 
     # create subparser for insert command
@@ -656,6 +705,9 @@ if __name__ == '__main__':
         args = parse_arguments()
         config_dict = read_config(args.config_file)
         game_files_dir = config_dict['[Modding Directories]']['Game Files']
+        block_cache_dir = config_dict['[Modding Directories]'].get('Block Cache')
+        set_default_index(config_dict['[Modding Directories]'].get('Structure Index'))
+        set_backup_store(config_dict['[Modding Directories]'].get('Backup Store'))
         scripts_dir = config_dict['[Modding Directories]']['Scripts']
         patch_dir = config_dict['[Modding Directories]']['Patches']
         patch_list = []
@@ -735,11 +787,17 @@ if __name__ == '__main__':
             args.psxmode(disc_dict)  # , args.backup)
         elif args.func == 'decompress':
             args.run_decompression(args.compressed_file, args.start_block,
-                                   args.end_block, args.is_subfile)
+                                   args.end_block, args.is_subfile, args.workers)
+        elif args.func == 'compress' and args.dry_run:
+            plan = args.plan_compression(args.decompressed_file, args.mod_mode,
+                                         args.is_subfile, args.backend, block_cache_dir)
+            if plan is not None:
+                plan.print_report()
         elif args.func == 'compress':
             args.run_compression(args.decompressed_file, args.mod_mode,
-                                 args.is_subfile, args.max_attempts,
-                                 args.delete_decompressed)
+                                 args.is_subfile,
+                                 delete_decompressed=args.delete_decompressed,
+                                 backend=args.backend, block_cache_dir=block_cache_dir)
         elif args.func == 'exfiles':
             args.files_to_extract = [[x] for x in args.files_to_extract]
             args.extract_files(args.file, args.use_sector_padding, args.files_to_extract)
@@ -750,7 +808,8 @@ if __name__ == '__main__':
             disc_dict = _build_disc_dict(config_dict, args.version, disc_list, scripts_dir,
                                          game_files_dir)
             args.file_category = ''.join(('[', args.file_category.upper(), ']'))
-            args.extract_all_from_list(file, disc_dict, args.file_category)
+            args.extract_all_from_list(file, disc_dict, args.file_category, args.jobs,
+                                       args.from_disc)
         elif args.func == 'infiles':
             args.files_to_insert = [[x] for x in args.files_to_insert]
             args.insert_files(args.file, args.use_sector_padding, args.files_to_insert,
@@ -762,10 +821,15 @@ if __name__ == '__main__':
             disc_dict = _build_disc_dict(config_dict, args.version, disc_list, scripts_dir,
                                          game_files_dir)
             args.file_category = ''.join(('[', args.file_category.upper(), ']'))
-            args.insert_all_from_list(file, disc_dict, args.file_category,
-                                      args.del_component_folders)
+            if args.dry_run:
+                args.plan_all_from_list(file, disc_dict, args.file_category,
+                                        block_cache_dir=block_cache_dir)
+            else:
+                args.insert_all_from_list(file, disc_dict, args.file_category,
+                                          args.del_component_folders, block_cache_dir)
         elif args.func == 'unpack':
-            args.unpack_all(args.source_file, args.sector_padded, args.delete_empty_files)
+            args.unpack_all(args.source_file, args.sector_padded, args.delete_empty_files,
+                            args.jobs, args.manifest_file)
         elif args.func == 'swap':
             args.file_swap(args.src_file, args.dest_file)
         elif args.func == 'swapall':
@@ -781,8 +845,16 @@ if __name__ == '__main__':
         elif args.func == 'buildindex':
             args.build_index(args.dir_to_index, args.output_file)
         elif args.func == 'idfiles':
+            disc_images = None
+            if args.version is not None:
+                args.version = args.version.upper()
+                disc_images = {
+                    disc: os.path.join(config_dict['[Game Directories]'][args.version],
+                                       disc_val[0])
+                    for disc, disc_val in config_dict['[Game Discs]'][args.version].items()
+                    if disc != 'All Discs' and disc_val[0] != ''}
             args.id_file_type(args.dir_to_search, args.file_type,
-                              args.header_pattern, args.output_file)
+                              args.header_pattern, args.output_file, disc_images)
         elif args.func == 'dump':
             scripts_folder = os.path.split(args.csv_file)[0]
             scripts_folder = scripts_folder if scripts_folder else '.'
@@ -804,7 +876,7 @@ if __name__ == '__main__':
             disc_list = list(config_dict['[Game Discs]'][args.version].keys())
             disc_dict = _build_disc_dict(config_dict, args.version, disc_list, args.script_folder, 
                                          game_files_dir)
-            args.dump_all(file, disc_dict)
+            args.dump_all(file, disc_dict, args.from_disc)
         elif args.func == 'insert':
             ptr_tbl_starts = [int(x, 16) for x in args.ptr_tbl_starts.split(',')]
             ptr_tbl_ends = [int(x, 16) for x in args.ptr_tbl_ends.split(',')]
@@ -883,7 +955,7 @@ if __name__ == '__main__':
                               'using a mod that swaps files.')
                         sys.exit(0)
 
-                install_mods(list_file, disc_dict_pair, deepcopy(patch_list))
+                install_mods(list_file, disc_dict_pair, deepcopy(patch_list), block_cache_dir)
 
                 try:
                     shutil.rmtree(game_files_dir)
@@ -901,7 +973,6 @@ if __name__ == '__main__':
                     for p in patch_list:
                         backup = '.'.join((p, 'orig'))
                         if block_range_pattern.search(p) and os.path.exists(backup):
-                            backup_file(p, True)
-                            os.remove(backup)
+                            backup_file(p, True, remove_backup=True)
     except KeyboardInterrupt:
         print('\n')
@@ -16,10 +16,11 @@ import sys
 import traceback
 from config_handler import read_config, numerical_sort, read_file_list, update_config, config_setup, \
     update_file_list
-from disc_handler import backup_file, cdpatch, psxmode, _def_path
+from disc_handler import backup_file, cdpatch, psxmode, set_backup_store, _def_path
 from game_file_handler import extract_all_from_list, insert_all_from_list, swap_all_from_list, \
-    process_block_range
+    process_block_range, shutdown_compression_pool
 from hidden_print import HiddenPrints
+from structure_index import set_default_index
 
 colorama.init()
 BLOCKSIZE_PATTERN = re.compile(b'([\x00-\xff][\x00-\\x08]\x00\x00)')
@@ -202,7 +203,7 @@ def create_patches(list_file, game_files_dir, patch_dir, disc_dict):
     print(ERASE + 'Patcher: Patch creation successful\n')
 
 
-def install_mods(list_file, disc_dict_pair, patch_list):
+def install_mods(list_file, disc_dict_pair, patch_list, block_cache_dir=None):
     """
     Applies mods to listed files.
 
@@ -220,6 +221,8 @@ def install_mods(list_file, disc_dict_pair, patch_list):
         Pair of disc dicts (one each for dst and src).
     patch_list : str list
         List of file names of patches to apply.
+    block_cache_dir : str
+        Directory of the compressed block cache. (default: None)
     """
 
     dest_dict = disc_dict_pair[0]
@@ -328,8 +331,7 @@ def install_mods(list_file, disc_dict_pair, patch_list):
                 os.remove(file_val[1])
 
                 if file_val[0] is not None:
-                    shutil.copy('.'.join((patch_file, 'orig')), patch_file)
-                    os.remove('.'.join((patch_file, 'orig')))
+                    backup_file(patch_file, True, True, True)
 
                 print(f'LODModS: {patches_applied:d}/{total_files:d} files patched',
                       end='\r')
@@ -341,29 +343,11 @@ def install_mods(list_file, disc_dict_pair, patch_list):
 
     print('\nLODModS: Inserting subfiles into files')
     with HiddenPrints():
-        insert_all_from_list(list_file, dest_dict)
+        insert_all_from_list(list_file, dest_dict, block_cache_dir=block_cache_dir)
+    shutdown_compression_pool()
     print('LODModS: Subfiles inserted')
 
-    print('\nLODModS: Inserting files into discs (may take several minutes)')
-    cdpatch_dict = deepcopy(dest_dict)
-    for disc, disc_val in cdpatch_dict.items():
-        for key in list(disc_val[1][1].keys()):
-            if 'XA' not in key and 'IKI' not in key:
-                del cdpatch_dict[disc][1][1][key]
-            else:
-                del dest_dict[disc][1][1][key]
-
-    if cdpatch_dict:
-        cdpatch_dict_all = {k: v for k, v in cdpatch_dict.items() if k == 'All Discs'}
-        if cdpatch_dict_all:
-            for disc in ('Disc 1', 'Disc 2', 'Disc 3', 'Disc 4'):
-                disc_path = cdpatch_dict_all['All Discs'][0]
-                cdpatch_dict_all[disc] = [
-                    disc_path, [cdpatch_dict_all['All Discs'][1][0], {}], '']
-        cdpatch_dict_indiv = {k: v for k, v in cdpatch_dict.items() if k != 'All Discs'}
-
-        cdpatch(cdpatch_dict_all, '-i', True)
-        cdpatch(cdpatch_dict_indiv, '-i', True)
+    print('\nLODModS: Inserting files into discs')
     psxmode(dest_dict, False, True)
     print(MOVE_CURSOR + ERASE + 'LODModS: Inserting files into discs\n'
                                 'LODModS: Files inserted\n')
@@ -395,6 +379,9 @@ def main():
 
         list_file = config_dict['[File Lists]'][version]
         game_files_dir = config_dict['[Modding Directories]']['Game Files']
+        block_cache_dir = config_dict['[Modding Directories]'].get('Block Cache')
+        set_default_index(config_dict['[Modding Directories]'].get('Structure Index'))
+        set_backup_store(config_dict['[Modding Directories]'].get('Backup Store'))
 
         mods_found = update_mod_list('lodmods.config', config_dict, swap)
         if not mods_found:
@@ -435,7 +422,7 @@ def main():
                   'using a mod that swaps files.')
             sys.exit(0)
 
-        install_mods(list_file, disc_dict_pair, deepcopy(patch_list))
+        install_mods(list_file, disc_dict_pair, deepcopy(patch_list), block_cache_dir)
 
         try:
             shutil.rmtree(game_files_dir)
@@ -453,8 +440,7 @@ def main():
             for p in patch_list:
                 backup = '.'.join((p, 'orig'))
                 if block_range_pattern.search(p) and os.path.exists(backup):
-                    backup_file(p, True)
-                    os.remove(backup)
+                    backup_file(p, True, remove_backup=True)
 
         input('\nPress ENTER to exit')
 
@@ -0,0 +1,660 @@
+"""
+Provides access to LoD's MRG archives without copying their contents.
+
+MRG files (DRGN0.BIN, DRGN1.BIN, DRGN2x.BIN and many of their subfiles) are
+made up of an 8-byte header (b'MRG\\x1a' and the 4-byte number of files),
+followed by a logical block addressing (LBA) table of 8-byte entries giving
+the offset and size of each file. In sector-padded MRG files (e.g. DRGN2x.BIN)
+the offsets are sector numbers, which are multiplied by 0x800 to get the
+actual offsets.
+
+MRGArchive maps the archive into memory and parses the LBA table once. Each
+file is returned as a memoryview of the mapped archive, and nested MRG and
+BPE subfiles can be opened in place, so no file contents are copied until
+they are written somewhere. MRGWriter streams a rebuilt archive to a temp
+file that replaces the original once it is complete.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+import io
+import mmap
+import os
+import struct
+import bpe
+from disc_handler import copy_range, open_replacement
+
+MRG_MAGIC = b'MRG\x1a'
+SECTOR_SIZE = 0x800
+
+
+def is_mrg(buf):
+    """
+    Checks whether a buffer starts with an MRG header.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer to check.
+
+    Returns
+    -------
+    bool
+        True if the buffer is an MRG file.
+    """
+
+    return bytes(buf[:4]) == MRG_MAGIC
+
+
+def is_bpe(buf):
+    """
+    Checks whether a buffer starts with a BPE header.
+
+    Parameters
+    ----------
+    buf : bytes-like
+        Buffer to check.
+
+    Returns
+    -------
+    bool
+        True if the buffer is a BPE file.
+    """
+
+    return bytes(buf[4:8]) == bpe.BPE_MAGIC
+
+
+class MRGArchive:
+    """
+    A class for reading the files contained in an MRG file.
+
+    Files are numbered from 1, in order of their offsets within the
+    archive, as with the extraction and insertion functions in
+    game_file_handler. File 0 is the header and LBA table. Indexing the
+    archive returns a memoryview of a file, and iterating over it returns
+    a memoryview of each of files 1 to len(archive) in turn.
+
+    An archive made from a file name maps the file into memory, and must
+    be closed (or used in a with statement) once it is no longer needed.
+    Memoryviews of its files must be released before it is closed.
+
+    Functions
+    ---------
+    file_range()
+        Returns the offset and size of a file in the archive.
+    open()
+        Returns an MRG subfile as an MRGArchive.
+    decompress()
+        Decompresses a BPE subfile.
+    file_type()
+        Returns whether a subfile is an MRG or BPE file.
+    plan_insertion()
+        Plans the insertion of files into the archive.
+    rebuild()
+        Returns the archive with some of its files replaced.
+    close()
+        Releases the archive's memory map.
+
+    Attributes
+    ----------
+    name : str
+        Name of the archive, used in messages.
+    size : int
+        Size of the MRG file.
+    sector_padding : bool
+        Value stating whether the MRG file uses '0x8c' sector padding.
+    num_files : int
+        Number of files contained in MRG file (excludes LBA); defined by
+        second 4-byte word header.
+    lba_table_len : int
+        Length of the LBA table; equal to num_files * 8
+    ptr_locs : int list
+        List containing offsets of all 8-byte entries in LBA table.
+    file_locs : int list
+        List containing offsets of all files in MRG.
+    file_sizes : int list
+        List containing sizes of all files in MRG.
+    """
+
+    def __init__(self, source, sector_padding=False, name=None):
+        """
+        Parameters
+        ----------
+        source : str or bytes-like
+            Name of MRG file to map into memory, or a buffer containing an
+            MRG file (e.g. a file of a parent archive).
+        sector_padding : bool
+            Value stating whether the MRG file uses '0x8c' sector padding.
+            (default: False)
+        name : str
+            Name of the archive. Defaults to the file name, if any.
+
+        Raises
+        ------
+        ValueError
+            If the source is not an MRG file.
+        """
+
+        self._mmap = None
+        if isinstance(source, str):
+            self.name = source if name is None else name
+            with open(source, 'rb') as f:
+                try:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:  # Empty files cannot be mapped.
+                    raise ValueError('%s is not a MRG file' % source)
+            self._view = memoryview(self._mmap)
+        else:
+            self.name = '<buffer>' if name is None else name
+            self._view = memoryview(source).cast('B')
+
+        if len(self._view) < 8 or not is_mrg(self._view):
+            self.close()
+            raise ValueError('%s is not a MRG file' % self.name)
+
+        self.size = len(self._view)
+        self._sector_padding = sector_padding
+        self.num_files = int.from_bytes(self._view[4:8], 'little')
+        self.lba_table_len = self.num_files * 0x08
+        if self.lba_table_len + 8 > len(self._view):
+            self.close()
+            raise ValueError('%s has a truncated LBA table' % self.name)
+
+        multiplier = SECTOR_SIZE if sector_padding else 1
+        entries = [(loc * multiplier, size, 8 + i * 8) for i, (loc, size) in
+                   enumerate(struct.iter_unpack('<2I', self._view[8:8+self.lba_table_len]))]
+        entries.sort(key=lambda x: x[:2])
+        self.file_locs = [x[0] for x in entries]
+        self.file_sizes = [x[1] for x in entries]
+        self.ptr_locs = [x[2] for x in entries]
+
+    @property
+    def sector_padding(self):
+        return self._sector_padding
+
+    def __len__(self):
+        return self.num_files
+
+    def __getitem__(self, file_num):
+        loc, size = self.file_range(file_num)
+        return self._view[loc:loc+size]
+
+    def __iter__(self):
+        for file_num in range(1, self.num_files + 1):
+            yield self[file_num]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _subfile_name(self, file_num):
+        return '%s/%d' % (self.name, file_num)
+
+    def file_range(self, file_num):
+        """
+        Returns the offset and size of a file in the archive.
+
+        Parameters
+        ----------
+        file_num : int
+            Number of file. File 0 is the header and LBA table.
+
+        Returns
+        -------
+        tuple
+            Offset and size of file.
+
+        Raises
+        ------
+        IndexError
+            If the archive does not contain the file.
+        """
+
+        if file_num == 0:
+            return 0, self.lba_table_len + 8
+        elif not 0 < file_num <= self.num_files:
+            raise IndexError('File %d does not exist. %s contains %d files' %
+                             (file_num, self.name, self.num_files))
+
+        return self.file_locs[file_num-1], self.file_sizes[file_num-1]
+
+    def file_type(self, file_num):
+        """
+        Returns whether a subfile is an MRG or BPE file.
+
+        Parameters
+        ----------
+        file_num : int
+            Number of the subfile.
+
+        Returns
+        -------
+        str
+            'MRG', 'BPE', or None if the subfile is neither.
+        """
+
+        header = bytes(self[file_num][:8])
+        if is_mrg(header):
+            return 'MRG'
+        elif is_bpe(header):
+            return 'BPE'
+        return None
+
+    def open(self, file_num, sector_padding=False):
+        """
+        Returns an MRG subfile as an MRGArchive.
+
+        The subfile archive reads from this archive's memory, so it remains
+        valid only until this archive is closed.
+
+        Parameters
+        ----------
+        file_num : int
+            Number of the subfile.
+        sector_padding : bool
+            Value stating whether the subfile uses '0x8c' sector padding.
+            (default: False)
+
+        Returns
+        -------
+        MRGArchive
+            Subfile archive.
+
+        Raises
+        ------
+        ValueError
+            If the subfile is not an MRG file.
+        """
+
+        return MRGArchive(self[file_num], sector_padding, self._subfile_name(file_num))
+
+    def decompress(self, file_num, start_block=0, end_block=512, is_subfile=False):
+        """
+        Decompresses a BPE subfile using bpe.decompress().
+
+        Parameters
+        ----------
+        file_num : int
+            Number of the subfile.
+        start_block : int
+            Data block to start decompression from. (default: 0)
+        end_block : int
+            Data block to decompress up to (non-inclusive). (default: 512)
+        is_subfile : bool
+            Flag indicating whether the subfile is a BPE file, or a non-BPE
+            file that contains BPE-compressed data within its body.
+            (default: False)
+
+        Returns
+        -------
+        (bytes, BlockMeta)
+            Decompressed data and the metadata needed to re-compress it.
+
+        Raises
+        ------
+        ValueError
+            If the subfile is not a BPE file.
+        """
+
+        with self[file_num] as buf:
+            return bpe.decompress(buf, start_block, end_block, is_subfile)
+
+    def plan_insertion(self, new_sizes):
+        """
+        Plans the insertion of files into the archive.
+
+        Parameters
+        ----------
+        new_sizes : dict
+            Sizes of the files being inserted, by file number.
+
+        Returns
+        -------
+        InsertionPlan
+            Layout of the archive after insertion.
+        """
+
+        return InsertionPlan(self, new_sizes)
+
+    def rebuild(self, replacements):
+        """
+        Returns the archive with some of its files replaced.
+
+        The archive is rebuilt in memory by MRGWriter.
+
+        Parameters
+        ----------
+        replacements : dict
+            New contents (bytes-like) of files, by file number.
+
+        Returns
+        -------
+        bytes
+            Contents of the rebuilt archive.
+        """
+
+        output = io.BytesIO()
+        with MRGWriter(self, output) as writer:
+            for file_num in range(1, self.num_files + 1):
+                data = replacements.get(file_num)
+                writer.write_file(self[file_num] if data is None else data)
+
+        return output.getvalue()
+
+    def close(self):
+        """
+        Releases the archive's memory map, if it has one.
+
+        Raises
+        ------
+        BufferError
+            If memoryviews of the archive's files have not been released.
+        """
+
+        self._view.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+
+class MRGWriter:
+    """
+    A class for writing a rebuilt MRG file.
+
+    The header and LBA table are taken from the original archive, and the
+    files are then written in order, each padded with 0x8c to a word
+    boundary (except the last file) or to a sector boundary in sector-padded
+    archives. Entries that point to the same file as the previous entry are
+    kept pointing to the same offset. The LBA table is filled in with the
+    new offsets and sizes once all files are written.
+
+    When writing to a file name, the new archive is written to a temp file
+    that only replaces the file once the writer is closed without error,
+    so a failed rebuild leaves the original archive untouched. The temp
+    file is preallocated if the sizes of the files are known.
+
+    Functions
+    ---------
+    write_file()
+        Writes the next file to the archive.
+    close()
+        Fills in the LBA table and finishes the archive.
+
+    Attributes
+    ----------
+    sector_padding : bool
+        Value stating whether the MRG file uses '0x8c' sector padding.
+    file_locs : int list
+        New offsets of the files written so far, in order.
+    file_sizes : int list
+        New sizes of the files written so far.
+    size : int
+        Size of the archive written so far.
+    """
+
+    def __init__(self, archive, output, file_sizes=None):
+        """
+        Parameters
+        ----------
+        archive : MRGArchive
+            Original archive. Everything needed from it is read here, so it
+            can be closed before the new archive is written.
+        output : str or BufferedWriter
+            Name of the file to replace with the new archive, or a seekable
+            file object to write it to.
+        file_sizes : int list
+            Sizes of all files that will be written, if known, to
+            preallocate the new archive with. (default: None)
+        """
+
+        self.sector_padding = archive.sector_padding
+        self.file_locs = []
+        self.file_sizes = []
+        self._output = output
+        self._orig_locs = list(archive.file_locs)
+        self._ptr_locs = list(archive.ptr_locs)
+
+        # The header and LBA table (plus sector padding) are kept as is.
+        start = archive.lba_table_len + 8
+        if self.sector_padding:
+            start = -(-start // SECTOR_SIZE) * SECTOR_SIZE
+        self._header = bytes(archive._view[:start])
+        self._pos = len(self._header)
+        self.size = self._pos
+
+        self._final_size = None
+        if file_sizes is not None:
+            pos = self._pos
+            locs = []
+            for i, size in enumerate(file_sizes):
+                loc, pos = self._place(i, size, pos, locs)
+                locs.append(loc)
+            self._final_size = max([pos] + [loc + size for loc, size in zip(locs, file_sizes)])
+
+        self._context = None
+        self._outf = None
+
+    def __enter__(self):
+        if isinstance(self._output, str):
+            self._context = open_replacement(self._output)
+            self._outf = self._context.__enter__()
+        else:
+            self._outf = self._output
+
+        if self._final_size is not None and self._context is not None:
+            try:
+                os.posix_fallocate(self._outf.fileno(), 0, self._final_size)
+            except (AttributeError, OSError):
+                pass  # Preallocation is only an optimization.
+        self._outf.write(self._header)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._context is not None:
+            self._context.__exit__(exc_type, exc_value, traceback)
+
+    def _place(self, i, size, pos, locs):
+        """
+        Returns the offset of file i and the offset following it (after
+        padding), given the offset following the previous file.
+        """
+
+        # Duplicate entries overwrite the file they point to.
+        if i and self._orig_locs[i] == self._orig_locs[i-1]:
+            pos = locs[-1]
+        loc = pos
+        pos += size
+        if self.sector_padding and pos % SECTOR_SIZE:
+            pos += SECTOR_SIZE - pos % SECTOR_SIZE
+        elif not self.sector_padding and i != len(self._orig_locs) - 1 and pos % 4:
+            pos += 4 - pos % 4
+
+        return loc, pos
+
+    def write_file(self, source):
+        """
+        Writes the next file to the archive.
+
+        Parameters
+        ----------
+        source : str or bytes-like
+            Name of the file to write, or its contents.
+
+        Raises
+        ------
+        IndexError
+            If all of the archive's files have already been written.
+        """
+
+        i = len(self.file_locs)
+        if i >= len(self._orig_locs):
+            raise IndexError('All %d files have been written' % len(self._orig_locs))
+
+        if isinstance(source, str):
+            size = os.path.getsize(source)
+        else:
+            size = len(source)
+        loc, pos = self._place(i, size, self._pos, self.file_locs)
+
+        self._outf.seek(loc)
+        if isinstance(source, str):
+            with open(source, 'rb') as inf:
+                copy_range(inf, self._outf, 0, size)
+        else:
+            self._outf.write(source)
+        self._outf.write(b'\x8c' * (pos - loc - size))
+
+        self.file_locs.append(loc)
+        self.file_sizes.append(size)
+        self._pos = pos
+        self.size = max(self.size, pos)
+
+    def close(self):
+        """
+        Fills in the LBA table and finishes the archive, replacing the
+        original if writing to a file name.
+
+        Raises
+        ------
+        ValueError
+            If not all of the archive's files have been written.
+        """
+
+        if self._outf is None:
+            return
+        if len(self.file_locs) != len(self._orig_locs):
+            error = ValueError('Only %d of %d files were written' %
+                               (len(self.file_locs), len(self._orig_locs)))
+            if self._context is not None:
+                self._context.__exit__(ValueError, error, None)
+            self._outf = None
+            raise error
+
+        for ptr_loc, loc, size in zip(self._ptr_locs, self.file_locs, self.file_sizes):
+            self._outf.seek(ptr_loc)
+            if self.sector_padding:
+                loc //= SECTOR_SIZE
+            self._outf.write(struct.pack('<2I', loc, size))
+        self._outf.truncate(self.size)
+        self._outf.seek(self.size)
+
+        if self._context is not None:
+            self._context.__exit__(None, None, None)
+        self._outf = None
+
+
+class InsertionPlan:
+    """
+    A class for storing the layout of an MRG file after files are inserted
+    into it individually.
+
+    The layout matches inserting each file in turn, as insert_files() does:
+    a file no larger than its original size (rounded up to a word, or to a
+    sector if the archive is sector-padded) is written over the original,
+    as is the last file. A larger file is written in place and pushes every
+    following file back by the amount it grew. Files are padded with 0x8c
+    as they are when inserted. The whole layout is worked out before any
+    data is written, so the new archive can be written in a single pass.
+
+    Attributes
+    ----------
+    segments : list
+        Tuples (kind, source, offset, length) making up the new archive,
+        where kind is 'copy' (source is an offset in the original archive),
+        'file' (source is the number of an inserted file), or 'pad' (0x8c
+        padding), and offset is the offset to write to.
+    file_locs : int list
+        New offsets of all files, in the same order as the archive's lists.
+    file_sizes : int list
+        New sizes of all files.
+    ptr_locs : int list
+        Offsets of the LBA table entries of all files.
+    size : int
+        Size of the new archive.
+    moves_files : bool
+        Whether any file moves. If not, the inserted files can simply be
+        written over the original archive.
+    """
+
+    def __init__(self, archive, new_sizes):
+        """
+        Parameters
+        ----------
+        archive : MRGArchive
+            Archive that files are being inserted into.
+        new_sizes : dict
+            Sizes of the files being inserted, by file number.
+        """
+
+        self.file_locs = list(archive.file_locs)
+        self.file_sizes = list(archive.file_sizes)
+        self.ptr_locs = list(archive.ptr_locs)
+        self.segments = []
+
+        last_file = archive.num_files
+        alignment = SECTOR_SIZE if archive.sector_padding else 4
+        pos = 0  # Offset in the original archive up to which it is planned.
+        shift = 0  # Amount that the original archive has moved at pos.
+        for file_num in sorted(new_sizes):
+            i = file_num - 1
+            loc = archive.file_locs[i]
+            size = new_sizes[file_num]
+            fits = file_num == last_file or \
+                size <= -(-archive.file_sizes[i] // alignment) * alignment
+
+            # With the exception of the final subfile, any file where
+            # size % 4 != 0 is padded with 0x8c. Files that do not fit are
+            # also padded to the sector in sector-padded archives; files
+            # that fit already have sector padding.
+            if not archive.sector_padding and file_num != last_file and size % 4:
+                padding = 4 - size % 4
+            elif archive.sector_padding and not fits and size % SECTOR_SIZE:
+                padding = SECTOR_SIZE - size % SECTOR_SIZE
+            else:
+                padding = 0
+
+            if loc > pos:
+                self.segments.append(('copy', pos, pos + shift, loc - pos))
+            self.segments.append(('file', file_num, loc + shift, size))
+            if padding:
+                self.segments.append(('pad', None, loc + shift + size, padding))
+            self.file_sizes[i] = size
+
+            # The rest of the archive moves back by the amount the file grew.
+            end = loc + size + padding
+            growth = 0 if fits else end - archive.file_locs[i+1]
+            if growth > 0:
+                pos = archive.file_locs[i+1]
+                shift += growth
+                for j in range(i + 1, len(self.file_locs)):
+                    self.file_locs[j] += growth
+            else:
+                pos = max(pos, end)
+
+        if archive.size > pos:
+            self.segments.append(('copy', pos, pos + shift, archive.size - pos))
+        self.size = max(seg[2] + seg[3] for seg in self.segments) \
+            if self.segments else archive.size
+        self.moves_files = shift != 0
+
+    def lba_entries(self, sector_padding):
+        """
+        Returns the new LBA table entries.
+
+        Parameters
+        ----------
+        sector_padding : bool
+            Value stating whether the MRG file uses '0x8c' sector padding.
+
+        Returns
+        -------
+        list
+            Tuples (entry offset, 8-byte entry) for every file.
+        """
+
+        return [(ptr_loc, struct.pack('<2I', loc // SECTOR_SIZE if sector_padding else loc, size))
+                for ptr_loc, loc, size in zip(self.ptr_locs, self.file_locs, self.file_sizes)]
@@ -0,0 +1,423 @@
+"""
+Provides a persistent index of the structure of game files.
+
+Extracting, inserting, unpacking and identifying files all start by reading
+LBA tables and matching file headers, and most of the files read are the
+same unmodified game files every time. This module records the structure
+of each file in an SQLite database the first time it is read: the offset,
+size and type of the file and of every subfile nested within it (through
+MRG files), whether MRG files are sector padded, and the number of blocks
+in BPE files. The whole file is indexed in a single pass over a memory map
+of it.
+
+Each file is keyed by its path, size, modification time and SHA-1 hash.
+If the size or modification time of a file has changed when it is looked
+up, the file is hashed again, and reindexed only if its contents have
+actually changed.
+
+Changes to the index are written in one transaction, which is committed
+every COMMIT_INTERVAL indexed files and when the index is closed, so that
+scanning a tree of small files does not commit once per file.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+import atexit
+from collections import namedtuple
+import hashlib
+import mmap
+import os
+import re
+import sqlite3
+import bpe
+import mrg
+
+INDEX_VERSION = 1
+END_DLG_FLAG = re.compile(b'[\x00-\xff][\x00-\x05]\xff\xa0[\x00-\x26]\x00')
+# BPE and MRG searching won't work on an unpacked folder as these are never
+# base files, and get deleted in the unpacking process.
+FILETYPE_DICT = {'BPE': re.compile(b'^[\x00-\xff]{4}BPE\x1a'),
+                 'CLUT': re.compile(b'\x12\x00{3}'),
+                 'DEFF': re.compile(b'^DEFF'),
+                 'MCQ': re.compile(b'^MCQ'),
+                 'MRG': re.compile(b'^MRG\x1a'),
+                 'PXL': re.compile(b'^\x11\x00{3}'),
+                 'TIM': re.compile(b'^\x10\x00{3}'),
+                 'TMD': re.compile(b'\x41\x00{3}'),
+                 'LMB': re.compile(b'\x43\x4d\x42'),
+                 'TEXT': END_DLG_FLAG}
+# Types that are matched against the whole file rather than the header.
+FULL_FILE_TYPES = ('TEXT', 'LMB')
+# Order in which the main type of a file is chosen from the types it
+# matches, with types identified by a fixed header first.
+TYPE_PRIORITY = ('MRG', 'BPE', 'TIM', 'PXL', 'MCQ', 'DEFF', 'TMD', 'LMB', 'CLUT', 'TEXT')
+HASH_BUFFER_SIZE = 0x100000  # 1 MiB
+COMMIT_INTERVAL = 0x400  # Files indexed per commit
+
+IndexEntry = namedtuple('IndexEntry', ('subfile', 'offset', 'size', 'type',
+                                       'types', 'sector_padding', 'num_blocks'))
+
+_default_index = None
+
+
+def match_file_types(data):
+    """
+    Returns the types in FILETYPE_DICT that a file matches.
+
+    Most types are matched against the first 16 bytes of the file. TEXT
+    and LMB are searched for through the whole file, and TEXT only matches
+    at an even offset.
+
+    Parameters
+    ----------
+    data : bytes-like
+        Contents of file.
+
+    Returns
+    -------
+    str list
+        Types that the file matches, in FILETYPE_DICT order.
+    """
+
+    header = bytes(data[:16])
+    types = []
+    for file_type, pattern in FILETYPE_DICT.items():
+        if file_type == 'TEXT':
+            if any(not m.start(0) % 2 for m in pattern.finditer(data)):
+                types.append(file_type)
+        elif pattern.search(data if file_type in FULL_FILE_TYPES else header):
+            types.append(file_type)
+
+    return types
+
+
+def set_default_index(index_file):
+    """
+    Sets the file of the index used by default by the file handlers.
+
+    The index is opened when get_default_index() is first called.
+
+    Parameters
+    ----------
+    index_file : str
+        Name of index file, or None to not use an index.
+    """
+
+    global _default_index
+    if isinstance(_default_index, StructureIndex):
+        _default_index.close()
+    _default_index = index_file
+
+
+def get_default_index():
+    """
+    Returns the index used by default by the file handlers.
+
+    Returns
+    -------
+    StructureIndex
+        Default index, or None if no index file has been set or it could
+        not be opened.
+    """
+
+    global _default_index
+    if isinstance(_default_index, str):
+        try:
+            _default_index = StructureIndex(_default_index)
+        except sqlite3.Error as e:
+            print('Index: Could not open %s: %s' % (_default_index, e))
+            _default_index = None
+        else:
+            atexit.register(_default_index.close)
+    return _default_index
+
+
+class StructureIndex:
+    """
+    A class for storing and retrieving the structure of game files.
+
+    Functions
+    ---------
+    lookup()
+        Returns the index entries of a file and all of its subfiles.
+    file_ranges()
+        Returns the offset and size of each file in a MRG file.
+    file_types()
+        Returns the types that a file matches.
+    commit()
+        Writes pending changes to the index database.
+    close()
+        Commits pending changes and closes the index database.
+
+    Attributes
+    ----------
+    index_file : str
+        Name of the index database file.
+    hits : int
+        Number of files found in the index.
+    misses : int
+        Number of files indexed or reindexed.
+    """
+
+    def __init__(self, index_file):
+        """
+        Parameters
+        ----------
+        index_file : str
+            Name of index database file. Created if it does not exist.
+        """
+
+        self.index_file = index_file
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0  # Files changed since the last commit
+        if os.path.dirname(index_file):
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        self._db = sqlite3.connect(index_file)
+
+        # Tables created by a different version of the index are replaced.
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != INDEX_VERSION:
+            with self._db:
+                self._db.execute('DROP TABLE IF EXISTS files')
+                self._db.execute('DROP TABLE IF EXISTS entries')
+                self._db.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+                'size INTEGER, mtime INTEGER, hash TEXT, sector_padding INTEGER)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS entries (path TEXT, subfile TEXT, '
+                'offset INTEGER, size INTEGER, type TEXT, types TEXT, '
+                'sector_padding INTEGER, num_blocks INTEGER, '
+                'PRIMARY KEY (path, subfile))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _hash(file_name):
+        sha1 = hashlib.sha1()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def _validate(self, path, stat, sector_padding):
+        """
+        Returns whether the index of a file is up to date, updating the
+        modification time of the index if only that has changed.
+        """
+
+        row = self._db.execute(
+            'SELECT size, mtime, hash, sector_padding FROM files WHERE path = ?',
+            (path,)).fetchone()
+        if row is None or row[0] != stat.st_size \
+                or sector_padding is not None and row[3] != sector_padding:
+            return False
+        if row[1] == stat.st_mtime_ns:
+            return True
+
+        # The file has been touched, so check whether it has actually changed.
+        if self._hash(path) != row[2]:
+            return False
+        self._db.execute('UPDATE files SET mtime = ? WHERE path = ?',
+                         (stat.st_mtime_ns, path))
+        self._changed()
+        return True
+
+    def _changed(self):
+        """
+        Counts a changed file, committing every COMMIT_INTERVAL files.
+        """
+
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def _build(self, path, stat, sector_padding):
+        """
+        Indexes a file and all of its subfiles in one pass.
+        """
+
+        entries = []
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            if stat.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                        memoryview(mm) as view:
+                    sha1.update(view)
+                    self._index_data(view, '', 0, sector_padding, entries)
+            else:
+                self._index_data(b'', '', 0, sector_padding, entries)
+
+        self._db.execute('DELETE FROM entries WHERE path = ?', (path,))
+        self._db.execute(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+            (path, stat.st_size, stat.st_mtime_ns, sha1.hexdigest(), sector_padding))
+        self._db.executemany(
+            'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(path, *entry) for entry in entries])
+        self._changed()
+
+    def _index_data(self, data, subfile, offset, sector_padding, entries):
+        """
+        Adds the entries of a file and its subfiles to entries.
+        """
+
+        num_blocks = None
+        archive = None
+        if mrg.is_mrg(data):
+            try:
+                archive = mrg.MRGArchive(data, sector_padding, subfile)
+            except ValueError:
+                pass  # Not actually a MRG file.
+
+        types = match_file_types(data)
+        if 'BPE' in types:
+            try:
+                num_blocks = len(bpe.scan_blocks(data)[1])
+            except (IndexError, ValueError):
+                pass  # Truncated or corrupt BPE file.
+        main_types = [file_type for file_type in types
+                      if file_type != 'MRG' or archive is not None]
+        main_type = min(main_types, key=TYPE_PRIORITY.index) if main_types else None
+        entries.append(IndexEntry(subfile, offset, len(data), main_type, ','.join(types),
+                                  int(sector_padding), num_blocks))
+
+        if archive is not None:
+            with archive:
+                for file_num in range(1, len(archive) + 1):
+                    loc = archive.file_range(file_num)[0]
+                    with archive[file_num] as view:
+                        self._index_data(view, '/'.join(filter(None, (subfile, str(file_num)))),
+                                         offset + loc, False, entries)
+
+    def lookup(self, file_name, sector_padding=None, index_missing=True):
+        """
+        Returns the index entries of a file and all of its subfiles.
+
+        The file is indexed first if it is not in the index or has changed.
+        Subfiles are named by their file number within each MRG file,
+        separated by '/' (e.g. '43/2' is file 2 of file 43 of file_name).
+        The file itself is named ''. Offsets are from the start of
+        file_name, and MRG subfiles are never sector padded.
+
+        Parameters
+        ----------
+        file_name : str
+            Name of file.
+        sector_padding : bool
+            Value stating whether the file uses '0x8c' sector padding, if it
+            is a MRG file. If None, the file is looked up however it was
+            indexed, or indexed without sector padding. (default: None)
+        index_missing : bool
+            Whether to index the file if it is not in the index or has
+            changed. If False, None is returned instead, for callers that
+            only need a little of the file. (default: True)
+
+        Returns
+        -------
+        IndexEntry list
+            Entries of the file and its subfiles, or None if the file does
+            not exist (or is not indexed, if index_missing is False).
+        """
+
+        path = os.path.abspath(file_name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if sector_padding is not None:
+            sector_padding = int(sector_padding)
+        if self._validate(path, stat, sector_padding):
+            self.hits += 1
+        elif not index_missing:
+            return None
+        else:
+            self.misses += 1
+            self._build(path, stat, sector_padding or 0)
+
+        return [IndexEntry(*row) for row in self._db.execute(
+            'SELECT subfile, offset, size, type, types, sector_padding, num_blocks '
+            'FROM entries WHERE path = ? ORDER BY rowid', (path,))]
+
+    def file_ranges(self, file_name, sector_padding=False):
+        """
+        Returns the offset and size of each file in a MRG file.
+
+        Parameters
+        ----------
+        file_name : str
+            Name of MRG file.
+        sector_padding : bool
+            Value stating whether the MRG file uses '0x8c' sector padding.
+            (default: False)
+
+        Returns
+        -------
+        list
+            (offset, size) of each file, by file number (file 0 being the
+            header and LBA table), or None if file_name is not a MRG file.
+        """
+
+        entries = self.lookup(file_name, sector_padding)
+        if not entries or entries[0].type != 'MRG':
+            return None
+
+        ranges = [(entry.offset, entry.size) for entry in entries
+                  if entry.subfile and '/' not in entry.subfile]
+        return [(0, 8 + 8 * len(ranges))] + ranges
+
+    def file_types(self, file_name, sector_padding=None, index_missing=True):
+        """
+        Returns the types that a file matches.
+
+        See match_file_types().
+
+        Parameters
+        ----------
+        file_name : str
+            Name of file.
+        sector_padding : bool
+            Value stating whether the file uses '0x8c' sector padding, if it
+            is a MRG file. See lookup(). (default: None)
+        index_missing : bool
+            Whether to index the file if it is not in the index or has
+            changed. See lookup(). (default: True)
+
+        Returns
+        -------
+        str list
+            Types that the file matches, or None if the file does not exist
+            (or is not indexed, if index_missing is False).
+        """
+
+        entries = self.lookup(file_name, sector_padding, index_missing)
+        if entries is None:
+            return None
+        return entries[0].types.split(',') if entries[0].types else []
+
+    def commit(self):
+        """
+        Writes pending changes to the index database.
+        """
+
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        """
+        Commits pending changes and closes the index database. Does nothing
+        if it is already closed.
+        """
+
+        if self._db is None:
+            return
+        self.commit()
+        self._db.close()
+        self._db = None
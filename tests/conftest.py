@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The LODModS modules are not a package, so make them importable from the
+# tests.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,88 @@
+"""
+Tests for the bpe module.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+import random
+import pytest
+import bpe
+
+NUM_RANDOM_BLOCKS = 20
+
+
+def _random_blocks():
+    rng = random.Random(0)
+    blocks = []
+    for i in range(NUM_RANDOM_BLOCKS):
+        # Use alphabets of varying sizes, so that some blocks fill the
+        # dictionary and others run out of byte pairs to replace. Blocks
+        # need at least one byte value other than 0xff free for the
+        # dictionary.
+        alphabet = rng.sample(range(0x100), rng.choice((2, 8, 32, 128, 0xc0)))
+        blocks.append(bytes(rng.choice(alphabet) for _ in range(bpe.BLOCK_SIZE)))
+    return blocks
+
+
+EDGE_CASE_BLOCKS = [
+    bytes(bpe.BLOCK_SIZE),                       # A single repeated byte
+    b'\x00',                                     # A single byte
+    b'\x01\x02\x03',                             # An odd-length short block
+    bytes(range(0xfe)) * 8 + bytes(range(0x10)), # A single free key
+    bytes(range(0xfe)) + b'\xff' * 0x702,         # Only 0xfe free
+    b'\x8c' * bpe.BLOCK_SIZE,                    # The padding byte
+    bytes(range(0x80)) * 0x10,                   # Half of the byte values in use
+    b'\xab\xcd' * 0x400,                         # A single byte pair
+    bytes(random.Random(1).randrange(0x80) for _ in range(bpe.BLOCK_SIZE)),
+]
+
+BLOCKS = EDGE_CASE_BLOCKS + _random_blocks()
+
+
+def _bpe_file(data, **kwargs):
+    """
+    Returns data compressed as a complete BPE file.
+    """
+
+    return b''.join((len(data).to_bytes(4, 'little'), bpe.BPE_MAGIC,
+                     bpe.compress(data, bpe.BlockMeta(len(data)), **kwargs),
+                     bytes(4)))
+
+
+@pytest.mark.parametrize('sort_order', bpe.SORT_ORDERS)
+@pytest.mark.parametrize('block_num', range(len(BLOCKS)))
+def test_numpy_backend_matches_python(block_num, sort_order):
+    pytest.importorskip('numpy')
+    block = BLOCKS[block_num]
+    assert bpe.compress_block(block, sort_order, backend='numpy') == \
+        bpe.compress_block(block, sort_order, backend='python')
+
+
+@pytest.mark.parametrize('block_num', range(len(BLOCKS)))
+def test_block_round_trip(block_num):
+    block = BLOCKS[block_num]
+    data, meta = bpe.decompress(_bpe_file(block))
+    assert data == block
+    assert meta.block_sizes == [len(block)]
+
+
+@pytest.mark.parametrize('backend', bpe.BACKENDS)
+def test_compress_round_trip(backend):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    data = b''.join(BLOCKS)
+    compressed = _bpe_file(data, backend=backend)
+    assert bpe.decompress(compressed)[0] == data
+
+    # Partial block ranges decompress to the matching part of the data.
+    decompressed, meta = bpe.decompress(compressed, 2, 5)
+    assert decompressed == b''.join(bpe.split_blocks(data, bpe.BlockMeta())[2:5])
+    assert (meta.start_block, meta.end_block) == (2, 5)
+
+
+@pytest.mark.parametrize('sort_order', bpe.SORT_ORDERS)
+def test_sort_orders_round_trip(sort_order):
+    data = b''.join(BLOCKS[:4])
+    num_blocks = len(bpe.split_blocks(data, bpe.BlockMeta()))
+    compressed = _bpe_file(data, sort_orders=[sort_order] * num_blocks)
+    assert bpe.decompress(compressed)[0] == data
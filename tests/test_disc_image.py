@@ -0,0 +1,276 @@
+"""
+Tests for the disc_image module, using small synthetic disc images.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+import random
+import pytest
+import edc_ecc
+from disc_image import DiscFile, DiscImage, DiscWriter, PVD_SECTOR, RAW_SECTOR_SIZE, \
+    SECTOR_SIZE, XA_FORM2, XA_INTERLEAVED, XA_SECTOR_SIZE
+
+FORM2_DATA_SIZE = 2324
+NUM_SECTORS = 28
+ROOT_LBA = 18
+SECT_LBA = 19
+
+_rng = random.Random(0)
+BIG = bytes(_rng.randrange(0x100) for _ in range(3000))
+SMALL = bytes(_rng.randrange(0x100) for _ in range(3000))
+XA = [bytes(_rng.randrange(0x100) for _ in range(FORM2_DATA_SIZE)) for _ in range(2)]
+STR = [bytes(_rng.randrange(0x100) for _ in range(FORM2_DATA_SIZE))]
+
+# Path: (LBA, contents, XA attributes). Form 2 contents are lists of sectors.
+FILES = {'SECT/DRGN21.BIN': (20, BIG, 0x0d55),
+         'SECT/SMALL.BIN': (22, SMALL, 0x0d55),
+         'LODXA00.XA': (24, XA, 0x0d55 | XA_FORM2),
+         'MOVIE.STR': (26, STR, 0x0d55 | XA_INTERLEAVED)}
+
+
+def _record(name, lba, size, is_dir=False, xa_attributes=None):
+    """
+    Returns an ISO9660 directory record, with an XA system use field.
+    """
+
+    name = name.encode('ascii')
+    record = bytearray(33 + len(name) + (1 - len(name) % 2))
+    record[2:10] = lba.to_bytes(4, 'little') + lba.to_bytes(4, 'big')
+    record[10:18] = size.to_bytes(4, 'little') + size.to_bytes(4, 'big')
+    record[25] = 0x02 if is_dir else 0x00
+    record[32] = len(name)
+    record[33:33+len(name)] = name
+    if xa_attributes is not None:
+        record += bytes(4) + xa_attributes.to_bytes(2, 'big') + b'XA' + bytes(6)
+    record[0] = len(record)
+    return bytes(record)
+
+
+def _size(contents):
+    return len(contents) * SECTOR_SIZE if isinstance(contents, list) else len(contents)
+
+
+def _user_data():
+    """
+    Returns the user data of each Form 1 sector and the Form 2 sectors of
+    each file, by LBA.
+    """
+
+    pvd = bytearray(SECTOR_SIZE)
+    pvd[0:7] = b'\x01CD001\x01'
+    pvd[40:72] = b'TESTVOL'.ljust(32)
+    pvd[80:88] = NUM_SECTORS.to_bytes(4, 'little') + NUM_SECTORS.to_bytes(4, 'big')
+    pvd[156:190] = _record('\x00', ROOT_LBA, SECTOR_SIZE, True)
+
+    root = _record('\x00', ROOT_LBA, SECTOR_SIZE, True) \
+        + _record('\x01', ROOT_LBA, SECTOR_SIZE, True) \
+        + _record('SECT', SECT_LBA, SECTOR_SIZE, True, 0x8d55)
+    sect = _record('\x00', SECT_LBA, SECTOR_SIZE, True) \
+        + _record('\x01', ROOT_LBA, SECTOR_SIZE, True)
+    for path, (lba, contents, attributes) in FILES.items():
+        record = _record(path.split('/')[-1] + ';1', lba, _size(contents), False, attributes)
+        if path.startswith('SECT/'):
+            sect += record
+        else:
+            root += record
+
+    form1 = {PVD_SECTOR: bytes(pvd), PVD_SECTOR + 1: b'\xffCD001\x01',
+             ROOT_LBA: root, SECT_LBA: sect}
+    form2 = {}
+    for lba, contents, _ in FILES.values():
+        if isinstance(contents, list):
+            form2.update({lba + i: sector for i, sector in enumerate(contents)})
+        else:
+            for i in range(0, len(contents), SECTOR_SIZE):
+                form1[lba + i // SECTOR_SIZE] = contents[i:i+SECTOR_SIZE]
+    return form1, form2
+
+
+def _iso_image():
+    form1, form2 = _user_data()
+    image = bytearray(NUM_SECTORS * SECTOR_SIZE)
+    for lba, data in list(form1.items()) + list(form2.items()):
+        image[lba*SECTOR_SIZE:lba*SECTOR_SIZE+len(data[:SECTOR_SIZE])] = data[:SECTOR_SIZE]
+    return bytes(image)
+
+
+def _raw_image():
+    form1, form2 = _user_data()
+    image = bytearray()
+    for lba in range(NUM_SECTORS):
+        image += edc_ecc.sector_header(lba)
+        if lba in form2:
+            image += bytes((1, 1, 0x64, 0)) * 2 + form2[lba] + bytes(4)
+        else:
+            image += bytes((0, 0, 0x08, 0)) * 2 \
+                + form1.get(lba, b'').ljust(SECTOR_SIZE, b'\x00') \
+                + bytes(RAW_SECTOR_SIZE - 24 - SECTOR_SIZE)
+    edc_ecc.encode_sectors(image)
+    return bytes(image)
+
+
+def _raw_form2_file(sectors):
+    """
+    Returns a Form 2 file as extracted from a raw image, in 2336-byte
+    sectors.
+    """
+
+    file = b''
+    for data in sectors:
+        # The EDC of a Form 2 sector does not cover its header.
+        sector = bytearray(edc_ecc.sector_header(0) + bytes((1, 1, 0x64, 0)) * 2
+                           + data + bytes(4))
+        edc_ecc.encode_sectors(sector)
+        file += sector[16:]
+    return file
+
+
+@pytest.fixture(params=('iso', 'raw'))
+def image_file(request, tmp_path):
+    image_file = tmp_path / ('test.%s' % ('iso' if request.param == 'iso' else 'bin'))
+    image_file.write_bytes(_iso_image() if request.param == 'iso' else _raw_image())
+    return str(image_file)
+
+
+@pytest.fixture
+def raw_image_file(tmp_path):
+    image_file = tmp_path / 'test.bin'
+    image_file.write_bytes(_raw_image())
+    return str(image_file)
+
+
+def _sector_data(image_file, lba):
+    """
+    Returns the user data of a Form 1 sector, read straight from the image.
+    """
+
+    raw = image_file.endswith('.bin')
+    with open(image_file, 'rb') as f:
+        f.seek(lba * RAW_SECTOR_SIZE + 24 if raw else lba * SECTOR_SIZE)
+        return f.read(SECTOR_SIZE)
+
+
+def _volume_size(image_file):
+    pvd = _sector_data(image_file, PVD_SECTOR)
+    assert pvd[80:84] == pvd[84:88][::-1]
+    return int.from_bytes(pvd[80:84], 'little')
+
+
+def _record_values(image_file, path):
+    """
+    Returns the extent and size in a file's directory record, checking that
+    both byte orders match.
+    """
+
+    with DiscImage(image_file) as disc:
+        lba, offset = disc.record_location(path)
+    record = _sector_data(image_file, lba)[offset:offset+18]
+    assert record[2:6] == record[6:10][::-1] and record[10:14] == record[14:18][::-1]
+    return int.from_bytes(record[2:6], 'little'), int.from_bytes(record[10:14], 'little')
+
+
+def test_files(image_file):
+    with DiscImage(image_file) as disc:
+        assert disc.raw == image_file.endswith('.bin')
+        assert disc.volume_id == 'TESTVOL'
+        assert disc.num_sectors == NUM_SECTORS
+        assert disc.files == {
+            'SECT/DRGN21.BIN': DiscFile(20, len(BIG), 1),
+            'SECT/SMALL.BIN': DiscFile(22, len(SMALL), 1),
+            'LODXA00.XA': DiscFile(24, 2 * SECTOR_SIZE, 2),
+            'MOVIE.STR': DiscFile(26, SECTOR_SIZE, 2)}
+        assert 'sect\\drgn21.bin;1' in disc
+        assert 'SECT/MISSING.BIN' not in disc
+
+
+def test_read_form1_file(image_file, tmp_path):
+    with DiscImage(image_file) as disc:
+        assert disc.read_file('sect/drgn21.bin') == BIG
+        with disc.view_file('SECT/DRGN21.BIN') as view:
+            assert view == BIG
+        with disc.view_file('SECT/SMALL.BIN;1') as view:
+            assert view == SMALL
+        disc.extract_file('SECT/DRGN21.BIN', str(tmp_path / 'out' / 'DRGN21.BIN'))
+    assert (tmp_path / 'out' / 'DRGN21.BIN').read_bytes() == BIG
+
+
+def test_read_form2_file(raw_image_file, tmp_path):
+    with DiscImage(raw_image_file) as disc:
+        for path in ('LODXA00.XA', 'MOVIE.STR'):
+            contents = FILES[path][1]
+            data = disc.read_file(path)
+            assert len(data) == len(contents) * XA_SECTOR_SIZE
+            assert data == _raw_form2_file(contents)
+            with disc.view_file(path) as view:
+                assert view == data
+            disc.extract_file(path, str(tmp_path / path))
+            assert (tmp_path / path).read_bytes() == data
+
+
+def test_missing_file(image_file):
+    with DiscImage(image_file) as disc:
+        with pytest.raises(FileNotFoundError):
+            disc.file_entry('SECT/MISSING.BIN')
+        with pytest.raises(FileNotFoundError):
+            disc.read_file('SECT/MISSING.BIN')
+
+
+def test_not_a_disc_image(tmp_path):
+    not_image = tmp_path / 'test.bin'
+    not_image.write_bytes(bytes(NUM_SECTORS * SECTOR_SIZE))
+    with pytest.raises(ValueError):
+        DiscImage(str(not_image))
+
+
+def test_writer_relocates_grown_file(image_file):
+    grown = bytes(range(0x100)) * 20  # 3 sectors, where BIG has 2
+    with DiscWriter(image_file) as writer:
+        writer.add_file('sect/drgn21.bin', grown)
+        layout = writer.write()
+    assert layout == {'sect/drgn21.bin': NUM_SECTORS}
+
+    with DiscImage(image_file) as disc:
+        assert disc.files['SECT/DRGN21.BIN'] == DiscFile(NUM_SECTORS, len(grown), 1)
+        assert disc.read_file('SECT/DRGN21.BIN') == grown
+        assert disc.read_file('SECT/SMALL.BIN') == SMALL
+        assert disc.num_sectors == NUM_SECTORS + 3
+    assert _record_values(image_file, 'SECT/DRGN21.BIN') == (NUM_SECTORS, len(grown))
+    assert _volume_size(image_file) == NUM_SECTORS + 3
+
+
+def test_writer_overwrites_shrunk_file_in_place(image_file):
+    shrunk = b'shrunk' * 20
+    with DiscWriter(image_file) as writer:
+        assert writer.replace_file('SECT/SMALL.BIN', shrunk) == 22
+
+    with DiscImage(image_file) as disc:
+        assert disc.files['SECT/SMALL.BIN'] == DiscFile(22, len(shrunk), 1)
+        assert disc.read_file('SECT/SMALL.BIN') == shrunk
+        assert disc.read_file('SECT/DRGN21.BIN') == BIG
+        assert disc.num_sectors == NUM_SECTORS
+    assert _record_values(image_file, 'SECT/SMALL.BIN') == (22, len(shrunk))
+    assert _volume_size(image_file) == NUM_SECTORS
+
+
+@pytest.mark.parametrize('backend', edc_ecc.BACKENDS)
+def test_writer_regenerates_edc_ecc(raw_image_file, backend):
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    xa = [bytes(reversed(x)) for x in XA]
+    with DiscWriter(raw_image_file, backend) as writer:
+        writer.add_file('SECT/DRGN21.BIN', bytes(range(0x100)) * 20)
+        writer.add_file('SECT/SMALL.BIN', b'shrunk' * 20)
+        writer.add_file('LODXA00.XA', _raw_form2_file(xa))
+        writer.write()
+
+    with open(raw_image_file, 'rb') as f:
+        image = f.read()
+    for lba in range(len(image) // RAW_SECTOR_SIZE):
+        sector = image[lba*RAW_SECTOR_SIZE:(lba+1)*RAW_SECTOR_SIZE]
+        assert sector[:16] == edc_ecc.sector_header(lba)
+        encoded = bytearray(sector)
+        edc_ecc.encode_sectors(encoded)
+        assert encoded == sector
+
+    with DiscImage(raw_image_file) as disc:
+        assert disc.read_file('LODXA00.XA') == _raw_form2_file(xa)
@@ -10,6 +10,7 @@ Copyright (C) 2020 theflyingzamboni
 
 from copy import deepcopy
 import csv
+import io
 from more_itertools import sort_together
 import mmap
 import os
@@ -20,6 +21,7 @@ from build_codec import *
 from config_handler import read_file_list
 from disc_handler import backup_file
 from game_file_handler import process_block_range
+from virtual_files import disc_file_system
 
 is_insert = False
 
@@ -852,7 +854,7 @@ def update_box_dimensions(csv_file):
 
 
 def dump_text(file, csv_file, ptr_tbl_starts, ptr_tbl_ends,
-              single_ptr_tbl, ov_text_starts=None, called=False):
+              single_ptr_tbl, ov_text_starts=None, called=False, data=None):
     """
     Dumps text from a game file.
 
@@ -885,15 +887,23 @@ def dump_text(file, csv_file, ptr_tbl_starts, ptr_tbl_ends,
     called : bool
         Indicates whether function was called from _dump_helper()
         (default: False).
+    data : bytes-like
+        Contents of the file, if it should not be read from file (e.g. if
+        it is read from a disc image) (default: None).
     """
 
     global is_insert
     is_insert = False
-    file_size = os.path.getsize(file)
+    file_size = os.path.getsize(file) if data is None else len(data)
     basename = os.path.splitext(os.path.basename(file))[0]
     csv_output = []
 
-    with open(file, 'rb') as inf:
+    if data is None:
+        inf = open(file, 'rb')
+    else:
+        inf = io.BytesIO(data)
+        inf.name = file
+    with inf:
         # Check for addition text, pop relevant entries from parameter lists,
         # and dump additions.
         for index, val in enumerate(single_ptr_tbl):
@@ -976,7 +986,7 @@ def dump_text(file, csv_file, ptr_tbl_starts, ptr_tbl_ends,
         print('Dump: Could not access %s. Make sure file is closed' % csv_file)
 
 
-def dump_all(list_file, disc_dict):
+def dump_all(list_file, disc_dict, from_disc=False):
     """
     Dumps text from all files listed in a file list text file.
 
@@ -989,6 +999,9 @@ def dump_all(list_file, disc_dict):
     This function should be used with output txt file from id_file_type.
     This has already been done for each disc.
 
+    If from_disc is set, files that have not been extracted to disk are
+    read straight from each disc's image instead.
+
     Parameters
     ----------
     list_file : str
@@ -996,6 +1009,9 @@ def dump_all(list_file, disc_dict):
     disc_dict : dict
         Dict containing information about disc image, directory structure,
         and game files
+    from_disc : bool
+        Whether to read files from the disc images in disc_dict if they are
+        not on disk. (default: False)
     """
     print('\nDump: Dumping script files')
 
@@ -1054,6 +1070,7 @@ def dump_all(list_file, disc_dict):
                     else:
                         file[5] = [int(x, 16) for x in file[5].split(',')]
                     file.append(csv_file)
+                    file.append(disc)
                     files_to_dump.append(file)
                 except IndexError:
                     if val[1][1]:
@@ -1083,18 +1100,40 @@ def dump_all(list_file, disc_dict):
             print('Dump: Could not access %s. Make sure file is closed' %
                   script_dict[disc])
 
+    # Open the disc images to read files that have not been extracted from.
+    disc_file_systems = {}
+    if from_disc:
+        for disc in files_list:
+            if disc in disc_dict:
+                disc_file_systems[disc] = disc_file_system(disc_dict[disc])
+
     # Dump text from each file listed in files_to_dump.
-    for file in sorted(files_to_dump):
-        try:
-            dump_text(file[0], file[6], file[2], file[3], file[4], file[5], True)
-        except FileNotFoundError:
-            print('Dump: File %s not found\nDump: Skipping file' %
-                  sys.exc_info()[1].filename)
-            scripts_dumped -= 1
-        except EOFError:
-            scripts_dumped -= 1
-        except UnicodeDecodeError:
-            scripts_dumped -= 1
+    try:
+        for file in sorted(files_to_dump):
+            data = None
+            vfs = disc_file_systems.get(file[7])
+            try:
+                if vfs is not None and not os.path.exists(file[0]):
+                    try:
+                        data = vfs.read_extracted(file[0])
+                    except FileNotFoundError:
+                        pass  # Reported when the file is opened.
+                dump_text(file[0], file[6], file[2], file[3], file[4], file[5], True, data)
+            except FileNotFoundError:
+                print('Dump: File %s not found\nDump: Skipping file' %
+                      sys.exc_info()[1].filename)
+                scripts_dumped -= 1
+            except EOFError:
+                scripts_dumped -= 1
+            except UnicodeDecodeError:
+                scripts_dumped -= 1
+            finally:
+                if isinstance(data, memoryview):
+                    data.release()
+    finally:
+        for vfs in disc_file_systems.values():
+            if vfs is not None:
+                vfs.close()
 
     print('Dump: Dumped %s of %s script files\n' %
           (scripts_dumped, total_scripts))
@@ -0,0 +1,657 @@
+"""
+Provides virtual paths to files nested within LoD's game files.
+
+Game files are normally unpacked to disk before they are modded, with one
+_dir subdirectory for every level of nesting (e.g. SECT/DRGN21_dir/
+DRGN21_100_dir/DRGN21_100_16.bin). This module instead addresses nested files
+with virtual paths, which are resolved in memory when they are read:
+
+    SECT/DRGN21.BIN/100/16      File 16 of file 100 of DRGN21.BIN
+    OVL/S_ITEM.OV_/{0-73}       Blocks 0-73 of S_ITEM.OV_, decompressed
+    SECT/DRGN0.BIN/5/{0-512}    All blocks of BPE file 5 of DRGN0.BIN
+
+A virtual path starts with the path of a game file on disk, followed by
+the numbers of the MRG subfiles to descend into, and optionally a BPE block
+range, in the same format used in the names of decompressed files. Paths of
+extracted and decompressed files, as used in file list text files, can be
+converted with VirtualFileSystem.virtual_path().
+
+Files written to virtual paths are held in memory as overlays, and are
+only written to disk when flush() rebuilds each parent file.
+
+Game files can also be read straight from a disc image, for any that have
+not been extracted to disk. Nothing is then written to disk unless a file
+is modified and flushed, in which case the rebuilt game file is written to
+its path on disk, ready to be inserted back into the disc.
+
+Copyright (C) 2019 theflyingzamboni
+"""
+
+from collections import OrderedDict
+import mmap
+import os
+import re
+import bpe
+from disc_handler import backup_file, replace_file
+from disc_image import DiscImage
+import mrg
+
+BLOCK_RANGE = re.compile(r'{(\d+)-(\d+)}$')
+SECTOR_PADDED_FILES = re.compile(r'DRGN(0|1|2[1-4])\.BIN$', re.I)
+CACHE_SIZE = 256
+
+
+class _Node:
+    """
+    A resolved virtual path.
+
+    Attributes
+    ----------
+    data : bytes-like
+        Contents of the file.
+    sector_padding : bool
+        Value stating whether the file uses '0x8c' sector padding, if it
+        is an MRG file.
+    meta : BlockMeta
+        Metadata of the block range, if the node is a decompressed BPE
+        block range.
+    """
+
+    def __init__(self, data, sector_padding=False, meta=None):
+        self.data = data
+        self.sector_padding = sector_padding
+        self.meta = meta
+        self._archive = None
+
+    @property
+    def archive(self):
+        # The LBA table is only parsed when a subfile is first requested.
+        if self._archive is None:
+            self._archive = mrg.MRGArchive(self.data, self.sector_padding)
+        return self._archive
+
+    def release(self):
+        if self._archive is not None:
+            self._archive.close()
+        if isinstance(self.data, memoryview):
+            self.data.release()
+
+
+class VirtualFileSystem:
+    """
+    A class for reading and writing files nested within game files, using
+    virtual paths.
+
+    Game files are mapped into memory when first used. Each nested file is
+    resolved through the LBA tables of its parent MRG files and decompressed
+    if it is a BPE block range, and the most recently used nodes are kept
+    in a cache. Decompressed block ranges are the only nodes whose contents
+    are copied.
+
+    Memoryviews returned by read() remain valid until the game file they
+    come from is flushed, or the file system is closed.
+
+    Functions
+    ---------
+    read()
+        Returns the contents of a virtual path.
+    read_extracted()
+        Returns the contents of a file, by the path it is extracted to.
+    write()
+        Replaces the contents of a virtual path in memory.
+    exists()
+        Checks whether a virtual path can be resolved.
+    file_type()
+        Returns whether a virtual path is an MRG or BPE file.
+    listdir()
+        Lists the subfiles of an MRG file.
+    virtual_path()
+        Converts the path of an extracted file to a virtual path.
+    flush()
+        Rebuilds the game files containing written files, and writes them
+        to disk.
+    close()
+        Releases all game files.
+
+    Attributes
+    ----------
+    root_dir : str
+        Directory that virtual paths are relative to.
+    cache_size : int
+        Maximum number of nested nodes to keep in the cache.
+    disc : DiscImage
+        Disc image that game files not found in root_dir are read from,
+        if any.
+    """
+
+    def __init__(self, root_dir='.', cache_size=CACHE_SIZE, sector_padded_files=None,
+                 disc_image=None):
+        """
+        Parameters
+        ----------
+        root_dir : str
+            Directory that virtual paths are relative to. (default: '.')
+        cache_size : int
+            Maximum number of nested nodes to keep in the cache.
+            (default: 256)
+        sector_padded_files : iterable
+            Paths of the game files that use '0x8c' sector padding, as in
+            the sector padding flag of file list text files. (default:
+            DRGN0.BIN, DRGN1.BIN, and DRGN2x.BIN)
+        disc_image : str
+            Name of disc image to read game files from if they are not
+            found in root_dir, with paths on the disc matching paths
+            relative to root_dir. (default: None)
+
+        Raises
+        ------
+        FileNotFoundError
+            If the disc image does not exist.
+        ValueError
+            If the disc image is not an ISO9660 disc image.
+        """
+
+        self.root_dir = root_dir
+        self.disc = None if disc_image is None else DiscImage(disc_image)
+        self.cache_size = cache_size
+        if sector_padded_files is not None:
+            sector_padded_files = {self._normalize(x) for x in sector_padded_files}
+        self._sector_padded_files = sector_padded_files
+        self._files = {}  # Game file path: (mmap, _Node)
+        self._cache = OrderedDict()
+        self._overlays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _normalize(path):
+        return '/'.join(x for x in path.replace('\\', '/').split('/') if x not in ('', '.'))
+
+    def _split(self, path):
+        """
+        Splits a virtual path into a key of the game file path followed by
+        each nested component.
+        """
+
+        parts = self._normalize(path).split('/')
+        for i in range(1, len(parts) + 1):
+            file_name = '/'.join(parts[:i])
+            if file_name in self._files or \
+                    os.path.isfile(os.path.join(self.root_dir, file_name)) or \
+                    (self.disc is not None and file_name in self.disc):
+                return (file_name,) + tuple(parts[i:])
+
+        raise FileNotFoundError('%s does not exist' % path)
+
+    def _game_file(self, file_name):
+        if file_name not in self._files:
+            if self._sector_padded_files is None:
+                sector_padding = bool(SECTOR_PADDED_FILES.search(file_name))
+            else:
+                sector_padding = file_name in self._sector_padded_files
+            disk_file = os.path.join(self.root_dir, file_name)
+            if self.disc is not None and not os.path.isfile(disk_file):
+                file_map = None
+                data = self.disc.view_file(file_name)
+            else:
+                with open(disk_file, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size:
+                        file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        data = memoryview(file_map)
+                    else:  # Empty files cannot be mapped.
+                        file_map = None
+                        data = b''
+            self._files[file_name] = (file_map, _Node(data, sector_padding))
+
+        return self._files[file_name][1]
+
+    def _node(self, key):
+        """
+        Resolves a key, using overlays and the cache.
+        """
+
+        if key in self._overlays:
+            return self._overlays[key]
+        elif len(key) == 1:
+            return self._game_file(key[0])
+        elif key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        node = self._resolve(key)
+        self._cache[key] = node
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)[1].release()
+
+        return node
+
+    def _resolve(self, key):
+        """
+        Resolves the last component of a key from its parent node.
+        """
+
+        parent = self._node(key[:-1])
+        block_range = BLOCK_RANGE.match(key[-1])
+        if block_range:
+            data, meta = bpe.decompress(parent.data, int(block_range.group(1)),
+                                        int(block_range.group(2)),
+                                        not mrg.is_bpe(parent.data))
+            return _Node(data, meta=meta)
+        elif key[-1].isdigit():
+            return _Node(parent.archive[int(key[-1])])
+
+        raise FileNotFoundError('%s does not exist' % '/'.join(key))
+
+    def _drop(self, key):
+        """
+        Removes a key and all keys nested within it from the cache.
+        """
+
+        for cache_key in [x for x in self._cache if x[:len(key)] == key]:
+            self._cache.pop(cache_key).release()
+
+    def read(self, path):
+        """
+        Returns the contents of a virtual path.
+
+        Parameters
+        ----------
+        path : str
+            Virtual path to read.
+
+        Returns
+        -------
+        bytes-like
+            Contents of the file. Game files and MRG subfiles are returned
+            as memoryviews of the mapped game file.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the path does not exist.
+        IndexError
+            If a subfile number is not in its MRG file.
+        ValueError
+            If a subfile is not an MRG or BPE file as required by the path.
+        """
+
+        data = self._node(self._split(path)).data
+        # A new view is returned, so that the caller's view is not released
+        # when the node leaves the cache.
+        return memoryview(data) if isinstance(data, memoryview) else data
+
+    def read_extracted(self, file_name):
+        """
+        Returns the contents of a file, by the path it is extracted to.
+
+        See virtual_path(). Used to read files listed in file list text
+        files without extracting them.
+
+        Parameters
+        ----------
+        file_name : str
+            Path of extracted file, either relative to the current
+            directory and within root_dir, or relative to root_dir.
+
+        Returns
+        -------
+        bytes-like
+            Contents of the file. See read().
+
+        Raises
+        ------
+        FileNotFoundError
+            If the path cannot be resolved.
+        """
+
+        if os.path.commonpath((os.path.abspath(file_name), os.path.abspath(self.root_dir))) \
+                == os.path.abspath(self.root_dir):
+            file_name = os.path.relpath(file_name, self.root_dir)
+        try:
+            return self.read(self.virtual_path(file_name))
+        except (IndexError, ValueError) as e:
+            raise FileNotFoundError('%s does not exist' % file_name) from e
+
+    def write(self, path, data):
+        """
+        Replaces the contents of a virtual path in memory.
+
+        The new contents are used for any later reads of the path or of files
+        nested within it, and are written to disk by flush().
+
+        Parameters
+        ----------
+        path : str
+            Virtual path to write.
+        data : bytes-like
+            New contents of the file.
+        """
+
+        key = self._split(path)
+        # Block range metadata is kept, as it is needed to compress the data
+        # again.
+        node = self._node(key)
+        self._drop(key)
+        self._overlays[key] = _Node(bytes(data), node.sector_padding, node.meta)
+
+    def exists(self, path):
+        """
+        Checks whether a virtual path can be resolved.
+
+        Parameters
+        ----------
+        path : str
+            Virtual path to check.
+
+        Returns
+        -------
+        bool
+            True if the path exists.
+        """
+
+        try:
+            self.read(path)
+        except (FileNotFoundError, IndexError, ValueError):
+            return False
+        return True
+
+    def file_type(self, path):
+        """
+        Returns whether a virtual path is an MRG or BPE file.
+
+        Parameters
+        ----------
+        path : str
+            Virtual path to check.
+
+        Returns
+        -------
+        str
+            'MRG', 'BPE', or None if the file is neither.
+        """
+
+        data = self._node(self._split(path)).data
+        if mrg.is_mrg(data):
+            return 'MRG'
+        elif mrg.is_bpe(data):
+            return 'BPE'
+        return None
+
+    def listdir(self, path):
+        """
+        Lists the subfiles of an MRG file.
+
+        Parameters
+        ----------
+        path : str
+            Virtual path of MRG file.
+
+        Returns
+        -------
+        str list
+            Virtual paths of each subfile.
+        """
+
+        key = self._split(path)
+        return ['/'.join(key + (str(i),)) for i in range(1, len(self._node(key).archive) + 1)]
+
+    def virtual_path(self, file_name):
+        """
+        Converts the path of an extracted file to a virtual path.
+
+        Each '<name>_dir' directory is replaced by the file it was extracted
+        from, and each '<name>_<n>.bin' or '<name>_{<start>-<end>}<ext>'
+        file within it by the subfile number or block range. For example,
+        SECT/DRGN21_dir/DRGN21_100_dir/DRGN21_100_16.bin becomes
+        SECT/DRGN21.BIN/100/16.
+
+        Parameters
+        ----------
+        file_name : str
+            Path of extracted file, relative to root_dir.
+
+        Returns
+        -------
+        str
+            Virtual path of the file.
+
+        Raises
+        ------
+        FileNotFoundError
+            If a directory's parent file does not exist.
+        ValueError
+            If the path contains a file not named after its directory.
+        """
+
+        key = []
+        stem = None  # Name of the file that the current directory came from.
+        for part in self._normalize(file_name).split('/'):
+            if stem is None:
+                if not part.lower().endswith('_dir'):
+                    key.append(part)
+                    continue
+                # Find the game file this directory was extracted from.
+                stem = part[:-4]
+                for name in self._game_file_names(key):
+                    if os.path.splitext(name)[0].lower() == stem.lower():
+                        key.append(name)
+                        break
+                else:
+                    raise FileNotFoundError('%s has no parent file' % part)
+                continue
+
+            m = re.match(r'%s_(\d+)(_dir|\.bin)$' % re.escape(stem), part, re.I) or \
+                re.match(r'%s_({\d+-\d+})[^/]*$' % re.escape(stem), part, re.I)
+            if not m:
+                raise ValueError('%s is not a file of %s' % (part, stem))
+            key.append(m.group(1))
+            if m.lastindex == 2 and m.group(2).lower() == '_dir':
+                stem = part[:-4]
+
+        return '/'.join(key)
+
+    def _game_file_names(self, key):
+        """
+        Returns the names of the game files in a directory, on disk and on
+        the disc image.
+        """
+
+        parent_dir = os.path.join(self.root_dir, *key)
+        names = []
+        if os.path.isdir(parent_dir):
+            names = [name for name in sorted(os.listdir(parent_dir))
+                     if os.path.isfile(os.path.join(parent_dir, name))]
+        if self.disc is not None:
+            disc_dir = '/'.join(key).upper()
+            names.extend(sorted(os.path.basename(path) for path in self.disc.files
+                                if os.path.dirname(path) == disc_dir))
+        return names
+
+    def _rebuild(self, key, children, pool=None, backend='python'):
+        """
+        Returns the contents of a node with some of its children replaced.
+        """
+
+        parent = self._node(key)
+        if all(child[-1].isdigit() for child in children):
+            return parent.archive.rebuild(
+                {int(child[-1]): self._overlays[child].data for child in children})
+
+        # Block ranges are replaced starting from the last one, so that the
+        # offsets of earlier ranges do not change.
+        data = bytes(parent.data)
+        is_subfile = not mrg.is_bpe(data)
+        for child in sorted(children, key=lambda x: self._overlays[x].meta.start_block,
+                            reverse=True):
+            overlay = self._overlays[child]
+            data = _replace_block_range(data, overlay.data, overlay.meta, is_subfile,
+                                        backend, pool)
+        return data
+
+    def flush(self, pool=None, backend='python'):
+        """
+        Rebuilds the game files containing written files, and writes them
+        to disk.
+
+        Written files are inserted into their parents starting from the most
+        deeply nested. MRG files are rebuilt with mrg.MRGArchive.rebuild(),
+        and BPE block ranges are compressed again, reusing the original
+        compressed blocks for any unchanged blocks. Each game file is backed
+        up before it is replaced. Game files read from the disc image are
+        written to their paths in root_dir.
+
+        Parameters
+        ----------
+        pool : multiprocessing.Pool
+            Pool to compress BPE blocks in, if any. (default: None)
+        backend : str
+            Backend used to compress BPE blocks ('python' or 'numpy').
+            (default: 'python')
+
+        Raises
+        ------
+        ValueError
+            If a BPE block range within a non-BPE file no longer fits.
+        BufferError
+            If memoryviews of a game file being replaced have not been
+            released.
+        """
+
+        while any(len(key) > 1 for key in self._overlays):
+            depth = max(len(key) for key in self._overlays)
+            parents = {key[:-1] for key in self._overlays if len(key) == depth}
+            for parent in parents:
+                children = [key for key in self._overlays if key[:-1] == parent]
+                data = self._rebuild(parent, children, pool, backend)
+                sector_padding = self._node(parent).sector_padding
+                for child in children:
+                    del self._overlays[child]
+                self._drop(parent)
+                self._overlays[parent] = _Node(bytes(data), sector_padding)
+
+        for key in list(self._overlays):
+            file_name = os.path.join(self.root_dir, key[0])
+            data = self._overlays.pop(key).data
+            self._close_file(key[0])
+            if os.path.isfile(file_name):
+                backup_file(file_name, hide_print=True)
+            elif os.path.dirname(file_name):
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            replace_file(file_name, data)
+
+    def _close_file(self, file_name):
+        self._drop((file_name,))
+        if file_name in self._files:
+            file_map, node = self._files.pop(file_name)
+            node.release()
+            if file_map is not None:
+                file_map.close()
+
+    def close(self):
+        """
+        Releases all game files and the disc image. Written files that have
+        not been flushed are discarded.
+        """
+
+        self._overlays.clear()
+        for file_name in list(self._files):
+            self._close_file(file_name)
+        if self.disc is not None:
+            self.disc.close()
+            self.disc = None
+
+
+def disc_file_system(disc_val):
+    """
+    Returns a VirtualFileSystem that reads a disc's game files from its
+    disc image.
+
+    Parameters
+    ----------
+    disc_val : list
+        Entry of a disc dict ([disc image, [game files directory, ...],
+        ...]). Paths of game files on the disc are relative to the game
+        files directory.
+
+    Returns
+    -------
+    VirtualFileSystem
+        File system of the disc, or None if the disc image could not be
+        read.
+    """
+
+    try:
+        return VirtualFileSystem(disc_val[1][0], disc_image=disc_val[0])
+    except FileNotFoundError:
+        print('Disc: %s could not be found' % disc_val[0])
+    except ValueError as e:
+        print('Disc: %s' % e)
+    return None
+
+
+def _replace_block_range(buf, data, meta, is_subfile=False, backend='python', pool=None):
+    """
+    Compresses a block range back into BPE data.
+
+    Blocks that are unchanged from the original compressed data are reused.
+    If the BPE data is contained within another file, the block range must
+    be no larger than the original, and the file is padded with zeros after
+    the end of the BPE data so that nothing following it moves.
+
+    Parameters
+    ----------
+    buf : bytes
+        Data containing the compressed block range.
+    data : bytes-like
+        Decompressed data of the block range.
+    meta : BlockMeta
+        Metadata of the block range.
+    is_subfile : bool
+        Flag indicating whether buf is a BPE file, or a non-BPE file
+        that contains BPE-compressed data within its body. (default: False)
+    backend : str
+        Backend used to compress blocks. (default: 'python')
+    pool : multiprocessing.Pool
+        Pool to compress the blocks in, if any. (default: None)
+
+    Returns
+    -------
+    bytearray
+        Data containing the new compressed block range.
+
+    Raises
+    ------
+    ValueError
+        If is_subfile is set and the block range no longer fits.
+    """
+
+    start_offset, end_offset, bpe_start = bpe.find_block_offsets(
+        buf, meta.start_block, meta.end_block, is_subfile, meta)
+    original_blocks = bpe.read_blocks(buf, meta.start_block, meta.end_block, is_subfile)
+    if is_subfile:
+        comp_block_list, _ = bpe.compress_blocks_best(
+            data, meta, meta.sort_orders, pool, backend, None, original_blocks)
+    else:
+        comp_block_list = bpe.compress_blocks(
+            data, meta, None, pool, backend, None, original_blocks)
+
+    new_data = bytearray(buf[:start_offset])
+    full_file_size = int.from_bytes(new_data[bpe_start:bpe_start+4], 'little')
+    full_file_size += len(data) - meta.decompressed_size
+    new_data[bpe_start:bpe_start+4] = full_file_size.to_bytes(4, 'little')
+    new_data += b''.join(comp_block_list)
+    new_data += buf[end_offset:]
+
+    if is_subfile:
+        size_diff = len(buf) - len(new_data)
+        if size_diff < 0:
+            raise ValueError('Block range {%d-%d} is %d bytes too large' %
+                             (meta.start_block, meta.end_block, -size_diff))
+        end_of_data = bpe.scan_blocks(new_data, 512, True)[2] + 4
+        new_data[end_of_data:end_of_data] = bytes(size_diff)
+
+    return new_data